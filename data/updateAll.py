@@ -33,9 +33,12 @@ try:
     from routeutils.utils import addRoutes
     from routeutils.utils import addVirtualNets
     from routeutils.utils import cacheStations
+    from routeutils.utils import internTables
+    from routeutils.utils import Interner
     from routeutils.utils import Route
     from routeutils.utils import RoutingCache
     from routeutils.utils import replacelast
+    from routeutils.packed import writePacked
 except Exception:
     raise
 
@@ -44,7 +47,9 @@ def mergeRoutes(fileRoutes, synchroList, allowOverlaps=False):
     """Retrieve routes from different sources and merge them with the local
 ones in the routing tables. The configuration file is checked to see whether
 overlapping routes are allowed or not. A pickled version of the the routing
-table is saved under the same filename plus ``.bin`` (e.g. routing.xml.bin).
+table is saved under the same filename plus ``.bin`` (e.g. routing.xml.bin)
+and a packed version, which can be shared by all worker processes, plus
+``.pack`` (e.g. routing.xml.pack).
 
 :param fileRoutes: File containing the local routing table
 :type fileRoutes: str
@@ -58,8 +63,11 @@ table is saved under the same filename plus ``.bin`` (e.g. routing.xml.bin).
     logs = logging.getLogger('mergeRoutes')
     logs.info('Synchronizing with: %s' % synchroList)
 
-    ptRT = addRoutes(fileRoutes, allowOverlaps=allowOverlaps)
-    ptVN = addVirtualNets(fileRoutes)
+    # Repeated codes, addresses and timewindows are stored only once
+    interner = Interner()
+    ptRT = addRoutes(fileRoutes, allowOverlaps=allowOverlaps,
+                     interner=interner)
+    ptVN = addVirtualNets(fileRoutes, interner=interner)
     eidaDCs = list()
     eidaDCs.append(json.load(open(replacelast(fileRoutes, '.xml', '.json'))))
 
@@ -91,23 +99,25 @@ table is saved under the same filename plus ``.bin`` (e.g. routing.xml.bin).
             # problematic file returning a coherent version of the routes
             print('Adding REMOTE %s' % dcid)
             ptRT = addRoutes('./routing-%s.xml' % dcid.strip(),
-                             routingTable=ptRT, allowOverlaps=allowOverlaps)
+                             routingTable=ptRT, allowOverlaps=allowOverlaps,
+                             interner=interner)
             ptVN = addVirtualNets('./routing-%s.xml' % dcid.strip(),
-                                  vnTable=ptVN)
+                                  vnTable=ptVN, interner=interner)
 
         if os.path.exists('./routing-%s.json' % dcid.strip()):
             print('Adding REMOTE data center information from %s' % dcid)
             eidaDCs.append(json.load(open('./routing-%s.json' % dcid.strip())))
 
-    try:
-        os.remove('./%s.bin' % fileRoutes)
-    except Exception:
-        pass
-
     stationTable = dict()
     cacheStations(ptRT, stationTable)
-
-    with open('./%s.bin' % fileRoutes, 'wb') as finalRoutes:
+    ptRT, stationTable, ptVN = internTables(ptRT, stationTable, ptVN,
+                                            interner)
+    logs.info('%d repeated values (%d bytes) shared\n' % (interner.shared,
+                                                         interner.saved))
+
+    # Write to a temporary file and rename it, so that a running service
+    # reloading the routes never reads an incomplete snapshot
+    with open('./%s.bin.tmp' % fileRoutes, 'wb') as finalRoutes:
         pickle.dump((ptRT, stationTable, ptVN, eidaDCs), finalRoutes)
         logs.info('Routes in main Routing Table: %s\n' % len(ptRT))
         logs.info('Stations cached: %s\n' %
@@ -116,6 +126,12 @@ table is saved under the same filename plus ``.bin`` (e.g. routing.xml.bin).
         logs.info('Virtual Networks defined: %s\n' % len(ptVN))
         logs.info('Information from data centers: %s\n' % len(eidaDCs))
 
+    os.replace('./%s.bin.tmp' % fileRoutes, './%s.bin' % fileRoutes)
+
+    # Packed version of the tables to be shared by all processes of the
+    # service. Written after the pickled one, so that it is not outdated.
+    writePacked('./%s.pack' % fileRoutes, ptRT, stationTable, ptVN, eidaDCs)
+
 
 def main():
     # FIXME logLevel must be used via argparser
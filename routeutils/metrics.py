@@ -0,0 +1,227 @@
+"""Metrics of the Routing WS for EIDA.
+
+Requests, responses and hits of the internal caches are always counted. A
+fraction of the requests (see ``metricssampling`` in routing.cfg) are also
+timed stage by stage. All values are kept per process and exported in the
+text format of Prometheus.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2014-2020 Javier Quinteros, Deutsches GFZ Potsdam <javier@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import random
+import threading
+from time import perf_counter
+from collections import Counter
+
+
+class RequestTimer(object):
+    """Time the stages of a request and save the size of its result.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('last', 'stages', 'sizes')
+
+    def __init__(self):
+        """Constructor of RequestTimer."""
+        self.last = perf_counter()
+        self.stages = dict()
+        self.sizes = dict()
+
+    def lap(self, stage):
+        """Assign the time since the previous lap to a stage.
+
+        :param stage: Name of the stage
+        :type stage: str
+        """
+        now = perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def add(self, stage, seconds):
+        """Add time to a stage which is part of another one.
+
+        :param stage: Name of the stage
+        :type stage: str
+        :param seconds: Time spent in the stage
+        :type seconds: float
+        """
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def size(self, name, value):
+        """Save the size of some part of the result.
+
+        :param name: Name of the magnitude (f.i. bytes)
+        :type name: str
+        :param value: Size
+        :type value: int
+        """
+        self.sizes[name] = value
+
+
+class Metrics(object):
+    """Collect the metrics of the service in the current process.
+
+    Stages are only timed for the sampled requests, so that the overhead is
+    negligible if sampling is disabled. Functions called while a request is
+    processed can get the timer of the request, if any, with
+    :meth:`~Metrics.current`.
+
+    :platform: Any
+
+    """
+
+    def __init__(self, sampling=0.0):
+        """Constructor of Metrics.
+
+        :param sampling: Fraction of the requests to time (0 to 1)
+        :type sampling: float
+        """
+        self.sampling = sampling
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.requests = Counter()
+        self.cacheHits = Counter()
+        self.cacheMisses = Counter()
+        # Sum and count of the time spent in every stage
+        self.stageSum = Counter()
+        self.stageCount = Counter()
+        # Sum and count of every magnitude of the results
+        self.sizeSum = Counter()
+        self.sizeCount = Counter()
+
+    def start(self):
+        """Decide whether a new request is sampled.
+
+        :returns: Timer of the request or None if it is not sampled
+        :rtype: :class:`~RequestTimer`
+        """
+        if self.sampling and (random.random() < self.sampling):
+            timer = RequestTimer()
+        else:
+            timer = None
+        self.local.timer = timer
+        return timer
+
+    def current(self):
+        """Return the timer of the request processed by this thread, if any."""
+        return getattr(self.local, 'timer', None)
+
+    def finish(self, function, status, timer=None):
+        """Count a request and save its timings if it was sampled.
+
+        :param function: Function of the service called
+        :type function: str
+        :param status: HTTP status of the response
+        :type status: str
+        :param timer: Timer of the request
+        :type timer: :class:`~RequestTimer`
+        """
+        self.local.timer = None
+        with self.lock:
+            self.requests[(function, status.split()[0])] += 1
+            if timer is None:
+                return
+            for stage, seconds in timer.stages.items():
+                self.stageSum[(function, stage)] += seconds
+                self.stageCount[(function, stage)] += 1
+            for name, value in timer.sizes.items():
+                self.sizeSum[(function, name)] += value
+                self.sizeCount[(function, name)] += 1
+
+    def hit(self, cache):
+        """Count a hit in one of the internal caches."""
+        with self.lock:
+            self.cacheHits[cache] += 1
+
+    def miss(self, cache):
+        """Count a miss in one of the internal caches."""
+        with self.lock:
+            self.cacheMisses[cache] += 1
+
+    def export(self, rc=None):
+        """Export all metrics in the text format of Prometheus.
+
+        :param rc: Routing information in use
+        :type rc: :class:`~routeutils.utils.RoutingCache`
+        :returns: Metrics in Prometheus format
+        :rtype: str
+        """
+        lines = list()
+
+        def metric(name, kind, helpText, values):
+            lines.append('# HELP %s %s' % (name, helpText))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in values:
+                labels = ','.join('%s="%s"' % lab for lab in labels)
+                lines.append('%s%s %s' % (name, '{%s}' % labels if labels
+                                          else '', repr(value)))
+
+        with self.lock:
+            metric('routing_requests_total', 'counter',
+                   'Requests by function and HTTP status.',
+                   [((('function', f), ('status', s)), v)
+                    for (f, s), v in sorted(self.requests.items())])
+            metric('routing_cache_hits_total', 'counter',
+                   'Hits in the internal caches.',
+                   [((('cache', c),), v)
+                    for c, v in sorted(self.cacheHits.items())])
+            metric('routing_cache_misses_total', 'counter',
+                   'Misses in the internal caches.',
+                   [((('cache', c),), v)
+                    for c, v in sorted(self.cacheMisses.items())])
+
+            lines.append('# HELP routing_stage_seconds Time spent in every '
+                         'stage of the sampled requests.')
+            lines.append('# TYPE routing_stage_seconds summary')
+            for (f, s) in sorted(self.stageSum):
+                labels = 'function="%s",stage="%s"' % (f, s)
+                lines.append('routing_stage_seconds_sum{%s} %r' %
+                             (labels, self.stageSum[(f, s)]))
+                lines.append('routing_stage_seconds_count{%s} %d' %
+                             (labels, self.stageCount[(f, s)]))
+
+            lines.append('# HELP routing_result_size Size of the results of '
+                         'the sampled requests.')
+            lines.append('# TYPE routing_result_size summary')
+            for (f, n) in sorted(self.sizeSum):
+                labels = 'function="%s",magnitude="%s"' % (f, n)
+                lines.append('routing_result_size_sum{%s} %d' %
+                             (labels, self.sizeSum[(f, n)]))
+                lines.append('routing_result_size_count{%s} %d' %
+                             (labels, self.sizeCount[(f, n)]))
+
+        metric('routing_sampling_ratio', 'gauge',
+               'Fraction of the requests timed.', [((), self.sampling)])
+
+        if rc is not None:
+            metric('routing_table_generation', 'gauge',
+                   'Generation of the routing information in use.',
+                   [((), rc.generation)])
+            metric('routing_table_streams', 'gauge',
+                   'Streams in the routing table.',
+                   [((), len(rc.routingTable))])
+            metric('routing_table_vnets', 'gauge',
+                   'Virtual networks defined.', [((), len(rc.vnTable))])
+            metric('routing_table_shared_bytes', 'gauge',
+                   'Memory saved sharing the values repeated in the tables.',
+                   [((), rc.sharedBytes)])
+
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+registry = Metrics()
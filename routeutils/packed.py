@@ -0,0 +1,489 @@
+"""Packed read-only snapshot of the routing information.
+
+The routing, station and virtual network tables are written as packed records
+in a single file (e.g. routing.xml.pack). Every worker process maps the file
+in memory instead of unpickling its own copy of the tables, so that the pages
+are shared by all of them through the page cache of the OS. Records are only
+decoded when they are accessed and the routes decoded recently are kept.
+The routes of every service are also ranked in advance and their ranks
+written, so that the workers do not need to sort and compare them again.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2014-2020 Javier Quinteros, Deutsches GFZ Potsdam <javier@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import os
+import mmap
+import functools
+import json
+import struct
+import datetime
+from array import array
+from collections.abc import Mapping
+from collections.abc import Sequence
+
+from .utils import Stream
+from .utils import TW
+from .utils import Route
+from .utils import Station
+from .utils import BitsetIndex
+from .utils import ServiceRoutes
+
+MAGIC = b'RTPK'
+VERSION = 2
+
+# Sections of the file in the order in which they are written
+SECTIONS = ('stringOffsets', 'strings', 'streams', 'routes', 'groups',
+            'stationNames', 'latitudes', 'longitudes', 'stationStarts',
+            'stationEnds', 'vnets', 'vnMembers', 'eidaDCs', 'services',
+            'serviceBits', 'rankStreams', 'rankRoutes', 'streamFirsts',
+            'streamRanks', 'conflictFirsts', 'conflictRanks')
+
+# Magic, version and (offset, size) of every section
+HEADER = struct.Struct('<4sI%dQ' % (2 * len(SECTIONS)))
+# Network, station, location and channel codes, first route and routes
+STREAM = struct.Struct('<6I')
+# Service, address, start, end and priority
+ROUTE = struct.Struct('<2I2qi')
+# Address (netloc), stream, first station and stations
+GROUP = struct.Struct('<4I')
+# Code, first member and members
+VNET = struct.Struct('<3I')
+# Network, station, location and channel codes, start and end
+VNMEMBER = struct.Struct('<4I2q')
+# Service, first rank, ranks, first conflict and conflicts
+SERVICE = struct.Struct('<5I')
+
+# Open bounds of the time windows
+OPENSTART = -2**63
+OPENEND = 2**63 - 1
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def toMicroseconds(dt, default):
+    """Microseconds since the epoch or default if dt is None."""
+    if dt is None:
+        return default
+    return (dt - EPOCH) // MICROSECOND
+
+
+def fromMicroseconds(value):
+    """Datetime from microseconds since the epoch or None if open."""
+    if value in (OPENSTART, OPENEND):
+        return None
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+@functools.lru_cache(maxsize=65536)
+def packedTW(start, end):
+    """Timewindow from its bounds in microseconds.
+
+    The same few timewindows are shared by most of the routes. Every one is
+    decoded only once.
+    """
+    return TW(fromMicroseconds(start), fromMicroseconds(end))
+
+
+def writePacked(fileName, routingTable, stationTable, vnTable, eidaDCs):
+    """Write the routing information as a packed snapshot.
+
+    The file is written under a temporary name and renamed, so that processes
+    mapping the previous version are never affected.
+
+    :param fileName: Name of the packed snapshot (e.g. routing.xml.pack)
+    :type fileName: str
+    :param routingTable: Routing table
+    :type routingTable: dict
+    :param stationTable: Cache with names and locations of stations
+    :type stationTable: dict
+    :param vnTable: Table with the virtual networks
+    :type vnTable: dict
+    :param eidaDCs: Information about the data centres
+    :type eidaDCs: list
+    """
+    strings = dict()
+
+    def strId(s):
+        return strings.setdefault(s, len(strings))
+
+    streams = bytearray()
+    routes = bytearray()
+    streamIds = dict()
+    for pos, (st, lr) in enumerate(routingTable.items()):
+        streamIds[st] = pos
+        streams += STREAM.pack(strId(st.n), strId(st.s), strId(st.l),
+                               strId(st.c), len(routes) // ROUTE.size,
+                               len(lr))
+        for r in lr:
+            routes += ROUTE.pack(strId(r.service), strId(r.address),
+                                 toMicroseconds(r.tw.start, OPENSTART),
+                                 toMicroseconds(r.tw.end, OPENEND),
+                                 r.priority)
+
+    # Lists of stations are shared by all the hosts of a stream
+    groups = bytearray()
+    columns = dict((s, list()) for s in ('stationNames', 'latitudes',
+                                         'longitudes', 'stationStarts',
+                                         'stationEnds'))
+    written = dict()
+    for netloc, streamDict in stationTable.items():
+        for st, stations in streamDict.items():
+            try:
+                first = written[id(stations)]
+            except KeyError:
+                first = len(columns['stationNames'])
+                written[id(stations)] = first
+                for sta in stations:
+                    columns['stationNames'].append(strId(sta.name))
+                    columns['latitudes'].append(sta.latitude)
+                    columns['longitudes'].append(sta.longitude)
+                    columns['stationStarts'].append(
+                        toMicroseconds(sta.start, OPENSTART))
+                    columns['stationEnds'].append(
+                        toMicroseconds(sta.end, OPENEND))
+            groups += GROUP.pack(strId(netloc), streamIds[st], first,
+                                 len(stations))
+
+    vnets = bytearray()
+    vnMembers = bytearray()
+    for code, members in vnTable.items():
+        vnets += VNET.pack(strId(code), len(vnMembers) // VNMEMBER.size,
+                           len(members))
+        for st, tw in members:
+            vnMembers += VNMEMBER.pack(strId(st.n), strId(st.s),
+                                       strId(st.l), strId(st.c),
+                                       toMicroseconds(tw.start, OPENSTART),
+                                       toMicroseconds(tw.end, OPENEND))
+
+    # Routes of every service ranked with all their overlaps. The bitsets
+    # have one bit per stream and the arrays of every service follow the ones
+    # of the previous services.
+    index = BitsetIndex(routingTable)
+    services = bytearray()
+    serviceBits = bytearray()
+    arrays = dict((s, array('I')) for s in ('rankStreams', 'rankRoutes',
+                                            'streamFirsts', 'streamRanks',
+                                            'conflictFirsts',
+                                            'conflictRanks'))
+    nbytes = (len(index.streams) + 7) // 8
+    for service, bits in index.services.items():
+        table = ServiceRoutes(index, service)
+        conflictFirst = array('I', [0])
+        conflicts = array('I')
+        for rank in range(len(table)):
+            conflicts.extend(table.conflicts(rank))
+            conflictFirst.append(len(conflicts))
+
+        services += SERVICE.pack(strId(service), len(arrays['rankStreams']),
+                                 len(table), len(arrays['conflictRanks']),
+                                 len(conflicts))
+        serviceBits += bits.to_bytes(nbytes, 'little')
+        arrays['rankStreams'].extend(table.rankStream)
+        arrays['rankRoutes'].extend(table.rankRoute)
+        arrays['streamFirsts'].extend(table.streamFirst)
+        arrays['streamRanks'].extend(table.streamRanks)
+        arrays['conflictFirsts'].extend(conflictFirst)
+        arrays['conflictRanks'].extend(conflicts)
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+
+    n = len(columns['stationNames'])
+    data = {'stringOffsets': struct.pack('<%dI' % len(offsets), *offsets),
+            'strings': b''.join(encoded),
+            'streams': streams,
+            'routes': routes,
+            'groups': groups,
+            'stationNames': struct.pack('<%dI' % n, *columns['stationNames']),
+            'latitudes': struct.pack('<%dd' % n, *columns['latitudes']),
+            'longitudes': struct.pack('<%dd' % n, *columns['longitudes']),
+            'stationStarts': struct.pack('<%dq' % n,
+                                         *columns['stationStarts']),
+            'stationEnds': struct.pack('<%dq' % n, *columns['stationEnds']),
+            'vnets': vnets,
+            'vnMembers': vnMembers,
+            'eidaDCs': json.dumps(eidaDCs).encode('utf-8'),
+            'services': services,
+            'serviceBits': serviceBits}
+    for s, values in arrays.items():
+        data[s] = values.tobytes()
+
+    # Sections are aligned to 8 bytes, so that they can be cast to arrays
+    layout = list()
+    offset = HEADER.size
+    for s in SECTIONS:
+        offset += -offset % 8
+        layout.extend((offset, len(data[s])))
+        offset += len(data[s])
+
+    with open(fileName + '.tmp', 'wb') as fout:
+        fout.write(HEADER.pack(MAGIC, VERSION, *layout))
+        for s in SECTIONS:
+            fout.write(b'\0' * (-fout.tell() % 8))
+            fout.write(data[s])
+    os.replace(fileName + '.tmp', fileName)
+
+
+class PackedSnapshot(object):
+    """Map a packed snapshot in memory and give access to its tables.
+
+    The tables provide the same interface as the dictionaries read from the
+    pickled snapshot, but their records are decoded from the shared pages
+    every time they are accessed.
+
+    :platform: Linux (maybe also Windows)
+
+    """
+
+    def __init__(self, fileName):
+        """Constructor of PackedSnapshot.
+
+        :param fileName: Packed snapshot (e.g. routing.xml.pack)
+        :type fileName: str
+        :raises: ValueError
+        """
+        with open(fileName, 'rb') as fin:
+            self.mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = HEADER.unpack_from(self.mm)
+        if header[:2] != (MAGIC, VERSION):
+            raise ValueError('%s is not a packed snapshot (version %d)' %
+                             (fileName, VERSION))
+
+        view = memoryview(self.mm)
+        self.sections = dict()
+        for pos, s in enumerate(SECTIONS):
+            offset, size = header[2 + 2*pos:4 + 2*pos]
+            self.sections[s] = view[offset:offset + size]
+
+        offsets = self.sections['stringOffsets'].cast('I')
+        strings = bytes(self.sections['strings'])
+        self.strings = [strings[offsets[i]:offsets[i+1]].decode('utf-8')
+                        for i in range(len(offsets) - 1)]
+
+        self.names = self.sections['stationNames'].cast('I')
+        self.latitudes = self.sections['latitudes'].cast('d')
+        self.longitudes = self.sections['longitudes'].cast('d')
+        self.starts = self.sections['stationStarts'].cast('q')
+        self.ends = self.sections['stationEnds'].cast('q')
+
+        self.routingTable = PackedRoutingTable(self)
+        self.stationTable = dict()
+        keys = self.routingTable.streams
+        for netloc, st, first, length in \
+                GROUP.iter_unpack(self.sections['groups']):
+            self.stationTable.setdefault(self.strings[netloc], dict())[
+                keys[st]] = PackedStationList(self, first, length)
+
+    def stream(self, n, s, l, c):
+        """Decode a stream from the ids of its codes."""
+        return Stream(self.strings[n], self.strings[s], self.strings[l],
+                      self.strings[c])
+
+    def vnTable(self):
+        """Decode the table of virtual networks.
+
+        :returns: Streams and time windows of every virtual network
+        :rtype: dict
+        """
+        members = self.sections['vnMembers']
+        result = dict()
+        for code, first, length in VNET.iter_unpack(self.sections['vnets']):
+            result[self.strings[code]] = [
+                (self.stream(*m[:4]), TW(fromMicroseconds(m[4]),
+                                         fromMicroseconds(m[5])))
+                for m in VNMEMBER.iter_unpack(
+                    members[first * VNMEMBER.size:
+                            (first + length) * VNMEMBER.size])]
+        return result
+
+    def eidaDCs(self):
+        """Decode the information about the data centres."""
+        return json.loads(bytes(self.sections['eidaDCs']).decode('utf-8'))
+
+
+class PackedRoutingTable(Mapping):
+    """Routing table decoded on demand from a packed snapshot.
+
+    Only the streams used as keys and the routes of the streams accessed
+    recently are kept in the memory of the process. The lists of routes
+    returned are shared and must not be modified. The routes of every service
+    ranked in advance are found in :attr:`partitions`.
+
+    :platform: Linux (maybe also Windows)
+
+    """
+
+    # Maximum number of streams whose decoded routes are kept
+    cacheSize = 16384
+
+    def __init__(self, snapshot):
+        """Constructor of PackedRoutingTable.
+
+        :param snapshot: Snapshot mapped in memory
+        :type snapshot: :class:`~PackedSnapshot`
+        """
+        self.snapshot = snapshot
+        self.streams = list()
+        self.slices = dict()
+        for n, s, l, c, first, length in \
+                STREAM.iter_unpack(snapshot.sections['streams']):
+            st = snapshot.stream(n, s, l, c)
+            self.streams.append(st)
+            self.slices[st] = (first, length)
+        # Routes already decoded by stream
+        self.cache = dict()
+
+        # Ranked routes of every service
+        self.partitions = dict()
+        sections = dict((s, snapshot.sections[s].cast('I'))
+                        for s in ('rankStreams', 'rankRoutes', 'streamFirsts',
+                                  'streamRanks', 'conflictFirsts',
+                                  'conflictRanks'))
+        bits = snapshot.sections['serviceBits']
+        nbytes = (len(self.streams) + 7) // 8
+        for k, (service, first, ranks, firstConflict, conflicts) in \
+                enumerate(SERVICE.iter_unpack(snapshot.sections['services'])):
+            streamFirst = k * (len(self.streams) + 1)
+            self.partitions[snapshot.strings[service]] = PackedPartition(
+                int.from_bytes(bits[k * nbytes:(k + 1) * nbytes], 'little'),
+                sections['rankStreams'][first:first + ranks],
+                sections['rankRoutes'][first:first + ranks],
+                sections['streamFirsts'][streamFirst:
+                                         streamFirst + len(self.streams) + 1],
+                sections['streamRanks'][first:first + ranks],
+                sections['conflictFirsts'][first + k:first + k + ranks + 1],
+                sections['conflictRanks'][firstConflict:
+                                          firstConflict + conflicts])
+
+    def __getitem__(self, stream):
+        try:
+            return self.cache[stream]
+        except KeyError:
+            pass
+
+        first, length = self.slices[stream]
+        strings = self.snapshot.strings
+        routes = self.snapshot.sections['routes']
+        result = [Route(strings[srv], strings[addr], packedTW(start, end),
+                        prio)
+                  for srv, addr, start, end, prio in ROUTE.iter_unpack(
+                      routes[first * ROUTE.size:
+                             (first + length) * ROUTE.size])]
+
+        if len(self.cache) >= self.cacheSize:
+            self.cache.clear()
+        self.cache[stream] = result
+        return result
+
+    def __contains__(self, stream):
+        return stream in self.slices
+
+    def __iter__(self):
+        return iter(self.streams)
+
+    def __len__(self):
+        return len(self.streams)
+
+
+class PackedPartition(object):
+    """Routes of one service ranked in advance in a packed snapshot.
+
+    The arrays are the ones of :class:`~routeutils.utils.ServiceRoutes` and
+    are read from the shared pages. The ranks of the routes overlapping the
+    route with rank r are found between conflictFirst[r] and
+    conflictFirst[r + 1] in conflictRanks.
+
+    :platform: Linux (maybe also Windows)
+
+    """
+
+    __slots__ = ('bits', 'rankStream', 'rankRoute', 'streamFirst',
+                 'streamRanks', 'conflictFirst', 'conflictRanks')
+
+    def __init__(self, bits, rankStream, rankRoute, streamFirst, streamRanks,
+                 conflictFirst, conflictRanks):
+        """Constructor of PackedPartition.
+
+        :param bits: Bitset of the streams with routes of the service
+        :type bits: int
+        :param rankStream: Position of the stream of every route by rank
+        :type rankStream: memoryview
+        :param rankRoute: Position of every route in its stream by rank
+        :type rankRoute: memoryview
+        :param streamFirst: First rank in streamRanks of every stream
+        :type streamFirst: memoryview
+        :param streamRanks: Ranks of the routes of every stream
+        :type streamRanks: memoryview
+        :param conflictFirst: First rank in conflictRanks of every route
+        :type conflictFirst: memoryview
+        :param conflictRanks: Ranks of the routes overlapping every route
+        :type conflictRanks: memoryview
+        """
+        self.bits = bits
+        self.rankStream = rankStream
+        self.rankRoute = rankRoute
+        self.streamFirst = streamFirst
+        self.streamRanks = streamRanks
+        self.conflictFirst = conflictFirst
+        self.conflictRanks = conflictRanks
+
+
+class PackedStationList(Sequence):
+    """Stations cached for a stream, decoded on demand from a packed snapshot.
+
+    :platform: Linux (maybe also Windows)
+
+    """
+
+    __slots__ = ('snapshot', 'first', 'length')
+
+    def __init__(self, snapshot, first, length):
+        """Constructor of PackedStationList.
+
+        :param snapshot: Snapshot mapped in memory
+        :type snapshot: :class:`~PackedSnapshot`
+        :param first: Position of the first station in the snapshot
+        :type first: int
+        :param length: Number of stations
+        :type length: int
+        """
+        self.snapshot = snapshot
+        self.first = first
+        self.length = length
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return [self[i] for i in range(*pos.indices(self.length))]
+
+        if pos < 0:
+            pos += self.length
+        if not 0 <= pos < self.length:
+            raise IndexError('station index out of range')
+
+        sn = self.snapshot
+        pos += self.first
+        return Station(sn.strings[sn.names[pos]], sn.latitudes[pos],
+                       sn.longitudes[pos], fromMicroseconds(sn.starts[pos]),
+                       fromMicroseconds(sn.ends[pos]))
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        return list(self) == list(other)
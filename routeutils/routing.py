@@ -18,12 +18,78 @@ any later version.
 """
 
 import datetime
+import functools
+import logging
 import xml.etree.cElementTree as ET
 import json
 from .wsgicomm import WIClientError
 from .utils import RequestMerge
 from .utils import FDSNRules
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The same datetimes are repeated in many routes. Format them only once.
+isoformat = functools.lru_cache(maxsize=65536)(datetime.datetime.isoformat)
+
+
+def _dumpsJSON(obj):
+    return json.dumps(obj, default=isoformat).encode('utf-8')
+
+
+def _dumpsORJSON(obj):
+    return orjson.dumps(obj, default=isoformat)
+
+
+# Encoders available to serialize the results to JSON. The output of orjson
+# is equivalent but more compact (without spaces and not escaping non-ASCII
+# characters).
+jsonEncoders = {'json': _dumpsJSON}
+if orjson is not None:
+    jsonEncoders['orjson'] = _dumpsORJSON
+
+# Name of the JSON encoder in use
+jsonEncoder = 'json'
+# Name of the JSON encoder requested the last time
+configuredEncoder = 'json'
+
+
+def setJSONEncoder(name):
+    """Select the encoder used to serialize the results to JSON.
+
+    If the encoder is not available, the one from the standard library is
+    used. This is called with every request, so nothing is done (or logged)
+    if the encoder requested did not change.
+
+    :param name: Name of the encoder (json or orjson)
+    :type name: str
+    """
+    global jsonEncoder
+    global configuredEncoder
+
+    name = name.lower()
+    if name == configuredEncoder:
+        return
+
+    configuredEncoder = name
+    if name not in jsonEncoders:
+        logging.warning('JSON encoder %s not available. Using json.' % name)
+        name = 'json'
+    jsonEncoder = name
+
+
+def dumpsJSON(obj):
+    """Serialize an object to JSON with the encoder selected.
+
+    :param obj: Object to serialize. Datetimes are allowed.
+    :type obj: object
+    :returns: Object in JSON format (UTF-8)
+    :rtype: bytes
+    """
+    return jsonEncoders[jsonEncoder](obj)
+
 
 def _ConvertDictToXmlRecurse(parent, dictitem):
     assert not isinstance(dictitem, list)
@@ -63,28 +129,6 @@ def ConvertDictToXml(listdict):
     return r
 
 
-# Important to support the comma-syntax from FDSN (f.i. GE,RO,XX)
-def lsNSLC(net, sta, loc, cha):
-    """Iterator providing NSLC tuples from comma separated components.
-
-    :param net: Network code(s) in comma-separated format.
-    :type net: list
-    :param sta: Station code(s) in comma-separated format.
-    :type sta: list
-    :param loc: Location code(s) in comma-separated format.
-    :type loc: list
-    :param cha: Channel code(s) in comma-separated format.
-    :type cha: list
-    :rtype: tuple
-    :returns: NSLC tuples
-    """
-    for n in net:
-        for s in sta:
-            for l in loc:
-                for c in cha:
-                    yield (n, s, l, c)
-
-
 def applyFormat(resultRM, outFormat='xml'):
     """Apply the format specified to the RequestMerge object received.
 
@@ -92,15 +136,14 @@ def applyFormat(resultRM, outFormat='xml'):
     :type resultRM: RequestMerge
     :param outFormat: Output format for the result.
     :type outFormat: string
-    :rtype: string
-    :returns: Transformed version of the input in the desired format
+    :rtype: bytes
+    :returns: Transformed version of the input in the desired format (UTF-8)
     """
     if not isinstance(resultRM, RequestMerge):
         raise Exception('applyFormat expects a RequestMerge object!')
 
     if outFormat == 'json':
-        iterObj = json.dumps(resultRM, default=datetime.datetime.isoformat)
-        return iterObj
+        return dumpsJSON(resultRM)
     elif outFormat == 'get':
         iterObj = []
         for datacenter in resultRM:
@@ -110,11 +153,11 @@ def applyFormat(resultRM, outFormat='xml'):
                 iterObj.append(datacenter['url'] + '?' +
                                '&'.join([k + '=' + (str(item[k]) if not
                                          isinstance(item[k], datetime.datetime)
-                                         else item[k].isoformat()) for k in
+                                         else isoformat(item[k])) for k in
                                          item if item[k] not in ('', '*') and
                                          k != 'priority']))
         iterObj = '\n'.join(iterObj)
-        return iterObj
+        return iterObj.encode('utf-8')
     elif outFormat == 'post':
         iterObj = []
         for datacenter in resultRM:
@@ -123,11 +166,11 @@ def applyFormat(resultRM, outFormat='xml'):
                 item['loc'] = item['loc'] if len(item['loc']) else '--'
                 item['start'] = item['start'] if isinstance(item['start'],
                                                             str) \
-                    else item['start'].isoformat()
+                    else isoformat(item['start'])
 
                 # If endtime is a datetime get it in isoformat (string)
                 if isinstance(item['end'], datetime.datetime):
-                    item['end'] = item['end'].isoformat()
+                    item['end'] = isoformat(item['end'])
                 # If endtime is not a string use a default value (tomorrow)
                 if ((not isinstance(item['end'], str)) or
                         (isinstance(item['end'], str) and
@@ -139,18 +182,15 @@ def applyFormat(resultRM, outFormat='xml'):
                                item['start'] + ' ' + item['end'])
             iterObj.append('')
         iterObj = '\n'.join(iterObj)
-        return iterObj
+        return iterObj.encode('utf-8')
     elif outFormat == 'xml':
-        # Setting the encoding to unicode is the only way to get a string in the output
-        # Otherwise it will be a bytestring and the send_xml_response will fail
+        # Serializing to a string and encoding it once is faster than letting
+        # ElementTree encode every piece (and adds no XML declaration)
         iterObj2 = ET.tostring(ConvertDictToXml(resultRM), encoding='unicode')
-        return iterObj2
+        return iterObj2.encode('utf-8')
     elif outFormat == 'fdsn':
         # This is the metadata schema Chad drafted on his mail on
-        # Setting the encoding to unicode is the only way to get a string in the output
-        # Otherwise it will be a bytestring and the send_xml_response will fail
         resultFDSN = FDSNRules(resultRM)
-        iterObj = json.dumps(resultFDSN, default=datetime.datetime.isoformat)
-        return iterObj
+        return dumpsJSON(resultFDSN)
     else:
         raise WIClientError('Wrong format requested!')
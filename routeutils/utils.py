@@ -16,20 +16,36 @@ any later version.
 """
 
 import os
+import sys
+import bisect
+import math
 import datetime
 import fnmatch
+import functools
+import itertools
+import operator
 import json
+from array import array
 import xml.etree.cElementTree as ET
 from time import sleep
+from time import perf_counter
 from collections import namedtuple
 import logging
 from copy import deepcopy
 import pickle
+import threading
 import configparser
 import urllib.request as ul
 from urllib.parse import urlparse
 from urllib.error import URLError
 # from urllib.error import HTTPError
+from .metrics import registry
+
+try:
+    import numpy
+except ImportError:
+    # Station caches are filtered in pure Python
+    numpy = None
 
 
 # I need to find a mapping from (service, URL) to the schema below. It seems
@@ -633,6 +649,37 @@ def str2date(dStr):
     return datetime.datetime(*map(int, dateParts))
 
 
+@functools.lru_cache(maxsize=65536)
+def codeOverlap(code1, code2):
+    """Check if two codes of a N.S.L.C component overlap.
+
+    Results are cached, as the same few codes are compared many times.
+
+    :param code1: First code (wildcards allowed)
+    :type code1: str
+    :param code2: Second code (wildcards allowed)
+    :type code2: str
+    :rtype: boolean
+    :returns: Value indicating if any of the codes matches the other one
+    """
+    return ((code1 is None) or (code2 is None) or
+            fnmatch.fnmatch(code1, code2) or fnmatch.fnmatch(code2, code1))
+
+
+@functools.lru_cache(maxsize=4096)
+def hostOf(address):
+    """Return the host of the address of a route.
+
+    Results are cached, as the routes point to a few addresses.
+
+    :param address: Address of the route
+    :type address: str
+    :rtype: str
+    :returns: Host (and port) of the address
+    """
+    return urlparse(address).netloc
+
+
 def checkOverlap(str1, routeList, str2, route):
     """Check overlap of routes from stream str1 and a route from str2.
 
@@ -749,6 +796,95 @@ def cacheStations(routingTable, stationTable):
                 stationTable[service][st] = result
 
 
+class Interner(object):
+    """Share one copy of the values repeated in the routing information.
+
+    The same codes, services, addresses and timewindows appear in thousands
+    of routes. Every value is replaced by the first equal one seen, so that
+    only one object is kept in memory (and in the pickled snapshot).
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('values', 'shared', 'saved')
+
+    def __init__(self):
+        """Constructor of Interner."""
+        self.values = dict()
+        # Number and size (bytes) of the copies replaced
+        self.shared = 0
+        self.saved = 0
+
+    def __call__(self, value):
+        """Return the shared copy of a value.
+
+        :param value: String, datetime or timewindow
+        :type value: object
+        :returns: First value equal to the one given
+        :rtype: object
+        """
+        shared = self.values.setdefault(value, value)
+        if shared is not value:
+            self.shared += 1
+            self.saved += sys.getsizeof(value)
+        return shared
+
+    def stream(self, st):
+        """Return the shared copy of a :class:`~Stream` and its codes."""
+        return self(Stream(self(st.n), self(st.s), self(st.l), self(st.c)))
+
+    def tw(self, tw):
+        """Return the shared copy of a :class:`~TW` and its datetimes."""
+        return self(TW(self(tw.start), self(tw.end)))
+
+    def route(self, rt):
+        """Return a :class:`~Route` with shared service, address and TW."""
+        return Route(self(rt.service), self(rt.address), self.tw(rt.tw),
+                     rt.priority)
+
+
+def internTables(routingTable, stationTable, vnTable, interner=None):
+    """Build the routing information again sharing all repeated values.
+
+    :param routingTable: Routing table
+    :type routingTable: dict
+    :param stationTable: Cache with names and locations of stations
+    :type stationTable: dict
+    :param vnTable: Table with the virtual networks
+    :type vnTable: dict
+    :param interner: Values already shared
+    :type interner: :class:`~Interner`
+    :returns: Routing, station and virtual network tables
+    :rtype: tuple
+    """
+    intern = interner if interner is not None else Interner()
+
+    ptRT = dict()
+    for st, routes in routingTable.items():
+        ptRT[intern.stream(st)] = [intern.route(rt) for rt in routes]
+
+    # The same list of stations can be cached for many hosts
+    lists = dict()
+    ptST = dict()
+    for host, streams in stationTable.items():
+        auxST = ptST.setdefault(intern(host), dict())
+        for st, stations in streams.items():
+            if id(stations) not in lists:
+                lists[id(stations)] = [
+                    Station(intern(sta.name), sta.latitude, sta.longitude,
+                            intern(sta.start), intern(sta.end))
+                    for sta in stations]
+            auxST[intern.stream(st)] = lists[id(stations)]
+
+    ptVN = dict()
+    for code, members in vnTable.items():
+        ptVN[intern(code)] = [(intern.stream(st), intern.tw(tw))
+                              for st, tw in members]
+
+    return ptRT, ptST, ptVN
+
+
 def addVirtualNets(fileName, **kwargs):
     """Read the routing file in XML format and store its VNs in memory.
 
@@ -765,10 +901,14 @@ def addVirtualNets(fileName, **kwargs):
 
     :Keyword Arguments:
         * *vnTable* (``dict``) Table with virtual networks where aliases should be added.
+        * *interner* (:class:`~Interner`) Values shared with other tables.
     """
     # VN table is empty (default)
     ptVN = kwargs.get('vnTable', dict())
 
+    # Repeated codes and timewindows are shared
+    intern = kwargs.get('interner') or Interner()
+
     logs = logging.getLogger('addVirtualNets')
     logs.debug('Entering addVirtualNets()\n')
 
@@ -882,12 +1022,12 @@ def addVirtualNets(fileName, **kwargs):
                         msg = 'Error while converting END attribute.\n'
                         logs.warning(msg)
 
+                    member = (intern.stream(Stream(net, sta, loc, cha)),
+                              intern.tw(TW(startD, endD)))
                     if vnCode not in ptVN:
-                        ptVN[vnCode] = [(Stream(net, sta, loc, cha),
-                                         TW(startD, endD))]
+                        ptVN[intern(vnCode)] = [member]
                     else:
-                        ptVN[vnCode].append((Stream(net, sta, loc, cha),
-                                             TW(startD, endD)))
+                        ptVN[vnCode].append(member)
 
                     stream.clear()
 
@@ -915,10 +1055,14 @@ def addRoutes(fileName, **kwargs):
 
     :Keyword Arguments:
         * *routingTable* (``dict``) Routing Table where routes should be added to.
+        * *interner* (:class:`~Interner`) Values shared with other tables.
     """
     # Routing table is empty (default)
     ptRT = kwargs.get('routingTable', dict())
 
+    # Repeated codes, services, addresses and timewindows are shared
+    intern = kwargs.get('interner') or Interner()
+
     logs = logging.getLogger('addRoutes')
     logs.debug('Entering addRoutes(%s)\n' % fileName)
 
@@ -1092,10 +1236,11 @@ def addRoutes(fileName, **kwargs):
                             priority = 99
 
                         # Append the network to the list of networks
-                        st = Stream(networkCode, stationCode, locationCode,
-                                    streamCode)
-                        tw = TW(startD, endD)
-                        rt = Route(service, address, tw, priority)
+                        st = intern.stream(Stream(networkCode, stationCode,
+                                                  locationCode, streamCode))
+                        tw = intern.tw(TW(startD, endD))
+                        rt = Route(intern(service), intern(address), tw,
+                                   priority)
 
                         try:
                             # Check the overlap between the routes to import
@@ -1131,7 +1276,7 @@ def addRoutes(fileName, **kwargs):
 
     # Order the routes by priority
     for keyDict in ptRT:
-        ptRT[keyDict] = sorted(ptRT[keyDict])
+        ptRT[keyDict] = sorted(ptRT[keyDict], key=Route.sortKey)
 
     return ptRT
 
@@ -1355,6 +1500,8 @@ class Station(namedtuple('Station', ['name', 'latitude', 'longitude', 'start', '
            name: station name
            latitude: latitude
            longitude: longitude
+           start: start of the station epoch
+           end: end of the station epoch
 
     :platform: Any
 
@@ -1362,6 +1509,739 @@ class Station(namedtuple('Station', ['name', 'latitude', 'longitude', 'start', '
 
     __slots__ = ()
 
+    def active(self, tw):
+        """Check if the station was operating during the timewindow.
+
+        :param tw: Timewindow
+        :type tw: :class:`~TW`
+        :returns: Value specifying whether the epoch of the station overlaps
+            the timewindow. Open dates are considered unbounded.
+        :rtype: Bool
+        """
+        if ((tw.end is not None) and (self.start is not None) and
+                (self.start > tw.end)):
+            return False
+        if ((tw.start is not None) and (self.end is not None) and
+                (self.end < tw.start)):
+            return False
+        return True
+
+
+class StationIndex(object):
+    """Index of the stations cached for a stream.
+
+    Stations are indexed by name and sorted by latitude and by the start and
+    end of their epochs. A query iterates only over the most selective of
+    these indexes for the requested station code, geographical rectangle and
+    timewindow. Results keep the order of the cached list.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('stations', 'byName', 'latitudes', 'byLatitude', 'starts',
+                 'byStart', 'ends', 'byEnd')
+
+    def __init__(self, stations):
+        """Constructor of StationIndex.
+
+        :param stations: Stations cached for a stream
+        :type stations: list of :class:`~Station`
+
+        """
+        self.stations = stations
+
+        # Positions of the stations with the same name
+        self.byName = dict()
+        for pos, sta in enumerate(stations):
+            self.byName.setdefault(sta.name, list()).append(pos)
+
+        # Positions of the stations sorted by latitude
+        self.byLatitude = sorted(range(len(stations)),
+                                 key=lambda pos: stations[pos].latitude)
+        self.latitudes = [stations[pos].latitude for pos in self.byLatitude]
+
+        # Positions of the stations sorted by start and end of their epochs
+        starts = [epochSeconds(sta.start, -math.inf) for sta in stations]
+        self.byStart = sorted(range(len(stations)), key=starts.__getitem__)
+        self.starts = [starts[pos] for pos in self.byStart]
+        ends = [epochSeconds(sta.end, math.inf) for sta in stations]
+        self.byEnd = sorted(range(len(stations)), key=ends.__getitem__)
+        self.ends = [ends[pos] for pos in self.byEnd]
+
+    def names(self, pattern):
+        """Return the names of the stations matching the pattern.
+
+        :param pattern: Station code (wildcards allowed)
+        :type pattern: str
+        :returns: Names of the stations in the index matching the pattern
+        :rtype: list
+        """
+        if not any(w in pattern for w in '*?['):
+            return [pattern] if pattern in self.byName else []
+
+        return [name for name in self.byName
+                if fnmatch.fnmatch(name, pattern)]
+
+    def select(self, pattern='*', geoLocation=None, tw=None):
+        """Return the stations matching a station code and a rectangle.
+
+        :param pattern: Station code (wildcards allowed)
+        :type pattern: str
+        :param geoLocation: Rectangle restricting the location of the station
+        :type geoLocation: :class:`~geoRectangle`
+        :param tw: Timewindow in which the stations must be operating
+        :type tw: :class:`~TW`
+        :returns: Stations matching all the conditions
+        :rtype: list of :class:`~Station`
+        """
+        # Candidates provided by each of the indexes
+        candidates = list()
+        if not any(w in pattern for w in '*?['):
+            candidates.append(self.byName.get(pattern, []))
+        if geoLocation is not None:
+            lo = bisect.bisect_left(self.latitudes, geoLocation.minlat)
+            hi = bisect.bisect_right(self.latitudes, geoLocation.maxlat)
+            candidates.append(self.byLatitude[lo:hi])
+        if (tw is not None) and (tw.end is not None):
+            hi = bisect.bisect_right(self.starts, epochSeconds(tw.end))
+            candidates.append(self.byStart[:hi])
+        if (tw is not None) and (tw.start is not None):
+            lo = bisect.bisect_left(self.ends, epochSeconds(tw.start))
+            candidates.append(self.byEnd[lo:])
+
+        if len(candidates):
+            positions = sorted(min(candidates, key=len))
+        else:
+            positions = range(len(self.stations))
+
+        names = None if pattern == '*' else set(self.names(pattern))
+
+        result = list()
+        for pos in positions:
+            sta = self.stations[pos]
+            if (names is not None) and (sta.name not in names):
+                continue
+            if ((geoLocation is not None) and
+                    not geoLocation.contains(sta.latitude, sta.longitude)):
+                continue
+            if (tw is not None) and not sta.active(tw):
+                continue
+            result.append(sta)
+
+        return result
+
+
+class NumpyStationIndex(StationIndex):
+    """Index of the stations cached for a stream based on NumPy arrays.
+
+    Latitudes, longitudes, epochs and names of the stations are kept in
+    parallel arrays and all conditions are applied as vectorised masks.
+    Epochs are stored as seconds since 1970 with open dates set to infinite.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('nameIds', 'nameArray', 'latArray', 'lonArray',
+                 'startArray', 'endArray')
+
+    def __init__(self, stations):
+        """Constructor of NumpyStationIndex.
+
+        :param stations: Stations cached for a stream
+        :type stations: list of :class:`~Station`
+
+        """
+        self.stations = stations
+
+        # Positions of the stations with the same name
+        self.byName = dict()
+        for pos, sta in enumerate(stations):
+            self.byName.setdefault(sta.name, list()).append(pos)
+
+        self.nameIds = dict((name, i) for i, name in enumerate(self.byName))
+        self.nameArray = numpy.array([self.nameIds[sta.name]
+                                      for sta in stations], dtype=numpy.int32)
+        self.latArray = numpy.array([sta.latitude for sta in stations],
+                                    dtype=numpy.float64)
+        self.lonArray = numpy.array([sta.longitude for sta in stations],
+                                    dtype=numpy.float64)
+        self.startArray = numpy.array([epochSeconds(sta.start, -numpy.inf)
+                                       for sta in stations],
+                                      dtype=numpy.float64)
+        self.endArray = numpy.array([epochSeconds(sta.end, numpy.inf)
+                                     for sta in stations],
+                                    dtype=numpy.float64)
+
+    def select(self, pattern='*', geoLocation=None, tw=None):
+        """Return the stations matching a station code and a rectangle.
+
+        :param pattern: Station code (wildcards allowed)
+        :type pattern: str
+        :param geoLocation: Rectangle restricting the location of the station
+        :type geoLocation: :class:`~geoRectangle`
+        :param tw: Timewindow in which the stations must be operating
+        :type tw: :class:`~TW`
+        :returns: Stations matching all the conditions
+        :rtype: list of :class:`~Station`
+        """
+        if pattern == '*':
+            mask = numpy.ones(len(self.stations), dtype=bool)
+        else:
+            mask = numpy.isin(self.nameArray,
+                              [self.nameIds[name]
+                               for name in self.names(pattern)])
+
+        if geoLocation is not None:
+            mask &= ((self.latArray >= geoLocation.minlat) &
+                     (self.latArray <= geoLocation.maxlat) &
+                     (self.lonArray >= geoLocation.minlon) &
+                     (self.lonArray <= geoLocation.maxlon))
+
+        if tw is not None:
+            if tw.end is not None:
+                mask &= self.startArray <= epochSeconds(tw.end)
+            if tw.start is not None:
+                mask &= self.endArray >= epochSeconds(tw.start)
+
+        return [self.stations[pos] for pos in numpy.flatnonzero(mask)]
+
+
+def epochSeconds(dt, default=None):
+    """Return the seconds since 1970 of a datetime or a default value if None.
+
+    :param dt: Datetime to convert
+    :type dt: datetime
+    :param default: Value to return if dt is None
+    :type default: float
+    :returns: Seconds since 1970-01-01
+    :rtype: float
+    """
+    if dt is None:
+        return default
+    return (dt - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def makeStationIndex(stations):
+    """Create the most efficient index available for the stations received.
+
+    NumPy arrays are only used for lists which are long enough to compensate
+    the overhead of the vectorised operations. Otherwise (or if NumPy is not
+    installed) a :class:`~StationIndex` is returned.
+
+    :param stations: Stations cached for a stream
+    :type stations: list of :class:`~Station`
+    :returns: Index of the stations
+    :rtype: :class:`~StationIndex`
+    """
+    if (numpy is not None) and (len(stations) >= numpyMinStations):
+        return NumpyStationIndex(stations)
+    return StationIndex(stations)
+
+
+# Minimum number of stations to use a NumpyStationIndex
+numpyMinStations = 64
+
+
+class VirtualNetIndex(object):
+    """Index of the members of a virtual network.
+
+    Members are indexed by their station, location and channel codes and
+    sorted by the start and end of their timewindows. Only the members which
+    can match a request are checked when the virtual network is expanded.
+    Results keep the order of the definition of the virtual network.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('members', 'byCode', 'wildcards', 'starts', 'byStart',
+                 'ends', 'byEnd')
+
+    def __init__(self, members):
+        """Constructor of VirtualNetIndex.
+
+        :param members: Streams and timewindows of the virtual network
+        :type members: list of tuples (:class:`~Stream`, :class:`~TW`)
+
+        """
+        self.members = members
+
+        # Positions of the members with every station, location and channel
+        # code. Codes with wildcards can match any request.
+        self.byCode = tuple(dict() for i in range(3))
+        self.wildcards = tuple(list() for i in range(3))
+        for pos, (st, tw) in enumerate(members):
+            for i, code in enumerate(st[1:]):
+                if (code is None) or any(w in code for w in '*?['):
+                    self.wildcards[i].append(pos)
+                else:
+                    self.byCode[i].setdefault(code, list()).append(pos)
+
+        # Positions of the members sorted by start and end of their epochs
+        starts = [epochSeconds(tw.start, -math.inf) for st, tw in members]
+        self.byStart = sorted(range(len(members)), key=starts.__getitem__)
+        self.starts = [starts[pos] for pos in self.byStart]
+        ends = [epochSeconds(tw.end, math.inf) for st, tw in members]
+        self.byEnd = sorted(range(len(members)), key=ends.__getitem__)
+        self.ends = [ends[pos] for pos in self.byEnd]
+
+    def expand(self, stream, tw):
+        """Return the real streams of the virtual network matching a request.
+
+        :param stream: Requested stream. The network code is ignored.
+        :type stream: :class:`~Stream`
+        :param tw: Requested timewindow
+        :type tw: :class:`~TW`
+        :returns: Streams reduced to the request and their timewindows
+            intersected with the requested one
+        :rtype: list of tuples (:class:`~Stream`, :class:`~TW`)
+        """
+        # Candidates provided by each of the indexes
+        candidates = list()
+        for i, code in enumerate(stream[1:]):
+            if (code is not None) and not any(w in code for w in '*?['):
+                candidates.append(self.byCode[i].get(code, []) +
+                                  self.wildcards[i])
+        # An open timewindow matches every member
+        if (tw.start is not None) or (tw.end is not None):
+            if tw.end is not None:
+                hi = bisect.bisect_left(self.starts, epochSeconds(tw.end))
+                candidates.append(self.byStart[:hi])
+            if tw.start is not None:
+                lo = bisect.bisect_right(self.ends, epochSeconds(tw.start))
+                candidates.append(self.byEnd[lo:])
+
+        if len(candidates):
+            positions = sorted(min(candidates, key=len))
+        else:
+            positions = range(len(self.members))
+
+        # The network code of the members is kept
+        request = ('*', stream.s, stream.l, stream.c)
+
+        result = list()
+        for pos in positions:
+            member, memberTW = self.members[pos]
+            codes = list()
+            for m, q in zip(member, request):
+                if (m is None) or fnmatch.fnmatch(q, m):
+                    codes.append(q)
+                elif (q is None) or fnmatch.fnmatch(m, q):
+                    codes.append(m)
+                else:
+                    break
+            else:
+                try:
+                    result.append((Stream(*codes),
+                                   TW(*memberTW.intersection(tw))))
+                except ValueError:
+                    # Empty intersection
+                    pass
+
+        return result
+
+
+class VirtualNetRoutes(object):
+    """Routes of the members of a virtual network resolved in advance.
+
+    The virtual network is expanded once for an open timewindow and the
+    streams of the routing table overlapping each member are saved. The
+    routes selected for every service are saved too the first time they are
+    needed. A request for the whole virtual network then only needs to clip
+    the timewindows of the members and to check the stations in cache.
+
+    The routes selected for the timewindow of a member are also valid for a
+    narrower one as long as all the routes considered still overlap it.
+    Otherwise, they are selected again but only among the saved streams.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('vnIndex', 'routingTable', 'alternative', 'members',
+                 'selected')
+
+    def __init__(self, vnIndex, index, alternative=False):
+        """Constructor of VirtualNetRoutes.
+
+        :param vnIndex: Index of the members of the virtual network
+        :type vnIndex: :class:`~VirtualNetIndex`
+        :param index: Index of the routing table in use
+        :type index: :class:`~BitsetIndex`
+        :param alternative: Specifies whether alternative routes should be
+            included
+        :type alternative: bool
+
+        """
+        self.vnIndex = vnIndex
+        self.routingTable = index.routingTable
+        self.alternative = alternative
+
+        # Streams and timewindows of the members with the positions of the
+        # streams from the routing table overlapping them
+        self.members = list()
+        for st, tw in vnIndex.expand(Stream('*', '*', '*', '*'),
+                                     TW(None, None)):
+            self.members.append((st, tw,
+                                 index.positions(index.overlapping(st))))
+
+        # Timewindows of the routes considered and routes selected. The key
+        # is the position of the member and the service.
+        self.selected = dict()
+
+    def clip(self, tw):
+        """Return the members of the virtual network active in a timewindow.
+
+        :param tw: Requested timewindow
+        :type tw: :class:`~TW`
+        :returns: Positions, streams and timewindows intersected with the
+            requested one, as :meth:`~VirtualNetIndex.expand` would return
+        :rtype: list of tuples (int, :class:`~Stream`, :class:`~TW`)
+        """
+        result = list()
+        for pos, (st, memberTW, candidates) in enumerate(self.members):
+            try:
+                result.append((pos, st, TW(*memberTW.intersection(tw))))
+            except ValueError:
+                # Empty intersection
+                pass
+
+        return result
+
+
+class BitsetIndex(object):
+    """Inverted index of streams with one bitset per code of each component.
+
+    Every code of every N.S.L.C component is mapped to an integer whose bits
+    are the positions of the streams with that code. The streams overlapping
+    a request are found with a few AND operations between these integers.
+    Codes with wildcards in the index are compared with the requested code.
+    The streams with routes of every service are also kept as a bitset, so
+    that the streams selected can be split by service. They are taken from
+    the partitions of a packed routing table, whose routes are then not
+    decoded.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('routingTable', 'streams', 'bits', 'wildcards', 'full',
+                 'services', 'memo')
+
+    # Maximum number of requested codes whose bitsets are kept per component
+    memoSize = 4096
+
+    def __init__(self, routingTable):
+        """Constructor of BitsetIndex.
+
+        :param routingTable: Routing table
+        :type routingTable: dict
+
+        """
+        self.routingTable = routingTable
+        self.streams = list()
+        partitions = getattr(routingTable, 'partitions', None)
+
+        positions = tuple(dict() for i in range(4))
+        byService = dict()
+        for pos, st in enumerate(routingTable):
+            self.streams.append(st)
+            for i, code in enumerate(st):
+                positions[i].setdefault(code, list()).append(pos)
+            if partitions is None:
+                for service in set(rt.service for rt in routingTable[st]):
+                    byService.setdefault(service, list()).append(pos)
+
+        self.full = (1 << len(self.streams)) - 1
+        # Bitsets of the streams with routes of every service
+        if partitions is None:
+            self.services = dict((service, self.toBits(aux))
+                                 for service, aux in byService.items())
+        else:
+            self.services = dict((service, part.bits)
+                                 for service, part in partitions.items())
+
+        # Bitsets of the streams with every code. One dictionary per component.
+        self.bits = tuple(dict((code, self.toBits(aux))
+                               for code, aux in positions[i].items())
+                          for i in range(4))
+        # Codes with wildcards present in the index
+        self.wildcards = tuple([code for code in positions[i]
+                                if (code is None) or
+                                any(w in code for w in '*?[')]
+                               for i in range(4))
+        # Bitsets of the codes already requested
+        self.memo = tuple(dict() for i in range(4))
+
+    @staticmethod
+    def toBits(positions):
+        """Return a bitset with the bits in the positions given set.
+
+        :param positions: Positions of the bits in ascending order
+        :type positions: list
+        :rtype: int
+        """
+        buf = bytearray(positions[-1] // 8 + 1)
+        for pos in positions:
+            buf[pos >> 3] |= 1 << (pos & 7)
+        return int.from_bytes(buf, 'little')
+
+    def match(self, comp, code):
+        """Return the streams overlapping a code in one component.
+
+        :param comp: Component (0: network, 1: station, 2: location,
+            3: channel)
+        :type comp: int
+        :param code: Requested code (wildcards allowed)
+        :type code: str
+        :returns: Bitset of the positions of the streams
+        :rtype: int
+        """
+        memo = self.memo[comp]
+        try:
+            return memo[code]
+        except KeyError:
+            pass
+
+        bits = self.bits[comp]
+        if (code is None) or (code == '*'):
+            result = self.full
+        elif not any(w in code for w in '*?['):
+            result = bits.get(code, 0)
+            for other in self.wildcards[comp]:
+                if codeOverlap(other, code):
+                    result |= bits[other]
+        else:
+            result = 0
+            for other, aux in bits.items():
+                if codeOverlap(other, code):
+                    result |= aux
+
+        if len(memo) >= self.memoSize:
+            memo.clear()
+        memo[code] = result
+        return result
+
+    def routable(self, comp, code):
+        """Check quickly whether any stream could overlap a code.
+
+        Only the codes without wildcards are checked. The others are
+        considered routable.
+
+        :param comp: Component (0: network, 1: station, 2: location,
+            3: channel)
+        :type comp: int
+        :param code: Requested code
+        :type code: str
+        :rtype: bool
+        """
+        if (code is None) or (code in self.bits[comp]) or \
+                any(w in code for w in '*?['):
+            return True
+        return any(codeOverlap(other, code) for other in self.wildcards[comp])
+
+    def overlapping(self, stream):
+        """Return the streams overlapping a stream.
+
+        :param stream: Stream including wildcards
+        :type stream: :class:`~Stream`
+        :returns: Bitset of the positions of the streams
+        :rtype: int
+        """
+        bits = self.full
+        for i, code in enumerate(stream):
+            bits &= self.match(i, code)
+            if not bits:
+                break
+        return bits
+
+    @staticmethod
+    def positions(bits):
+        """Return the positions of the bits set in a bitset.
+
+        :param bits: Bitset
+        :type bits: int
+        :returns: Positions in ascending order
+        :rtype: list of int
+        """
+        # The bits are found by the string functions, which are much faster
+        # than shifting a large integer once per bit
+        digits = format(bits, 'b')[::-1]
+        result = list()
+        pos = digits.find('1')
+        while pos >= 0:
+            result.append(pos)
+            pos = digits.find('1', pos + 1)
+        return result
+
+    def select(self, bits):
+        """Return the streams in the positions of a bitset.
+
+        :param bits: Bitset with the positions of the streams
+        :type bits: int
+        :returns: Streams in the order of the routing table
+        :rtype: list of :class:`~Stream`
+        """
+        streams = self.streams
+        return [streams[pos] for pos in self.positions(bits)]
+
+
+class ServiceRoutes(object):
+    """Routes of one service ordered by priority with their overlaps resolved.
+
+    Routes are ranked in the order in which they are selected: by priority,
+    stream and position in the routing table. Only the positions of the
+    routes are kept, in compact arrays, and the routes themselves are taken
+    from the routing table when they are needed. The routes with a lower
+    rank overlapping a route in stream and timewindow are found the first
+    time that it is selected. A query only has to filter the routes by
+    stream and timewindow, sort their ranks and discard the ones overlapping
+    a route already selected. The ranks and overlaps written in a packed
+    snapshot are used as they are.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('service', 'index', 'routingTable', 'rankStream',
+                 'rankRoute', 'streamFirst', 'streamRanks', 'conflictFirst',
+                 'conflictRanks', 'conflictMemo')
+
+    def __init__(self, index, service):
+        """Constructor of ServiceRoutes.
+
+        :param index: Index of the routing table
+        :type index: :class:`~BitsetIndex`
+        :param service: Service name (f.i., 'dataselect')
+        :type service: str
+
+        """
+        self.service = service
+        self.index = index
+        self.routingTable = index.routingTable
+        # Ranks of the routes overlapping every route already selected
+        self.conflictMemo = dict()
+
+        partition = getattr(self.routingTable, 'partitions',
+                            dict()).get(service)
+        if partition is not None:
+            self.rankStream = partition.rankStream
+            self.rankRoute = partition.rankRoute
+            self.streamFirst = partition.streamFirst
+            self.streamRanks = partition.streamRanks
+            self.conflictFirst = partition.conflictFirst
+            self.conflictRanks = partition.conflictRanks
+            return
+
+        # Overlaps are only found when needed
+        self.conflictFirst = None
+        self.conflictRanks = None
+
+        aux = list()
+        for pos in index.positions(index.services.get(service, 0)):
+            st = index.streams[pos]
+            for i, rt in enumerate(self.routingTable[st]):
+                if rt.service == service:
+                    aux.append((rt.priority, st, i, pos))
+        aux.sort(key=lambda x: x[:3])
+
+        # Position of the stream in the routing table and of the route in
+        # the list of the stream by rank
+        self.rankStream = array('I', [pos for prio, st, i, pos in aux])
+        self.rankRoute = array('I', [i for prio, st, i, pos in aux])
+
+        # Ranks of the routes of every stream in the order of the routing
+        # table. The ones of the stream in position p are found between
+        # streamFirst[p] and streamFirst[p + 1].
+        byPos = dict()
+        for rank, (prio, st, i, pos) in enumerate(aux):
+            byPos.setdefault(pos, list()).append((i, rank))
+        self.streamRanks = array('I')
+        self.streamFirst = array('I', [0])
+        for pos in range(len(index.streams)):
+            self.streamRanks.extend(rank for i, rank in
+                                    sorted(byPos.get(pos, ())))
+            self.streamFirst.append(len(self.streamRanks))
+
+    def __len__(self):
+        """Return the number of routes of the service."""
+        return len(self.rankStream)
+
+    def overlapping(self, stream):
+        """Return the streams with routes of the service overlapping a stream.
+
+        :param stream: Stream including wildcards
+        :type stream: :class:`~Stream`
+        :returns: Positions of the streams in the routing table
+        :rtype: list of int
+        """
+        index = self.index
+        return index.positions(index.overlapping(stream) &
+                               index.services.get(self.service, 0))
+
+    def entries(self, pos):
+        """Return the ranks and routes of the service of a stream.
+
+        :param pos: Position of the stream in the routing table
+        :type pos: int
+        :returns: Ranks and routes in the order of the routing table
+        :rtype: list of tuples (int, :class:`~Route`)
+        """
+        ranks = self.streamRanks[self.streamFirst[pos]:
+                                 self.streamFirst[pos + 1]]
+        if not len(ranks):
+            return ()
+
+        routes = self.routingTable[self.index.streams[pos]]
+        rankRoute = self.rankRoute
+        return [(rank, routes[rankRoute[rank]]) for rank in ranks]
+
+    def item(self, rank):
+        """Return the stream and the route with a rank.
+
+        :param rank: Rank of the route
+        :type rank: int
+        :rtype: tuple (:class:`~Stream`, :class:`~Route`)
+        """
+        st = self.index.streams[self.rankStream[rank]]
+        return st, self.routingTable[st][self.rankRoute[rank]]
+
+    def conflicts(self, rank):
+        """Return the routes with a lower rank overlapping a route.
+
+        :param rank: Rank of the route
+        :type rank: int
+        :returns: Ranks in ascending order
+        :rtype: tuple of int
+        """
+        if self.conflictFirst is not None:
+            return tuple(self.conflictRanks[self.conflictFirst[rank]:
+                                            self.conflictFirst[rank + 1]])
+
+        try:
+            return self.conflictMemo[rank]
+        except KeyError:
+            pass
+
+        st1, rt1 = self.item(rank)
+        result = list()
+        for pos in self.overlapping(st1):
+            for rank2, rt2 in self.entries(pos):
+                if rank2 >= rank:
+                    continue
+                try:
+                    if rt1.tw.overlap(rt2.tw):
+                        result.append(rank2)
+                except ValueError:
+                    # Such routes are never selected
+                    pass
+
+        result = tuple(sorted(result))
+        self.conflictMemo[rank] = result
+        return result
+
 
 class geoRectangle(namedtuple('geoRectangle', ['minlat', 'maxlat', 'minlon', 'maxlon'])):
     """Namedtuple representing a geographical rectangle.
@@ -1465,14 +2345,17 @@ class Stream(namedtuple('Stream', ['n', 's', 'l', 'c'])):
         :rtype: Bool
 
         """
-        for i in range(len(other)):
-            if ((self[i] is not None) and (other[i] is not None) and
-                    not fnmatch.fnmatch(self[i], other[i]) and
-                    not fnmatch.fnmatch(other[i], self[i])):
+        for code1, code2 in zip(self, other):
+            if not codeOverlap(code1, code2):
                 return False
         return True
 
 
+# Limits of the open timewindows when they are compared
+minDT = datetime.datetime(1900, 1, 1)
+maxDT = datetime.datetime(3000, 1, 1)
+
+
 class TW(namedtuple('TW', ['start', 'end'])):
     """Namedtuple with methods to perform calculations on timewindows.
 
@@ -1524,34 +2407,6 @@ class TW(namedtuple('TW', ['start', 'end'])):
         False
 
         """
-        def inOrder(a, b, c):
-            if ((b is None) and (a is not None) and (c is not None)):
-                return False
-
-            # Here I'm sure that b is not None
-            if (a is None and c is None):
-                return True
-
-            # Here I'm sure that b is not None
-            if (b is None and c is None):
-                return True
-
-            # I also know that a or c are not None
-            if a is None:
-                return b < c
-
-            if c is None:
-                return a < b
-
-            # The three are not None
-            # print a, b, c, a < b, b < c, a < b < c
-            return a < b < c
-
-        def inOrder2(a, b, c):
-            # The three are not None
-            # print a, b, c, a < b, b < c, a < b < c
-            return a <= b <= c
-
         # First of all check that the TWs are correctly created
         if ((self.start is not None) and (self.end is not None) and
                 (self.start > self.end)):
@@ -1563,25 +2418,21 @@ class TW(namedtuple('TW', ['start', 'end'])):
             raise ValueError('Start greater than End %s > %s' % (otherTW.start,
                                                                  otherTW.end))
 
-        minDT = datetime.datetime(1900, 1, 1)
-        maxDT = datetime.datetime(3000, 1, 1)
-
         sStart = self.start if self.start is not None else minDT
         oStart = otherTW.start if otherTW.start is not None else minDT
         sEnd = self.end if self.end is not None else maxDT
         oEnd = otherTW.end if otherTW.end is not None else maxDT
 
-        if inOrder2(oStart, sStart, oEnd) or \
-                inOrder2(oStart, sEnd, oEnd):
+        if (oStart <= sStart <= oEnd) or (oStart <= sEnd <= oEnd):
             return True
 
         # Check if this is included in otherTW
-        if inOrder2(oStart, sStart, sEnd):
-            return inOrder2(sStart, sEnd, oEnd)
+        if oStart <= sStart <= sEnd:
+            return sStart <= sEnd <= oEnd
 
         # Check if otherTW is included in this one
-        if inOrder2(sStart, oStart, oEnd):
-            return inOrder2(oStart, oEnd, sEnd)
+        if sStart <= oStart <= oEnd:
+            return oStart <= oEnd <= sEnd
 
         if self == otherTW:
             return True
@@ -1652,6 +2503,153 @@ class TW(namedtuple('TW', ['start', 'end'])):
         return TW(resSt, resEn)
 
 
+class TWSet(object):
+    """Set of disjoint timewindows with integer bounds.
+
+    Bounds are kept sorted in a flat list as microseconds since 1970. Open
+    bounds are -inf and inf. Every timewindow includes its start but not its
+    end, so that empty timewindows (start >= end) are never kept, as in
+    :meth:`~TW.intersection`. All operations are done in one linear pass
+    over the bounds of both sets.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('bounds',)
+
+    # Origin of the bounds
+    epoch = datetime.datetime(1970, 1, 1)
+    unit = datetime.timedelta(microseconds=1)
+
+    def __init__(self, bounds=()):
+        """Constructor of TWSet.
+
+        :param bounds: Sorted starts and ends of the disjoint timewindows
+        :type bounds: list
+
+        """
+        self.bounds = list(bounds)
+
+    @classmethod
+    @functools.lru_cache(maxsize=65536)
+    def fromTW(cls, tw):
+        """Create a set with one timewindow.
+
+        Sets are cached, as the timewindows of the routes are converted many
+        times. They must not be modified.
+
+        :param tw: Timewindow
+        :type tw: :class:`~TW`
+        :returns: Set with the timewindow or empty if it has no duration
+        :rtype: :class:`~TWSet`
+        """
+        start = -math.inf if tw.start is None else cls.toBound(tw.start)
+        end = math.inf if tw.end is None else cls.toBound(tw.end)
+        return cls((start, end) if start < end else ())
+
+    # The same few datetimes are converted many times
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def toBound(dt):
+        """Convert a datetime to a bound."""
+        return (dt - TWSet.epoch) // TWSet.unit
+
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def toDatetime(bound):
+        """Convert a bound to a datetime (None if it is open)."""
+        if (bound == math.inf) or (bound == -math.inf):
+            return None
+        return TWSet.epoch + bound * TWSet.unit
+
+    def combine(self, other, keep):
+        """Combine this set with another one.
+
+        :param other: Set of timewindows
+        :type other: :class:`~TWSet`
+        :param keep: Decide from the membership of an instant in this and in
+            the other set whether it belongs to the result
+        :type keep: function
+        :returns: Set of timewindows
+        :rtype: :class:`~TWSet`
+        """
+        a, b = self.bounds, other.bounds
+        i = j = 0
+        inA = inB = inside = False
+        result = list()
+        while (i < len(a)) or (j < len(b)):
+            if (j == len(b)) or ((i < len(a)) and (a[i] <= b[j])):
+                bound = a[i]
+            else:
+                bound = b[j]
+            if (i < len(a)) and (a[i] == bound):
+                inA = not inA
+                i += 1
+            if (j < len(b)) and (b[j] == bound):
+                inB = not inB
+                j += 1
+            if keep(inA, inB) != inside:
+                inside = not inside
+                result.append(bound)
+
+        return TWSet(result)
+
+    def union(self, other):
+        """Return the timewindows in this or in the other set."""
+        return self.combine(other, lambda inA, inB: inA or inB)
+
+    def intersection(self, other):
+        """Return the timewindows in this and in the other set."""
+        a, b = self.bounds, other.bounds
+        if (len(a) == 2) and (len(b) == 2):
+            # Most common case. Just one timewindow in each set.
+            start, end = max(a[0], b[0]), min(a[1], b[1])
+            return TWSet((start, end) if start < end else ())
+
+        return self.combine(other, lambda inA, inB: inA and inB)
+
+    def difference(self, other):
+        """Return the timewindows in this but not in the other set."""
+        return self.combine(other, lambda inA, inB: inA and not inB)
+
+    def __iter__(self):
+        """Iterate over the timewindows of the set in order."""
+        bounds = self.bounds
+        return iter([TW(self.toDatetime(bounds[pos]),
+                        self.toDatetime(bounds[pos + 1]))
+                     for pos in range(0, len(bounds), 2)])
+
+    def __len__(self):
+        """Return the number of disjoint timewindows in the set."""
+        return len(self.bounds) // 2
+
+    def __eq__(self, other):
+        """Compare the bounds of two sets."""
+        return isinstance(other, TWSet) and (self.bounds == other.bounds)
+
+
+def coveredTW(tw, routeTW, requested=None):
+    """Return the parts of a timewindow covered by the one of a route.
+
+    :param tw: Requested timewindow
+    :type tw: :class:`~TW`
+    :param routeTW: Timewindow of the route
+    :type routeTW: :class:`~TW`
+    :param requested: Requested timewindow already converted
+    :type requested: :class:`~TWSet`
+    :returns: Disjoint timewindows covered
+    :rtype: list of :class:`~TW`
+    """
+    # An open route covers everything, even a timewindow without duration
+    if (routeTW.start is None) and (routeTW.end is None):
+        return [tw]
+
+    if requested is None:
+        requested = TWSet.fromTW(tw)
+    return list(requested.intersection(TWSet.fromTW(routeTW)))
+
+
 class Route(namedtuple('Route', ['service', 'address', 'tw', 'priority'])):
     """Namedtuple defining a :class:`~Route`.
 
@@ -1661,12 +2659,18 @@ class Route(namedtuple('Route', ['service', 'address', 'tw', 'priority'])):
            tw: timewindow
            priority: priority of the route
 
+    Routes are compared only by their priority. Use :attr:`~Route.sortKey`
+    to sort them, which avoids calling the comparison methods.
+
     :platform: Any
 
     """
 
     __slots__ = ()
 
+    # Key to sort the routes by priority
+    sortKey = operator.itemgetter(3)
+
     def toXML(self, nameSpace='ns0', level=2):
         """Export the Route to an XML representation."""
         return '%s<%s:%s address="%s" priority="%d" start="%s" end="%s" />\n' \
@@ -1730,13 +2734,23 @@ class RoutingCache(object):
 
     """
 
-    def __init__(self, routingFile=None, config='routing.cfg'):
+    # Generation numbers given to the routing data every time it is read
+    generations = itertools.count(1)
+
+    # Maximum number of recent requests without routes remembered
+    noRoutesSize = 4096
+
+    def __init__(self, routingFile=None, config='routing.cfg',
+                 buildIfMissing=True):
         """Constructor of RoutingCache.
 
         :param routingFile: XML file with routing information
         :type routingFile: str
         :param config: File where the configuration must be read from
         :type config: str
+        :param buildIfMissing: Build the routing data from the XML files and
+            the Station-WS if no snapshot (.pack or .bin) can be read
+        :type buildIfMissing: bool
 
         """
         # Save the logging object
@@ -1756,9 +2770,38 @@ class RoutingCache(object):
         # Dictionary with list of stations inside each virtual network
         self.vnTable = dict()
 
+        # Indexes of the cached stations. Built on demand.
+        self.stationIndex = dict()
+
+        # Indexes of the members of the virtual networks
+        self.vnIndex = dict()
+
+        # Routes of the virtual networks resolved in advance. Built on demand.
+        self.vnRoutes = dict()
+
+        # Routes of every service ordered by priority
+        self.serviceRoutes = dict()
+
+        # Inverted index of the streams of the routing table. Built on demand.
+        self.bitsetIndex = None
+
+        # Recent requests without routes and the tables they were checked with
+        self.noRoutes = dict()
+        self.noRoutesTables = None
+        self.noRoutesLock = threading.Lock()
+
+        # Generation of the routing data in use
+        self.generation = 0
+
+        # Modification times (ns) of the snapshots read
+        self.snapshotTime = None
+
+        # Memory (bytes) saved sharing the values repeated in the tables
+        self.sharedBytes = 0
+
         if self.routingFile is not None:
             self.logs.info('Wait until the RoutingCache is updated...')
-            self.update()
+            self.update(buildIfMissing)
             self.logs.info('RoutingCache finished!')
 
     def toXML(self, foutput, nameSpace='ns0'):
@@ -1821,6 +2864,11 @@ class RoutingCache(object):
         datacenters (if needed) and be able to merge the returned data avoiding
         duplication.
 
+        Every component of the stream can also be a list of codes (f.i.
+        Stream(['GE', 'RO'], '*', '*', ['BHZ', 'HHZ'])). In that case the
+        codes of each component are matched only once against the routing
+        table and only the combinations which can be routed are resolved.
+
         :param stream: :class:`~Stream` definition including wildcards
         :type stream: :class:`~Stream`
         :param tw: Timewindow
@@ -1837,32 +2885,350 @@ class RoutingCache(object):
         :raises: RoutingException
 
         """
-        # Convert from virtual network to real networks (if needed)
-        strtwList = self.vn2real(stream, tw)
-        self.logs.debug('Converting %s to %s' % (stream, strtwList))
-
-        if not len(strtwList):
-            msg = 'No routes found after resolving virtual network code.'
-            raise RoutingException(msg)
+        nslc = [tuple(comp) if isinstance(comp, (list, tuple, set)) else
+                (comp,) for comp in stream]
+        # Services are resolved in the order they were requested
+        services = list(dict.fromkeys(s.lower() for s in service.split(',')))
+
+        # Timer of the request if it is sampled
+        timer = registry.current()
+        if timer is not None:
+            start = perf_counter()
+
+        # Requests which cannot be routed are answered at once
+        index = self.getBitsetIndex()
+        key = (tuple(nslc), tw, service, geoLoc, alternative)
+        if self.knownWithoutRoutes(index, nslc[0], key):
+            raise RoutingException('No routes found!')
 
         result = RequestMerge()
-        for st, tw in strtwList:
-            try:
-                for srv in set([s.lower() for s in service.split(',')]):
-                    result.extend(self.getRouteDS(srv, st, tw, geoLoc,
-                                                  alternative))
-            except ValueError:
-                pass
+        # What the services have in common is resolved only once
+        memo = dict()
+        expanded = self.expandBits(index, *nslc)
+        if timer is not None:
+            timer.add('expandNSLC', perf_counter() - start)
+
+        for st, bits in expanded:
+            if timer is not None:
+                start = perf_counter()
+
+            if (bits is None) and (st.s == st.l == st.c == '*'):
+                # The whole virtual network is requested. Its routes are
+                # resolved in advance.
+                vnRoutes = self.getVNRoutes(st.n, alternative)
+                members = vnRoutes.clip(tw)
+                if timer is not None:
+                    timer.add('vn2real', perf_counter() - start)
+                    start = perf_counter()
+
+                for pos, auxSt, auxTW in members:
+                    for srv in services:
+                        try:
+                            finalset = self.selectVNRoutes(vnRoutes, pos, srv,
+                                                           auxTW)
+                            result.extend(self.resolveRoutes(srv, auxSt,
+                                                             auxTW, geoLoc,
+                                                             finalset, memo))
+                        except ValueError:
+                            pass
+
+                        except RoutingException:
+                            pass
+
+                if timer is not None:
+                    timer.add('getRouteDS', perf_counter() - start)
+                continue
 
-            except RoutingException:
-                pass
+            if bits is None:
+                # Convert from virtual network to real networks
+                strtwList = self.vn2real(st, tw)
+                self.logs.debug('Converting %s to %s', st, strtwList)
+                if timer is not None:
+                    timer.add('vn2real', perf_counter() - start)
+                    start = perf_counter()
+                # Streams are searched in the routes of every service
+                candidates = dict.fromkeys(services)
+            else:
+                strtwList = [(st, tw)]
+                # Every service gets only the streams with its routes
+                candidates = dict()
+                for srv in services:
+                    common = bits & index.services.get(srv, 0)
+                    if common:
+                        candidates[srv] = index.positions(common)
+
+            for auxSt, auxTW in strtwList:
+                for srv in services:
+                    if srv not in candidates:
+                        continue
+                    try:
+                        result.extend(self.getRouteDS(srv, auxSt, auxTW,
+                                                      geoLoc, alternative,
+                                                      candidates[srv], memo))
+                    except ValueError:
+                        pass
+
+                    except RoutingException:
+                        pass
+
+            if timer is not None:
+                timer.add('getRouteDS', perf_counter() - start)
 
         if (result is None) or (not len(result)):
+            self.rememberNoRoutes(key)
             # Through an exception if there is an error
             raise RoutingException('No routes found!')
 
         return result
 
+    def knownWithoutRoutes(self, index, networks, key):
+        """Check whether a request is known not to have routes.
+
+        No network requested can be in the routing table or a virtual
+        network, or the same request did not have routes recently.
+
+        :param index: Index of the routing table
+        :type index: :class:`~BitsetIndex`
+        :param networks: Network codes requested
+        :type networks: list
+        :param key: Parameters of the request
+        :type key: tuple
+        :rtype: bool
+        """
+        if not any(index.routable(0, n) or (n in self.vnTable)
+                   for n in networks):
+            registry.hit('noroutes')
+            return True
+
+        if (key in self.noRoutes) and self.sameTables(self.noRoutesTables):
+            registry.hit('noroutes')
+            return True
+
+        registry.miss('noroutes')
+        return False
+
+    def rememberNoRoutes(self, key):
+        """Remember that a request did not have routes.
+
+        The oldest requests are forgotten first. All of them are forgotten
+        when the routing information changes.
+
+        :param key: Parameters of the request
+        :type key: tuple
+        """
+        with self.noRoutesLock:
+            if not self.sameTables(self.noRoutesTables):
+                self.noRoutes = dict()
+                self.noRoutesTables = (self.routingTable,
+                                       getattr(self, 'stationTable', None),
+                                       self.vnTable)
+            elif len(self.noRoutes) >= self.noRoutesSize:
+                del self.noRoutes[next(iter(self.noRoutes))]
+            self.noRoutes[key] = True
+
+    def sameTables(self, tables):
+        """Check whether the tables given are the ones used to route.
+
+        :param tables: Routing, station and virtual network tables
+        :type tables: tuple
+        :rtype: bool
+        """
+        return (tables is not None) and \
+            (tables[0] is self.routingTable) and \
+            (tables[1] is getattr(self, 'stationTable', None)) and \
+            (tables[2] is self.vnTable)
+
+    def getRoutes(self, batch, service='dataselect', geoLoc=None,
+                  alternative=False):
+        """Return routes to request data for a batch of streams.
+
+        The streams and timewindows are routed in the order given, as
+        :meth:`~RoutingCache.getRoute` would do one by one, and the results
+        are merged. Items which cannot be routed are ignored.
+
+        :param batch: Pairs of :class:`~Stream` and :class:`~TW`
+        :type batch: list
+        :param service: Comma-separated list of services to get information from
+        :type service: str
+        :param geoLoc: Rectangle to filter stations
+        :type geoLoc: :class:`~geoRectangle`
+        :param alternative: Specifies whether alternative routes should be
+            included
+        :type alternative: bool
+        :returns: URLs and parameters to request the data
+        :rtype: :class:`~RequestMerge`
+
+        """
+        result = RequestMerge()
+        for st, tw in batch:
+            try:
+                result.extend(self.getRoute(st, tw, service, geoLoc,
+                                            alternative))
+            except RoutingException:
+                pass
+
+        return result
+
+    def expandNSLC(self, net, sta, loc, cha):
+        """Expand multi-valued N.S.L.C components into routable streams.
+
+        The streams from the routing table overlapping every requested code
+        are taken from the :class:`~BitsetIndex` of the table (see
+        :meth:`~RoutingCache.expandBits`). Only the combinations which
+        overlap at least one stream from the routing table are returned,
+        together with the list of those streams. Virtual networks are
+        returned without candidates, as they still need to be resolved by
+        :meth:`~RoutingCache.vn2real`.
+
+        :param net: Network code(s)
+        :type net: list
+        :param sta: Station code(s)
+        :type sta: list
+        :param loc: Location code(s)
+        :type loc: list
+        :param cha: Channel code(s)
+        :type cha: list
+        :returns: Streams in the order of the request and the streams from the
+            routing table overlapping them (None for virtual networks)
+        :rtype: list
+        """
+        index = self.getBitsetIndex()
+        return [(st, None if bits is None else index.select(bits))
+                for st, bits in self.expandBits(index, net, sta, loc, cha)]
+
+    def expandBits(self, index, net, sta, loc, cha):
+        """Expand multi-valued N.S.L.C components into routable streams.
+
+        The bitsets of the requested codes are combined with AND component by
+        component, so that the combinations without streams in common are
+        discarded as soon as possible.
+
+        :param index: Index of the routing table
+        :type index: :class:`~BitsetIndex`
+        :param net: Network code(s)
+        :type net: list
+        :param sta: Station code(s)
+        :type sta: list
+        :param loc: Location code(s)
+        :type loc: list
+        :param cha: Channel code(s)
+        :type cha: list
+        :returns: Streams in the order of the request and the bitset of the
+            streams from the routing table overlapping them (None for virtual
+            networks)
+        :rtype: list
+        """
+        comps = (net, sta, loc, cha)
+
+        # Combinations of the positions of the requested codes with the
+        # streams overlapping all of them
+        partial = [((), index.full)]
+        for i, codes in enumerate(comps):
+            masks = [index.match(i, code) for code in codes]
+            aux = list()
+            for idx, bits in partial:
+                for pos, mask in enumerate(masks):
+                    common = bits & mask
+                    if common:
+                        aux.append((idx + (pos,), common))
+            partial = aux
+
+        live = dict(partial)
+
+        # Virtual networks are resolved later, combination by combination
+        for posN, n in enumerate(net):
+            if n not in self.vnTable:
+                continue
+            for idx in itertools.product(range(len(sta)), range(len(loc)),
+                                         range(len(cha))):
+                live[(posN,) + idx] = None
+
+        return [(Stream(*[comps[i][pos] for i, pos in enumerate(idx)]),
+                 live[idx]) for idx in sorted(live)]
+
+    def scanNSLC(self, net, sta, loc, cha):
+        """Expand multi-valued N.S.L.C components scanning the routing table.
+
+        This is the linear strategy replaced by the :class:`~BitsetIndex` in
+        :meth:`~RoutingCache.expandNSLC`, which returns the same result. The
+        codes of every component are compared once against the codes of
+        each stream in the routing table, so that the cost grows with the sum
+        and not with the product of the number of codes requested. Only the
+        combinations which overlap at least one stream from the routing table
+        are returned, together with the list of those streams. Virtual
+        networks are returned without candidates, as they still need to be
+        resolved by :meth:`~RoutingCache.vn2real`.
+
+        :param net: Network code(s)
+        :type net: list
+        :param sta: Station code(s)
+        :type sta: list
+        :param loc: Location code(s)
+        :type loc: list
+        :param cha: Channel code(s)
+        :type cha: list
+        :returns: Streams in the order of the request and the streams from the
+            routing table overlapping them (None for virtual networks)
+        :rtype: list
+        """
+        comps = (net, sta, loc, cha)
+        # Positions of the requested codes matching each code present in
+        # the routing table. One dictionary per component.
+        memo = tuple(dict() for c in comps)
+
+        live = dict()
+        for stRT in self.routingTable.keys():
+            matched = list()
+            for i, codes in enumerate(comps):
+                try:
+                    aux = memo[i][stRT[i]]
+                except KeyError:
+                    aux = [pos for pos, code in enumerate(codes)
+                           if codeOverlap(stRT[i], code)]
+                    memo[i][stRT[i]] = aux
+
+                if not len(aux):
+                    break
+                matched.append(aux)
+            else:
+                for idx in itertools.product(*matched):
+                    live.setdefault(idx, list()).append(stRT)
+
+        # Virtual networks are resolved later, combination by combination
+        for posN, n in enumerate(net):
+            if n not in self.vnTable:
+                continue
+            for idx in itertools.product(range(len(sta)), range(len(loc)),
+                                         range(len(cha))):
+                live[(posN,) + idx] = None
+
+        return [(Stream(*[comps[i][pos] for i, pos in enumerate(idx)]),
+                 live[idx]) for idx in sorted(live)]
+
+    def getStationIndex(self, address, stream):
+        """Return the index of the stations cached for a route.
+
+        Indexes are built the first time they are needed.
+
+        :param address: Address of the route
+        :type address: str
+        :param stream: Stream from the routing table
+        :type stream: :class:`~Stream`
+        :returns: Stations cached for the stream at the host of the route
+        :rtype: :class:`~StationIndex`
+        :raises: KeyError
+        """
+        netloc = hostOf(address)
+        try:
+            index = self.stationIndex[(netloc, stream)]
+            registry.hit('stationindex')
+            return index
+        except KeyError:
+            registry.miss('stationindex')
+            index = makeStationIndex(self.stationTable[netloc][stream])
+            self.stationIndex[(netloc, stream)] = index
+            return index
+
     def vn2real(self, stream, tw):
         """Transform from a virtual network code to a list of streams.
 
@@ -1873,36 +3239,141 @@ class RoutingCache(object):
         :returns: Streams and time windows of real network-station codes.
         :rtype: list
         """
-        if stream.n not in self.vnTable.keys():
+        if stream.n not in self.vnTable:
             return [(stream, tw)]
 
-        # If virtual networks are defined with open start or end dates
-        # or if there is no intersection, that is resolved in the try
+        return self.getVNIndex(stream.n).expand(stream, tw)
 
-        # Remove the virtual network code to avoid problems in strictMatch
-        auxStr = ('*', stream.s, stream.l, stream.c)
+    def getVNIndex(self, code):
+        """Return the index of the members of a virtual network.
 
-        result = list()
-        for strtw in self.vnTable[stream.n]:
-            try:
-                s = strtw[0].strictMatch(auxStr)
-            except Exception:
-                # Overlap or match cannot be calculated between streams
-                continue
+        Indexes are built when the routing information is loaded or the first
+        time they are needed.
 
-            try:
-                auxSt, auxEn = strtw[1].intersection(tw)
-                t = TW(auxSt if auxSt is not None else None,
-                       auxEn if auxEn is not None else None)
-            except Exception:
-                continue
+        :param code: Code of the virtual network
+        :type code: str
+        :returns: Index of the members of the virtual network
+        :rtype: :class:`~VirtualNetIndex`
+        :raises: KeyError
+        """
+        members = self.vnTable[code]
+        index = self.vnIndex.get(code)
+        if (index is not None) and (index.members is members):
+            registry.hit('vnindex')
+            return index
 
-            result.append((s, t))
+        registry.miss('vnindex')
+        index = VirtualNetIndex(members)
+        self.vnIndex[code] = index
+        return index
 
-        return result
+    def getBitsetIndex(self):
+        """Return the inverted index of the streams of the routing table.
+
+        It is prepared when the routing information is loaded or the first
+        time it is needed.
+
+        :returns: Index of the streams by the codes of their components
+        :rtype: :class:`~BitsetIndex`
+        """
+        index = self.bitsetIndex
+        if (index is not None) and (index.routingTable is self.routingTable):
+            registry.hit('bitsetindex')
+            return index
+
+        registry.miss('bitsetindex')
+        index = BitsetIndex(self.routingTable)
+        self.bitsetIndex = index
+        return index
+
+    def getServiceRoutes(self, service):
+        """Return the routes of a service ordered by priority.
+
+        They are prepared when the routing information is loaded or the first
+        time they are needed.
+
+        :param service: Service name (f.i., 'dataselect')
+        :type service: str
+        :returns: Routes of the service with their overlaps resolved
+        :rtype: :class:`~ServiceRoutes`
+        """
+        table = self.serviceRoutes.get(service)
+        if (table is not None) and (table.routingTable is self.routingTable):
+            registry.hit('serviceroutes')
+            return table
+
+        registry.miss('serviceroutes')
+        table = ServiceRoutes(self.getBitsetIndex(), service)
+        # Unknown services are not kept
+        if len(table):
+            self.serviceRoutes[service] = table
+        return table
+
+    def getVNRoutes(self, code, alternative=False):
+        """Return the routes of the members of a virtual network.
+
+        They are resolved the first time they are needed and kept until the
+        routing information is replaced.
+
+        :param code: Code of the virtual network
+        :type code: str
+        :param alternative: Specifies whether alternative routes should be
+            included
+        :type alternative: bool
+        :returns: Routes of the members of the virtual network
+        :rtype: :class:`~VirtualNetRoutes`
+        :raises: KeyError
+        """
+        vnIndex = self.getVNIndex(code)
+        vnRoutes = self.vnRoutes.get((code, alternative))
+        if (vnRoutes is not None) and (vnRoutes.vnIndex is vnIndex) and \
+                (vnRoutes.routingTable is self.routingTable):
+            registry.hit('vnroutes')
+            return vnRoutes
+
+        registry.miss('vnroutes')
+        vnRoutes = VirtualNetRoutes(vnIndex, self.getBitsetIndex(),
+                                    alternative)
+        self.vnRoutes[(code, alternative)] = vnRoutes
+        return vnRoutes
+
+    def selectVNRoutes(self, vnRoutes, pos, service, tw):
+        """Return the routes selected for a member of a virtual network.
+
+        :param vnRoutes: Routes of the members of the virtual network
+        :type vnRoutes: :class:`~VirtualNetRoutes`
+        :param pos: Position of the member
+        :type pos: int
+        :param service: Specifies the service is being looked for
+        :type service: str
+        :param tw: Timewindow of the member clipped to the requested one
+        :type tw: :class:`~TW`
+        :returns: Streams from the routing table and their routes
+        :rtype: list of tuples (:class:`~Stream`, :class:`~Route`)
+        :raises: ValueError
+        """
+        st, memberTW, candidates = vnRoutes.members[pos]
+        try:
+            routeTWs, finalset = vnRoutes.selected[(pos, service)]
+        except KeyError:
+            table = self.getServiceRoutes(service)
+            routeTWs = set(rou.tw for stPos in candidates
+                           for rank, rou in table.entries(stPos)
+                           if rou.tw.overlap(memberTW))
+            finalset = self.selectRoutes(service, st, memberTW,
+                                         vnRoutes.alternative, candidates)
+            vnRoutes.selected[(pos, service)] = (routeTWs, finalset)
+
+        # The same routes are selected if all of them overlap the narrower
+        # timewindow. The ones not overlapping the member cannot overlap it.
+        if all(routeTW.overlap(tw) for routeTW in routeTWs):
+            return finalset
+
+        return self.selectRoutes(service, st, tw, vnRoutes.alternative,
+                                 candidates)
 
     def getRouteDS(self, service, stream, tw, geoLocation=None,
-                   alternative=False):
+                   alternative=False, candidates=None, memo=None):
         """Return routes to request data for the parameters specified.
 
         Based on a :class:`~Stream` and a timewindow (:class:`~TW`) returns
@@ -1921,166 +3392,221 @@ class RoutingCache(object):
         :param alternative: Specifies whether alternative routes should be
             included
         :type alternative: bool
+        :param candidates: Positions of the streams from the routing table
+            (see :class:`~BitsetIndex`) already known to overlap the requested
+            one. They are looked up in the index of the table if None.
+        :type candidates: list of int
+        :param memo: Shared by the services of one request (see
+            :meth:`~RoutingCache.resolveRoutes`)
+        :type memo: dict
         :returns: URLs and parameters to request the data
         :rtype: :class:`~RequestMerge`
         :raises: RoutingException, ValueError
 
         """
-        # Create list to store results
-        subs = list()
-        subs2 = list()
+        finalset = self.selectRoutes(service, stream, tw, alternative,
+                                     candidates)
+        return self.resolveRoutes(service, stream, tw, geoLocation, finalset,
+                                  memo)
 
-        # Filter by stream
-        for stRT in self.routingTable.keys():
-            if stRT.overlap(stream):
-                subs.append(stRT)
-
-        # print('subs', subs)
-
-        # Filter by service and timewindow
-        for stRT in subs:
-            priorities = list()
-            for rou in self.routingTable[stRT]:
-                # If it is the proper service and the timewindow coincides
-                # with the one in the parameter, add the priority to use it
-                # in the last check
-                # FIXME The method overlap below does NOT work if I swap
-                # rou.tw and tw. For instance, check with:
-                # TW(start=None, end=None) TW(start=datetime(1993, 1, 1, 0, 0),
-                # end=None)
-                if (service == rou.service) and (rou.tw.overlap(tw)):
-                    priorities.append(rou.priority)
-                else:
-                    priorities.append(None)
+    def selectRoutes(self, service, stream, tw, alternative=False,
+                     candidates=None):
+        """Select the routes of the streams overlapping the requested one.
+
+        Routes are selected by service, timewindow and priority. Routes
+        overlapping others with a higher priority are discarded. The order
+        of the routes and their overlaps are taken from
+        :meth:`~RoutingCache.getServiceRoutes`.
+
+        :param service: Specifies the service is being looked for
+        :type service: string
+        :param stream: :class:`~Stream` definition including wildcards
+        :type stream: :class:`~Stream`
+        :param tw: Timewindow
+        :type tw: :class:`~TW`
+        :param alternative: Specifies whether alternative routes should be
+            included
+        :type alternative: bool
+        :param candidates: Positions of the streams from the routing table
+            (see :class:`~BitsetIndex`) already known to overlap the requested
+            one. They are looked up in the index of the table if None.
+        :type candidates: list of int
+        :returns: Streams from the routing table and their routes
+        :rtype: list of tuples (:class:`~Stream`, :class:`~Route`)
+        :raises: ValueError
+
+        """
+        # Routes of the service ranked by priority
+        table = self.getServiceRoutes(service)
 
-            if not len([x for x in priorities if x is not None]):
+        # Filter by stream
+        if candidates is None:
+            candidates = table.overlapping(stream)
+
+        # Filter by timewindow and keep the ranks of the routes selected
+        selected = list()
+        for pos in candidates:
+            # FIXME The method overlap below does NOT work if I swap
+            # rou.tw and tw. For instance, check with:
+            # TW(start=None, end=None) TW(start=datetime(1993, 1, 1, 0, 0),
+            # end=None)
+            entries = [(rank, rou) for rank, rou in table.entries(pos)
+                       if rou.tw.overlap(tw)]
+            if not len(entries):
                 continue
 
             if not alternative:
                 # Retrieve only the lowest value of priority
-                prio2retrieve = [min(x for x in priorities if x is not None)]
+                prio2retrieve = min(rou.priority for rank, rou in entries)
+                selected.extend(rank for rank, rou in entries
+                                if rou.priority == prio2retrieve)
             else:
                 # Retrieve all alternatives. Don't care about priorities
-                prio2retrieve = [x for x in priorities if x is not None]
-
-            # print(prio2retrieve)
+                selected.extend(rank for rank, rou in entries)
 
-            for pos, p in enumerate(priorities):
-                if p not in prio2retrieve:
+        # Higher priorities first. Routes overlapping one already in the
+        # final set are discarded.
+        selected.sort()
+        finalset = list()
+        accepted = set()
+        for rank in selected:
+            s1, r1 = table.item(rank)
+            for rank2 in table.conflicts(rank):
+                if rank2 not in accepted:
                     continue
 
-                # Add tuples with (Stream, Route)
-                subs2.append((stRT, self.routingTable[stRT][pos]))
-
-                # If I don't want the alternative take only the first one
-                # if not alternative:
-                #     break
-
-        # print('subs2', subs2)
+                s2, r2 = table.item(rank2)
+                if not alternative:
+                    self.logs.error('%s OVERLAPS\n %s\n' %
+                                    ((s1, r1), (s2, r2)))
+                    break
 
-        finalset = list()
+                # Check that the priority is different! Because all
+                # the other attributes are the same or overlap
+                if r1.priority == r2.priority:
+                    self.logs.error('Overlap between %s and %s\n' %
+                                    ((s1, r1), (s2, r2)))
+                    break
+            else:
+                accepted.add(rank)
+                finalset.append((s1, r1))
 
-        # Reorder to have higher priorities first
-        priorities = [rt.priority for (st, rt) in subs2]
-        subs3 = [x for (y, x) in sorted(zip(priorities, subs2))]
+        return finalset
 
-        # print('subs3', subs3)
+    def resolveRoutes(self, service, stream, tw, geoLocation, finalset,
+                      memo=None):
+        """Return the requests needed for the routes selected.
 
-        for (s1, r1) in subs3:
-            for (s2, r2) in finalset:
-                if s1.overlap(s2) and r1.tw.overlap(r2.tw):
-                    if not alternative:
-                        self.logs.error('%s OVERLAPS\n %s\n' %
-                                        ((s1, r1), (s2, r2)))
-                        break
+        The requested timewindow is split among the routes and only the
+        stations in cache are considered. The streams to request and the
+        stations selected do not depend on the service. They are kept in
+        *memo*, so that they are resolved only once for all the services of
+        a request.
 
-                    # Check that the priority is different! Because all
-                    # the other attributes are the same or overlap
-                    if r1.priority == r2.priority:
-                        self.logs.error('Overlap between %s and %s\n' %
-                                        ((s1, r1), (s2, r2)))
-                        break
-            else:
-                # finalset.add(r1.strictMatch(stream))
-                finalset.append((s1, r1))
-                continue
+        :param service: Specifies the service is being looked for
+        :type service: string
+        :param stream: :class:`~Stream` definition including wildcards
+        :type stream: :class:`~Stream`
+        :param tw: Timewindow
+        :type tw: :class:`~TW`
+        :param geoLocation: Rectangle restricting the location of the station
+        :type geoLocation: :class:`~geoRectangle`
+        :param finalset: Streams and routes from :meth:`~selectRoutes`. It is
+            not modified.
+        :type finalset: list
+        :param memo: Streams and stations already resolved. It must be shared
+            only by calls with the same geoLocation.
+        :type memo: dict
+        :returns: URLs and parameters to request the data
+        :rtype: :class:`~RequestMerge`
+        :raises: RoutingException, ValueError
 
+        """
         result = RequestMerge()
+        if memo is None:
+            memo = dict()
 
         # In finalset I have all the streams (including expanded and
         # the ones with wildcards), that I need to request.
         # Now I need the URLs
-        self.logs.debug('Selected streams and routes: %s\n' % finalset)
+        self.logs.debug('Selected streams and routes: %s\n', finalset)
+
+        # Requested timewindow
+        requested = TWSet.fromTW(tw)
+
+        for (st, ro) in reversed(finalset):
+
+            # The route must overlap the requested timewindow
+            if tw not in ro.tw:
+                continue
+
+            # Stations cached for the stream at the host of the route
+            stIndex = self.getStationIndex(ro.address, st)
 
-        while finalset:
-            (st, ro) = finalset.pop()
+            # Requested stream reduced to the one from the routing table
+            try:
+                matched = memo[(stream, st)]
+            except KeyError:
+                try:
+                    matched = stream.strictMatch(st)
+                except Exception:
+                    matched = None
+                memo[(stream, st)] = matched
 
-            # Requested timewindow
-            setTW = set()
-            setTW.add(tw)
+            # Parts of the requested timewindow covered by the route
+            try:
+                covered = memo[(tw, ro.tw)]
+            except KeyError:
+                covered = coveredTW(tw, ro.tw, requested)
+                memo[(tw, ro.tw)] = covered
 
             # We don't need to loop as routes are already ordered by
-            # priority. Take the first one!
-            while setTW:
-                toProc = setTW.pop()
-                self.logs.debug('Processing %s\n' % str(toProc))
-
-                # Check if the timewindow is encompassed in the returned dates
-                self.logs.debug('%s in %s = %s\n' % (str(toProc),
-                                                     str(ro.tw),
-                                                     (toProc in ro.tw)))
-                if (toProc in ro.tw):
-
-                    # If the timewindow is not complete then add the missing
-                    # ranges to the tw set.
-                    for auxTW in toProc.difference(ro.tw):
-                        # Skip the case that we fall always in the same time
-                        # span
-                        if auxTW == toProc:
-                            break
-                        self.logs.debug('Adding %s\n' % str(auxTW))
-                        setTW.add(auxTW)
-
-                    # Check here that the final result is compatible with the
-                    # stations in cache
-                    ptST = self.stationTable[urlparse(ro.address).netloc]
-                    for cacheSt in ptST[st]:
-                        # Trying to catch cases like (APE, AP*)
-                        # print st
-                        # print cacheSt
-
-                        if (fnmatch.fnmatch(cacheSt.name, stream.s) and
-                                ((geoLocation is None) or
-                                 (geoLocation.contains(cacheSt.latitude,
-                                                       cacheSt.longitude)))):
-                            try:
-                                auxSt, auxEn = toProc.intersection(ro.tw)
-                                twAux = TW(auxSt if auxSt is not None else '',
-                                           auxEn if auxEn is not None else '')
-                                st2add = stream.strictMatch(st)
-                                # In case that routes have to be filter by
-                                # location, station names have to be expanded
-                                if geoLocation is not None:
-                                    st2add = st2add.strictMatch(
-                                        Stream('*', cacheSt.name, '*', '*'))
-
-                                # print('Add %s' % str(st2add))
-
-                                result.append(service, ro.address, ro.priority
-                                              if ro.priority is not None
-                                              else '', st2add, twAux)
-                            except Exception:
-                                pass
-
-                            # If we don't filter by location, one route covers
-                            # everything but if we do filter by location, we
-                            # need to keep adding stations
-                            if geoLocation is None:
-                                break
-                    else:
-                        msg = "Skipping %s as station %s not in its cache"
-                        logging.debug(msg % (str(stream.strictMatch(st)),
-                                             stream.s))
+            # priority. Only the part of the requested timewindow covered by
+            # the route is processed.
+            for twActive in covered:
+                # Check here that the final result is compatible with the
+                # stations in cache. Only stations matching the requested
+                # code and location and operating during the timewindow
+                # are considered.
+                key = (stIndex, stream.s, twActive)
+                try:
+                    stations = memo[key]
+                except KeyError:
+                    stations = stIndex.select(stream.s, geoLocation, twActive)
+                    memo[key] = stations
+
+                for cacheSt in stations:
+                    # Trying to catch cases like (APE, AP*)
+                    try:
+                        auxSt, auxEn = twActive
+                        twAux = TW(auxSt if auxSt is not None else '',
+                                   auxEn if auxEn is not None else '')
+                        st2add = matched
+                        if st2add is None:
+                            raise Exception('No overlap or match between '
+                                            'streams.')
+                        # In case that routes have to be filter by
+                        # location, station names have to be expanded
+                        if geoLocation is not None:
+                            st2add = st2add.strictMatch(
+                                Stream('*', cacheSt.name, '*', '*'))
+
+                        # print('Add %s' % str(st2add))
+
+                        result.append(service, ro.address, ro.priority
+                                      if ro.priority is not None
+                                      else '', st2add, twAux)
+                    except Exception:
+                        pass
+
+                    # If we don't filter by location, one route covers
+                    # everything but if we do filter by location, we
+                    # need to keep adding stations
+                    if geoLocation is None:
+                        break
+                else:
+                    msg = "Skipping %s as station %s not in its cache"
+                    logging.debug(msg, matched, stream.s)
 
         # Check the coherency of the routes to set the return code
         if len(result) == 0:
@@ -2269,12 +3795,18 @@ class RoutingCache(object):
 
         return '\n'.join(result)
 
-    def update(self):
+    def update(self, buildIfMissing=True):
         """Read the routing data from the file saved by the off-line process.
 
         All the routing information is read into a dictionary. Only the
         necessary attributes are stored. This relies on the idea that some
         other agent should update the routing data at a regular period of time.
+        The tables in use are replaced only after the new ones are complete.
+
+        :param buildIfMissing: Build the routing data from the XML files and
+            the Station-WS if no snapshot (.pack or .bin) can be read
+        :type buildIfMissing: bool
+        :raises: RoutingException
 
         """
         self.logs.debug('Entering update()\n')
@@ -2303,21 +3835,21 @@ class RoutingCache(object):
         self.logs.debug(synchroList)
         self.logs.debug('allowOverlaps: %s' % allowOverlaps)
 
-        # Just to shorten notation
-        ptRT = self.routingTable
-        ptVN = self.vnTable
-
-        # Clear all previous information
-        ptRT.clear()
-        ptVN.clear()
-        binFile = self.routingFile + '.bin'
+        # The new tables are read completely before replacing the current ones
+        snapshotTime = getSnapshotTime(self.routingFile)
+        interner = Interner()
         try:
-            with open(binFile, 'rb') as rMerged:
-                self.routingTable, self.stationTable, self.vnTable, self.eidaDCs = \
-                    pickle.load(rMerged)
+            ptRT, ptST, ptVN, eidaDCs = readSnapshot(self.routingFile,
+                                                     snapshotTime, interner)
         except Exception:
-            ptRT = addRoutes(self.routingFile, allowOverlaps=allowOverlaps)
-            ptVN = addVirtualNets(self.routingFile)
+            if not buildIfMissing:
+                raise RoutingException('Snapshot of %s could not be read' %
+                                       self.routingFile)
+
+            interner = Interner()
+            ptRT = addRoutes(self.routingFile, allowOverlaps=allowOverlaps,
+                             interner=interner)
+            ptVN = addVirtualNets(self.routingFile, interner=interner)
             # Loop for the data centres which should be integrated
             for line in synchroList.splitlines():
                 if not len(line):
@@ -2337,18 +3869,194 @@ class RoutingCache(object):
                                                   'routing-%s.xml' %
                                                   dcid.strip()),
                                      routingTable=ptRT,
-                                     allowOverlaps=allowOverlaps)
+                                     allowOverlaps=allowOverlaps,
+                                     interner=interner)
                     ptVN = addVirtualNets(os.path.join(os.getcwd(), 'data',
                                                        'routing-%s.xml' %
                                                        dcid.strip()),
-                                          vnTable=ptVN)
+                                          vnTable=ptVN, interner=interner)
 
-            # Set here self.stationTable
-            self.stationTable = dict()
-            cacheStations(ptRT, self.stationTable)
+            try:
+                with open(replacelast(self.routingFile, '.xml', '.json')) \
+                        as fin:
+                    eidaDCs = [json.load(fin)]
+            except Exception:
+                eidaDCs = list()
 
-            with open(binFile, 'wb') \
+            ptST = dict()
+            cacheStations(ptRT, ptST)
+            ptRT, ptST, ptVN = internTables(ptRT, ptST, ptVN, interner)
+
+            binFile = self.routingFile + '.bin'
+            with open(binFile + '.tmp', 'wb') \
                     as finalRoutes:
                 self.logs.debug('Writing %s\n' % binFile)
-                pickle.dump((ptRT, self.stationTable, ptVN, self.eidaDCs), finalRoutes)
-                self.routingTable = ptRT
+                pickle.dump((ptRT, ptST, ptVN, eidaDCs), finalRoutes)
+            os.replace(binFile + '.tmp', binFile)
+            # Written after the pickle, so that it is not considered outdated
+            from .packed import writePacked
+            writePacked(self.routingFile + '.pack', ptRT, ptST, ptVN,
+                        eidaDCs)
+            snapshotTime = getSnapshotTime(self.routingFile)
+
+        self.logs.info('%d repeated values (%d bytes) shared in the routing '
+                       'information' % (interner.shared, interner.saved))
+        self.sharedBytes = interner.saved
+
+        bitsetIndex = BitsetIndex(ptRT)
+
+        # Routes of every service ordered by priority
+        serviceRoutes = dict((srv, ServiceRoutes(bitsetIndex, srv))
+                             for srv in bitsetIndex.services)
+
+        # Replace all previous information
+        self.routingTable = ptRT
+        self.stationTable = ptST
+        self.vnTable = ptVN
+        self.eidaDCs = eidaDCs
+        self.stationIndex = dict()
+        self.vnIndex = dict((code, VirtualNetIndex(members))
+                            for code, members in ptVN.items())
+        self.vnRoutes = dict()
+        self.serviceRoutes = serviceRoutes
+        self.bitsetIndex = bitsetIndex
+        self.noRoutes = dict()
+        self.noRoutesTables = None
+        self.snapshotTime = snapshotTime
+        self.generation = next(RoutingCache.generations)
+
+
+def getSnapshotTime(routingFile):
+    """Return the modification times of the snapshots of the routing file.
+
+    :param routingFile: XML file with routing information
+    :type routingFile: str
+    :returns: Modification time (ns) of the pickled (.bin) and the packed
+        (.pack) snapshots. None for the missing ones.
+    :rtype: tuple
+    """
+    result = list()
+    for ext in ('.bin', '.pack'):
+        try:
+            result.append(os.stat(routingFile + ext).st_mtime_ns)
+        except OSError:
+            result.append(None)
+    return tuple(result)
+
+
+def readSnapshot(routingFile, snapshotTime=None, interner=None):
+    """Read the routing information from the snapshots of the routing file.
+
+    The packed snapshot (.pack) is mapped in memory and shared with all other
+    processes reading it. Its strings are already stored only once. It is
+    only used if it is not older than the pickled one (.bin), which is read
+    otherwise and whose repeated values are then shared.
+
+    :param routingFile: XML file with routing information
+    :type routingFile: str
+    :param snapshotTime: Modification times of the snapshots as returned by
+        :func:`~getSnapshotTime`. By default, the current ones.
+    :type snapshotTime: tuple
+    :param interner: Values shared while reading the pickled snapshot
+    :type interner: :class:`~Interner`
+    :returns: Routing, station and virtual network tables and information
+        about the data centres
+    :rtype: tuple
+    :raises: Exception
+    """
+    binTime, packTime = getSnapshotTime(routingFile) \
+        if snapshotTime is None else snapshotTime
+
+    if (packTime is not None) and ((binTime is None) or (packTime >= binTime)):
+        try:
+            from .packed import PackedSnapshot
+            snapshot = PackedSnapshot(routingFile + '.pack')
+            return (snapshot.routingTable, snapshot.stationTable,
+                    snapshot.vnTable(), snapshot.eidaDCs())
+        except Exception as e:
+            logging.warning('Packed snapshot could not be read: %s' % e)
+
+    with open(routingFile + '.bin', 'rb') as rMerged:
+        ptRT, ptST, ptVN, eidaDCs = pickle.load(rMerged)
+
+    # Snapshots written by older versions repeat the same values many times
+    ptRT, ptST, ptVN = internTables(ptRT, ptST, ptVN, interner)
+    return ptRT, ptST, ptVN, eidaDCs
+
+
+class RoutingCacheReloader(threading.Thread):
+    """Reload the routing information every time its snapshot changes.
+
+    The modification times of the snapshots (``.bin`` and ``.pack`` files)
+    written by the off-line process are checked at regular intervals. When
+    they change, a complete new :class:`~RoutingCache` is built in this thread
+    and passed to the callback, which is expected to swap it in with a single
+    reference assignment. Requests in progress keep the cache they started
+    with.
+
+    :platform: Any
+
+    """
+
+    def __init__(self, routingFile, config, callback, interval=60,
+                 mtime=None):
+        """Constructor of RoutingCacheReloader.
+
+        :param routingFile: XML file with routing information
+        :type routingFile: str
+        :param config: File where the configuration must be read from
+        :type config: str
+        :param callback: Function receiving every new RoutingCache
+        :type callback: callable
+        :param interval: Seconds between two checks of the snapshot
+        :type interval: float
+        :param mtime: Modification times (ns) of the snapshots in use. By
+            default, the current ones.
+        :type mtime: tuple
+
+        """
+        super().__init__(name='RoutingCacheReloader', daemon=True)
+        self.logs = logging.getLogger('RoutingCacheReloader')
+        self.routingFile = routingFile
+        self.configFile = config
+        self.callback = callback
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.mtime = self.snapshotTime() if mtime is None else mtime
+
+    def snapshotTime(self):
+        """Return the modification times of the snapshots."""
+        return getSnapshotTime(self.routingFile)
+
+    def check(self):
+        """Load a new RoutingCache if the snapshot was modified.
+
+        :returns: Value specifying whether a new RoutingCache was loaded
+        :rtype: Bool
+        """
+        mtime = self.snapshotTime()
+        if (mtime == (None, None)) or (mtime == self.mtime):
+            return False
+
+        try:
+            rc = RoutingCache(self.routingFile, self.configFile,
+                              buildIfMissing=False)
+        except Exception as e:
+            # Probably still being written. Try again in the next check.
+            self.logs.warning('Snapshot could not be reloaded: %s' % e)
+            return False
+
+        self.mtime = mtime
+        self.callback(rc)
+        self.logs.info('Routing information reloaded (generation %d)' %
+                       rc.generation)
+        return True
+
+    def run(self):
+        """Check the snapshot until the thread is stopped."""
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        """Stop checking the snapshot."""
+        self.stopped.set()
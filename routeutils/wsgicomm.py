@@ -24,6 +24,9 @@ response_headers_template = [('Access-Control-Allow-Origin', '*'),
                     ('Access-Control-Allow-Headers', 'Authorization'),
                     ('Access-Control-Expose-Headers', 'WWW-Authenticate')]
 
+# Status codes of responses which must not have a body (RFC 7230, 3.3.2)
+nobody_status = ('204', '304')
+
 
 class Logs(object):
     """Given a log level and a stream, redirect the output to the proper place.
@@ -205,6 +208,19 @@ class WIServiceError(WIError):
 #
 ##################################################################
 
+def encode_body(body):
+    """Return the body of a response in UTF-8, encoding it only if needed.
+
+    :param body: Body of the response
+    :type body: str or bytes
+    :returns: Encoded body
+    :rtype: bytes
+    """
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    return body
+
+
 def redirect_page(url, start_response):
     """Tell the web client through the WSGI module to redirect to a URL.
 
@@ -223,11 +239,12 @@ def send_html_response(status, body, start_response):
     :platform: Linux
 
     """
+    body = encode_body(body)
     response_headers = response_headers_template.copy()
     response_headers.extend([('Content-Type', 'text/html; charset=UTF-8'),
                         ('Content-Length', str(len(body)))])
     start_response(status, response_headers)
-    return [body.encode('utf-8')]
+    return [body]
 
 
 def send_xml_response(status, body, start_response):
@@ -236,11 +253,12 @@ def send_xml_response(status, body, start_response):
     :platform: Linux
 
     """
+    body = encode_body(body)
     response_headers = response_headers_template.copy()
     response_headers.extend([('Content-Type', 'text/xml; charset=UTF-8'),
                         ('Content-Length', str(len(body)))])
     start_response(status, response_headers)
-    return [body.encode('utf-8')]
+    return [body]
 
 
 def send_plain_response(status, body, start_response):
@@ -249,11 +267,12 @@ def send_plain_response(status, body, start_response):
     :platform: Linux
 
     """
+    body = encode_body(body)
     response_headers = response_headers_template.copy()
     response_headers.extend([('Content-Type', 'text/plain'),
                         ('Content-Length', str(len(body)))])
     start_response(status, response_headers)
-    return [body.encode('utf-8')]
+    return [body]
 
 
 def send_json_response(status, body, start_response):
@@ -263,13 +282,14 @@ def send_json_response(status, body, start_response):
 
     """
     response_headers = response_headers_template.copy()
-    if not isinstance(body, str):
+    if not isinstance(body, (str, bytes)):
         body = json.dumps(body)
+    body = encode_body(body)
 
     response_headers.extend([('Content-Type', 'application/json'),
                         ('Content-Length', str(len(body)))])
     start_response(status, response_headers)
-    return [body.encode('utf-8')]
+    return [body]
 
 
 def send_nobody_response(status, start_response):
@@ -279,7 +299,8 @@ def send_nobody_response(status, start_response):
 
     """
     response_headers = response_headers_template.copy()
-    response_headers.append(('Content-Length', 0))
+    if not status.startswith(nobody_status):
+        response_headers.append(('Content-Length', '0'))
     start_response(status, response_headers)
     return []
 
@@ -290,11 +311,16 @@ def send_error_response(status, body, start_response):
     :platform: Linux
 
     """
+    if status.startswith(nobody_status):
+        return send_nobody_response(status, start_response)
+
+    body = encode_body(body)
     response_headers = response_headers_template.copy()
-    response_headers.append(('Content-Type', 'text/plain'))
+    response_headers.extend([('Content-Type', 'text/plain'),
+                        ('Content-Length', str(len(body)))])
     # start_response(status, response_headers, sys.exc_info())
     start_response(status, response_headers)
-    return [body.encode('utf-8')]
+    return [body]
 
 
 def send_file_response(status, body, start_response):
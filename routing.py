@@ -16,11 +16,12 @@ any later version.
 """
 
 import os
-import cgi
+import threading
 import datetime
 import logging
 import configparser
 import json
+from urllib.parse import parse_qsl
 
 from routeutils.wsgicomm import WIContentError
 from routeutils.wsgicomm import WIClientError
@@ -35,19 +36,39 @@ from routeutils.utils import TW
 from routeutils.utils import geoRectangle
 from routeutils.utils import RequestMerge
 from routeutils.utils import RoutingCache
+from routeutils.utils import RoutingCacheReloader
 from routeutils.utils import RoutingException
 from routeutils.utils import str2date
-from routeutils.routing import lsNSLC
 from routeutils.routing import applyFormat
+from routeutils.routing import dumpsJSON
+from routeutils.routing import setJSONEncoder
+from routeutils.metrics import registry
+
+
+def parseQueryString(queryString):
+    """Parse the parameters of a query string.
+
+    Parameters without a value are ignored.
+
+    :param queryString: Query string of the request (QUERY_STRING)
+    :type queryString: str
+    :returns: Values of every parameter in the order received
+    :rtype: dict
+    """
+    parameters = dict()
+    for key, value in parse_qsl(queryString, encoding='utf-8',
+                                errors='replace'):
+        parameters.setdefault(key, list()).append(value)
+    return parameters
 
 
 def getParam(parameters, names, default, csv=False):
     """Read a parameter and return its value or a default value."""
     for n in names:
         if n in parameters:
-            if isinstance(parameters[n], list):
+            if len(parameters[n]) > 1:
                 raise Exception('Parameter(s) %s returned a list instead of a value. Multiple input?' % names)
-            result = parameters[n].value.upper()
+            result = parameters[n][0].upper()
             break
     else:
         result = default
@@ -58,9 +79,18 @@ def getParam(parameters, names, default, csv=False):
     return result
 
 
-def makeQueryGET(parameters):
-    """Process a request made via a GET method."""
-    global routes
+def makeQueryGET(parameters, rc=None):
+    """Process a request made via a GET method.
+
+    :param parameters: Parameters of the request (see
+        :func:`~parseQueryString`)
+    :type parameters: dict
+    :param rc: Routing information to use. By default, the current one.
+    :type rc: RoutingCache
+    :returns: Routes for the request
+    :rtype: RequestMerge
+    """
+    rc = routes if rc is None else rc
 
     # List all the accepted parameters
     allowedParams = ['net', 'network',
@@ -161,24 +191,114 @@ def makeQueryGET(parameters):
         geoLoc = geoRectangle(minlat, maxlat, minlon, maxlon)
 
     result = RequestMerge()
-    # Expand lists in parameters (f.i., cha=BHZ,HHN) and yield all possible
-    # values
-    for (n, s, l, c) in lsNSLC(net, sta, loc, cha):
-        try:
-            st = Stream(n, s, l, c)
-            tw = TW(start, endt)
-            result.extend(routes.getRoute(st, tw, ser, geoLoc, alt))
-        except RoutingException:
-            pass
+    # Lists in parameters (f.i., cha=BHZ,HHN) are passed as they are. The
+    # routing engine expands only the combinations which can be routed.
+    try:
+        st = Stream(net, sta, loc, cha)
+        tw = TW(start, endt)
+        result.extend(rc.getRoute(st, tw, ser, geoLoc, alt))
+    except RoutingException:
+        pass
 
     if len(result) == 0:
         raise WIContentError()
     return result
 
 
-def makeQueryPOST(postText):
-    """Process a request made via a POST method."""
-    global routes
+def readLines(fp, length=None, chunkSize=65536):
+    """Read the lines of the body of a request as its chunks are needed.
+
+    Only one chunk is kept in memory at a time and the lines are split as
+    :meth:`str.splitlines` would do with the whole body.
+
+    :param fp: Input stream of the request (wsgi.input)
+    :type fp: file-like object
+    :param length: Length of the body or None to read until the end
+    :type length: int
+    :param chunkSize: Bytes read at once
+    :type chunkSize: int
+    :returns: Lines of the body
+    :rtype: generator
+    """
+    pending = b''
+    while (length is None) or (length > 0):
+        chunk = fp.read(chunkSize if length is None else
+                        min(chunkSize, length))
+        if not chunk:
+            break
+        if length is not None:
+            length -= len(chunk)
+
+        pieces = (pending + chunk).split(b'\n')
+        pending = pieces.pop()
+        for piece in pieces:
+            yield from piece.decode().splitlines() or ['']
+
+    if pending:
+        yield from pending.decode().splitlines()
+
+
+class PostBody(object):
+    """Body of a POST request parsed while it is read.
+
+    The header of the body (lines like key=value) is read when the object is
+    created. The lines with the streams requested are read later while
+    iterating over the object, so that the whole body does not need to be in
+    memory.
+
+    :platform: Any
+
+    """
+
+    __slots__ = ('header', 'lines', 'first')
+
+    def __init__(self, lines):
+        """Constructor of PostBody.
+
+        :param lines: Lines of the body (f.i. from :func:`~readLines`)
+        :type lines: iterator
+        """
+        self.lines = iter(lines)
+        # Pairs with the key and value of every line of the header
+        self.header = list()
+        # First line after the header
+        self.first = None
+        for line in self.lines:
+            if not len(line):
+                continue
+
+            if '=' not in line:
+                self.first = line
+                break
+            self.header.append(line)
+
+    def __iter__(self):
+        """Iterate over the non-empty lines after the header."""
+        if self.first is not None:
+            yield self.first
+        for line in self.lines:
+            if len(line):
+                yield line
+
+
+def makeQueryPOST(postText, rc=None, batchSize=1000):
+    """Process a request made via a POST method.
+
+    The lines requesting the same streams and timewindows are routed only
+    once. The rest are routed in batches while the body is read.
+
+    :param postText: Body of the request
+    :type postText: str or PostBody
+    :param rc: Routing information to use. By default, the current one.
+    :type rc: RoutingCache
+    :param batchSize: Maximum number of lines routed at once
+    :type batchSize: int
+    :returns: Routes for the request
+    :rtype: RequestMerge
+    """
+    rc = routes if rc is None else rc
+    if not isinstance(postText, PostBody):
+        postText = PostBody(postText.splitlines())
 
     # These are the parameters accepted appart from N.S.L.C
     extraParams = ['format', 'service', 'alternative',
@@ -192,107 +312,334 @@ def makeQueryPOST(postText):
     alt = False
 
     result = RequestMerge()
-    # Check if we are still processing the header of the POST body. This has a
-    # format like key=value, one per line.
-    inHeader = True
 
     minlat = -90.0
     maxlat = 90.0
     minlon = -180.0
     maxlon = 180.0
 
-    filterdefined = False
-    for line in postText.splitlines():
-        if not len(line):
-            continue
+    # The header of the POST body has a format like key=value, one per line.
+    for line in postText.header:
+        try:
+            key, value = line.split('=')
+            key = key.strip()
+            value = value.strip()
+        except Exception:
+            msg = 'Wrong format detected while processing: %s' % line
+            raise WIClientError(msg)
 
-        if (inHeader and ('=' not in line)):
-            inHeader = False
+        if key not in extraParams:
+            msg = 'Unknown parameter "%s"' % key
+            raise WIClientError(msg)
 
-        if inHeader:
-            try:
-                key, value = line.split('=')
-                key = key.strip()
-                value = value.strip()
-            except Exception:
-                msg = 'Wrong format detected while processing: %s' % line
-                raise WIClientError(msg)
-
-            if key not in extraParams:
-                msg = 'Unknown parameter "%s"' % key
-                raise WIClientError(msg)
-
-            if key == 'service':
-                ser = value
-            elif key == 'alternative':
-                alt = True if value.lower() == 'true' else False
-            elif key == 'minlat':
-                minlat = float(value.lower())
-            elif key == 'maxlat':
-                maxlat = float(value.lower())
-            elif key == 'minlon':
-                minlon = float(value.lower())
-            elif key == 'maxlon':
-                maxlon = float(value.lower())
+        if key == 'service':
+            ser = value
+        elif key == 'alternative':
+            alt = True if value.lower() == 'true' else False
+        elif key == 'minlat':
+            minlat = float(value.lower())
+        elif key == 'maxlat':
+            maxlat = float(value.lower())
+        elif key == 'minlon':
+            minlon = float(value.lower())
+        elif key == 'maxlon':
+            maxlon = float(value.lower())
 
-            continue
+    if ((minlat == -90.0) and (maxlat == 90.0) and (minlon == -180.0) and
+            (maxlon == 180.0)):
+        geoLoc = None
+    else:
+        geoLoc = geoRectangle(minlat, maxlat, minlon, maxlon)
+
+    # Lines already seen and dates already converted
+    seen = set()
+    dates = {'*': None}
+    batch = list()
+
+    filterdefined = False
+    lines = iter(postText)
+    while True:
+        # I'm already in the main part of the POST body, where the streams
+        # are specified
+        try:
+            line = next(lines)
+        except StopIteration:
+            break
+        except UnicodeDecodeError as e:
+            raise WIClientError(str(e))
 
-        # I'm already in the main part of the POST body, where the streams are
-        # specified
         filterdefined = True
 
         net, sta, loc, cha, start, endt = line.split()
-        net = net.upper()
-        sta = sta.upper()
-        loc = loc.upper()
-        try:
-            if start.strip() == '*':
-                start = None
-            else:
-                start = str2date(start)
-        except Exception:
-            msg = 'Error while converting %s to datetime' % start
-            raise WIClientError(msg)
+        key = (net.upper(), sta.upper(), loc.upper(), cha, start, endt)
+        if key in seen:
+            continue
+        seen.add(key)
 
-        try:
-            if endt.strip() == '*':
-                endt = None
-            else:
-                endt = str2date(endt)
-        except Exception:
-            msg = 'Error while converting %s to datetime' % endt
-            raise WIClientError(msg)
+        for d in (start, endt):
+            if d not in dates:
+                try:
+                    dates[d] = str2date(d)
+                except Exception:
+                    msg = 'Error while converting %s to datetime' % d
+                    raise WIClientError(msg)
 
-        if ((minlat == -90.0) and (maxlat == 90.0) and (minlon == -180.0) and
-                (maxlon == 180.0)):
-            geoLoc = None
-        else:
-            geoLoc = geoRectangle(minlat, maxlat, minlon, maxlon)
+        batch.append((Stream(*key[:4]), TW(dates[start], dates[endt])))
+        if len(batch) >= batchSize:
+            result.extend(rc.getRoutes(batch, ser, geoLoc, alt))
+            batch = list()
 
-        try:
-            st = Stream(net, sta, loc, cha)
-            tw = TW(start, endt)
-            result.extend(routes.getRoute(st, tw, ser, geoLoc, alt))
-        except RoutingException:
-            pass
+    if len(batch):
+        result.extend(rc.getRoutes(batch, ser, geoLoc, alt))
 
     if not filterdefined:
         st = Stream('*', '*', '*', '*')
         tw = TW(None, None)
         geoLoc = None
-        result.extend(routes.getRoute(st, tw, ser, geoLoc, alt))
+        result.extend(rc.getRoute(st, tw, ser, geoLoc, alt))
 
     if len(result) == 0:
         raise WIContentError()
     return result
 
 
+class SingleFlight(object):
+    """Share the result of a call among identical calls made at once.
+
+    While a call with some key is in progress, the calls with the same key
+    made from other threads wait for it and get its result (or exception)
+    instead of repeating it. Results are not kept after the call finishes.
+
+    :platform: Any
+
+    """
+
+    class Call(object):
+        """Call in progress and its outcome."""
+
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        """Constructor of SingleFlight."""
+        self.lock = threading.Lock()
+        self.calls = dict()
+
+    def do(self, key, func):
+        """Call a function unless an identical call is already in progress.
+
+        :param key: Key identifying the call (hashable)
+        :type key: tuple
+        :param func: Function without parameters
+        :type func: callable
+        :returns: Result of the function
+        :rtype: object
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.Call()
+                self.calls[key] = call
+
+        if not leader:
+            registry.hit('singleflight')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        registry.miss('singleflight')
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
 # This variable will be treated as GLOBAL by all the other functions
 routes = None
+# Thread reloading the routing information when it changes (False if it
+# should not be started)
+reloader = None
+# Lock to load the routing information only once
+loadLock = threading.Lock()
+# Seconds between two attempts to load the routing information if it could
+# not be loaded at startup and the reload is disabled
+retryInterval = 60
+# Identical GET queries received at once are resolved only once
+flights = SingleFlight()
+
+
+def setRoutes(rc):
+    """Replace the routing information used by new requests.
+
+    The reference is replaced at once. Requests in progress keep using the
+    :class:`~RoutingCache` they started with.
+
+    :param rc: New routing information
+    :type rc: RoutingCache
+    """
+    global routes
+    routes = rc
+
+
+def warmup(buildIfMissing=True):
+    """Load the routing information before any request is received.
+
+    This is expected to be called when the WSGI module is imported (f.i. from
+    routing.wsgi or a preload hook of the server), so that a worker accepts
+    requests only when the routing information is already in memory. Only if
+    buildIfMissing is True and the snapshot (data/routing.xml.bin) cannot be
+    read, the routes are built from the XML files and all Station-WS are
+    queried to cache the stations (slow!).
+
+    If the routing information cannot be loaded, the thread reloading it is
+    started, so that the first snapshot readable is loaded in the background.
+
+    :param buildIfMissing: Build the routing information if the snapshot
+        cannot be read
+    :type buildIfMissing: bool
+    :returns: Value specifying whether the routing information is available
+    :rtype: bool
+    """
+    with loadLock:
+        if routes is not None:
+            return True
+
+        here = os.path.dirname(__file__)
+        routesFile = os.path.join(here, 'data', 'routing.xml')
+        configFile = os.path.join(here, 'routing.cfg')
+        try:
+            setRoutes(RoutingCache(routesFile, configFile, buildIfMissing))
+        except RoutingException as e:
+            logging.error('Routing information not available: %s' % e)
+            config = configparser.RawConfigParser()
+            config.read(configFile)
+            _startReloader(here, config)
+            return False
+
+    return True
+
+
+def startReloader(here, config, blocking=True):
+    """Start the thread reloading the routing information when it changes.
+
+    Only one thread is started, even if the first requests arrive at once.
+    If no routing information was loaded yet, the thread loads the first
+    snapshot readable, even if the reload is disabled in the configuration.
+
+    :param here: Root directory of the service
+    :type here: str
+    :param config: Configuration of the service
+    :type config: configparser.RawConfigParser
+    :param blocking: Wait until the routing information is not being loaded
+        by another thread. Otherwise, nothing is done in that case.
+    :type blocking: bool
+    """
+    if not loadLock.acquire(blocking):
+        return
+
+    try:
+        _startReloader(here, config)
+    finally:
+        loadLock.release()
+
+
+def _startReloader(here, config):
+    # Called with loadLock held
+    global reloader
+
+    if reloader is not None:
+        return
+
+    interval = config.getfloat('Service', 'reloadinterval', fallback=0)
+    callback = setRoutes
+    if routes is not None:
+        mtime = routes.snapshotTime
+    else:
+        # Any snapshot found is newer than the routing information in use
+        mtime = (None, None)
+        if interval <= 0:
+            interval = retryInterval
+
+            def callback(rc):
+                setRoutes(rc)
+                # The reload is disabled once the routes are available
+                reloader.stop()
+
+    if interval <= 0:
+        reloader = False
+        return
+
+    reloader = RoutingCacheReloader(os.path.join(here, 'data', 'routing.xml'),
+                                    os.path.join(here, 'routing.cfg'),
+                                    callback, interval, mtime)
+    reloader.start()
+
+
+def _resetReloader():
+    # Threads do not survive a fork. Every worker starts its own reloader.
+    global reloader
+    reloader = None
+
+
+os.register_at_fork(after_in_child=_resetReloader)
+
+
+# Functions implemented by the service
+implementedFunctions = ('query', 'application.wadl', 'localconfig',
+                        'globalconfig', 'version', 'info', '', 'virtualnets',
+                        'endpoints', 'dc', 'metrics')
 
 
 def application(environ, start_response):
-    """Main WSGI handler. Process requests and calls proper functions."""
+    """Main WSGI handler. Count the requests and time the sampled ones."""
+    timer = registry.start()
+    function = environ['PATH_INFO'].split('/')[-1]
+    if function not in implementedFunctions:
+        function = 'unknown'
+
+    response = dict()
+
+    def startResponse(status, headers, exc_info=None):
+        response['status'] = status
+        return start_response(status, headers)
+
+    try:
+        body = processRequest(environ, startResponse, timer)
+    except Exception:
+        registry.finish(function, '500')
+        raise
+
+    if timer is not None:
+        timer.lap('send')
+        timer.size('bytes', sum(len(chunk) for chunk in body))
+    registry.finish(function, response.get('status', '500'), timer)
+    return body
+
+
+def processRequest(environ, start_response, timer=None):
+    """Process requests and calls proper functions.
+
+    :param environ: WSGI environment
+    :type environ: dict
+    :param start_response: WSGI function to start the response
+    :type start_response: callable
+    :param timer: Timer of the request if it is sampled
+    :type timer: routeutils.metrics.RequestTimer
+    :returns: Body of the response
+    :rtype: list
+    """
     global routes
     fname = environ['PATH_INFO']
 
@@ -301,6 +648,9 @@ def application(environ, start_response):
     config.read(os.path.join(here, 'routing.cfg'))
     verbo = config.get('Service', 'verbosity')
     baseURL = config.get('Service', 'baseURL')
+    registry.sampling = config.getfloat('Service', 'metricssampling',
+                                        fallback=0)
+    setJSONEncoder(config.get('Service', 'jsonencoder', fallback='json'))
     # Warning is the default value
     verboNum = getattr(logging, verbo.upper(), 30)
     logging.info('Verbosity configured with %s' % verboNum)
@@ -321,27 +671,20 @@ def application(environ, start_response):
         outForm = 'xml'
 
         if environ['REQUEST_METHOD'] == 'GET':
-            form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
+            form = parseQueryString(environ['QUERY_STRING'])
             if 'format' in form:
-                outForm = form['format'].value.lower()
+                outForm = form['format'][0].lower()
         elif environ['REQUEST_METHOD'] == 'POST':
             try:
                 length = int(environ.get('CONTENT_LENGTH', '0'))
             except ValueError:
                 length = 0
 
-            # If there is a body to read
-            if length:
-                form = environ['wsgi.input'].read(length).decode()
-            else:
-                form = environ['wsgi.input'].read().decode()
-
-            for line in form.splitlines():
-                if not len(line):
-                    continue
+            # Only the header is read here. The rest of the body is read
+            # while the query is processed.
+            form = PostBody(readLines(environ['wsgi.input'], length or None))
 
-                if '=' not in line:
-                    break
+            for line in form.header:
                 k, v = line.split('=')
                 if k.strip() == 'format':
                     outForm = v.strip()
@@ -359,16 +702,24 @@ def application(environ, start_response):
 
         return send_error_response("400 Bad Request", str(e), start_response)
 
-    # Check whether the function called is implemented
-    implementedFunctions = ['query', 'application.wadl', 'localconfig',
-                            'globalconfig', 'version', 'info', '',
-                            'virtualnets', 'endpoints', 'dc']
+    if timer is not None:
+        timer.lap('read')
 
+    # The routing information should have been loaded by warmup() before
+    # any request arrives. Otherwise, it is loaded in the background by the
+    # reloader and requests are not kept waiting for it.
     if routes is None:
-        # Add routing cache here, to be accessible to all modules
-        routesFile = os.path.join(here, 'data', 'routing.xml')
-        configFile = os.path.join(here, 'routing.cfg')
-        routes = RoutingCache(routesFile, configFile)
+        if reloader is None:
+            startReloader(here, config, blocking=False)
+        return send_error_response("503 Service Unavailable",
+                                   "Routing information not available yet",
+                                   start_response)
+
+    if reloader is None:
+        startReloader(here, config)
+
+    # Keep the same routing information during the whole request
+    rc = routes
 
     fname = environ['PATH_INFO'].split('/')[-1]
     if fname not in implementedFunctions:
@@ -396,10 +747,30 @@ def application(environ, start_response):
 
     elif fname == 'query':
         makeQuery = globals()['makeQuery%s' % environ['REQUEST_METHOD']]
-        try:
-            iterObj = makeQuery(form)
+
+        def query():
+            iterObj = makeQuery(form, rc)
+            if timer is not None:
+                timer.lap('makeQuery')
+                timer.size('datacenters', len(iterObj))
+                timer.size('streams', sum(len(dc['params'])
+                                          for dc in iterObj))
 
             iterObj = applyFormat(iterObj, outForm)
+            if timer is not None:
+                timer.lap('applyFormat')
+            return iterObj
+
+        try:
+            if environ['REQUEST_METHOD'] == 'GET':
+                # The order of the parameters is not relevant. The body of
+                # POST requests is read while it is processed and they are
+                # never coalesced.
+                key = (rc, outForm, tuple(sorted((k, tuple(v))
+                                                 for k, v in form.items())))
+                iterObj = flights.do(key, query)
+            else:
+                iterObj = query()
 
             status = '200 OK'
             if outForm == 'xml':
@@ -419,20 +790,20 @@ def application(environ, start_response):
         except Exception:
             dc = dict()
 
-        return send_json_response('200 OK', dc, start_response)
+        return send_json_response('200 OK', dumpsJSON(dc), start_response)
 
     elif fname == 'endpoints':
-        result = routes.endpoints()
+        result = rc.endpoints()
         return send_plain_response('200 OK', result, start_response)
 
     elif fname == 'localconfig':
-        result = routes.localConfig()
+        result = rc.localConfig()
         if outForm == 'xml':
             return send_xml_response('200 OK', result,
                                      start_response)
 
     elif fname == 'globalconfig':
-        result = routes.globalConfig()
+        result = rc.globalConfig()
         if outForm == 'fdsn':
             return send_json_response('200 OK', result,
                                       start_response)
@@ -442,10 +813,14 @@ def application(environ, start_response):
         return send_error_response("400 Bad Request", text, start_response)
 
     elif fname == 'virtualnets':
-        result = routes.virtualNets()
+        result = rc.virtualNets()
         return send_json_response('200 OK', result,
                                   start_response)
 
+    elif fname == 'metrics':
+        return send_plain_response('200 OK', registry.export(rc),
+                                   start_response)
+
     elif fname == 'version':
         text = "1.2.1"
         return send_plain_response('200 OK', text, start_response)
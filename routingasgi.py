@@ -0,0 +1,261 @@
+"""ASGI front end of the Routing Service for EIDA.
+
+The requests are processed by the same code as in the WSGI application
+(routing.py), sharing its :class:`~RoutingCache`, but the connections are
+handled by an asyncio event loop. Small request bodies are read as they
+arrive without blocking any thread and the queries, which could be
+CPU-intensive, are resolved in a pool of threads. Many slow clients can be
+served by one process without one thread per connection. Larger bodies are
+passed as a stream to the thread resolving the query, which receives their
+chunks only when it needs them, so that they are never kept whole in memory.
+
+It can be run with any ASGI server, e.g. ::
+
+    $ uvicorn routingasgi:application
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2014-2020 Javier Quinteros, Deutsches GFZ Potsdam <javier@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import sys
+import io
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import routing
+
+# Functions resolved in the pool of threads and not in the event loop
+offloadedFunctions = ('query', 'localconfig', 'globalconfig')
+
+# Pool of threads where the routing is done
+executor = ThreadPoolExecutor(thread_name_prefix='routing')
+
+
+class ClientDisconnected(Exception):
+    """Exception to signal that the client closed the connection."""
+
+
+async def readBody(receive, limit=65536):
+    """Read the first chunks of the body of a request as they arrive.
+
+    :param receive: ASGI receive channel
+    :type receive: coroutine function
+    :param limit: Bytes read before passing the rest of the body as a stream
+    :type limit: int
+    :returns: Start of the body and whether there are more chunks to read
+    :rtype: tuple
+    :raises: ClientDisconnected
+    """
+    chunks = list()
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+
+        chunk = message.get('body', b'')
+        chunks.append(chunk)
+        size += len(chunk)
+        more = message.get('more_body', False)
+        if (not more) or (size >= limit):
+            return b''.join(chunks), more
+
+
+class BodyStream(io.RawIOBase):
+    """Body of a request received by a thread as it is read.
+
+    Every chunk is awaited in the event loop only when the data read so far
+    has been consumed. The client is therefore not read faster than the
+    request is processed and only one chunk is kept in memory.
+
+    :platform: Any
+
+    """
+
+    def __init__(self, receive, loop, start=b'', more=True):
+        """Constructor of BodyStream.
+
+        :param receive: ASGI receive channel
+        :type receive: coroutine function
+        :param loop: Event loop of the connection
+        :type loop: asyncio.AbstractEventLoop
+        :param start: Start of the body already received
+        :type start: bytes
+        :param more: Whether there are more chunks to receive
+        :type more: bool
+        """
+        super().__init__()
+        self.receive = receive
+        self.loop = loop
+        self.chunk = memoryview(start)
+        self.more = more
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """Read data into a buffer receiving a new chunk if needed.
+
+        :raises: ClientDisconnected
+        """
+        while not len(self.chunk) and self.more:
+            message = asyncio.run_coroutine_threadsafe(self.receive(),
+                                                       self.loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            self.chunk = memoryview(message.get('body', b''))
+            self.more = message.get('more_body', False)
+
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+
+def makeEnviron(scope, body, stream=None):
+    """Build the WSGI environment of an ASGI HTTP request.
+
+    :param scope: ASGI connection scope
+    :type scope: dict
+    :param body: Body of the request or its start if a stream is given
+    :type body: bytes
+    :param stream: Whole body of the request if it was not completely read
+    :type stream: :class:`~BodyStream`
+    :returns: WSGI environment
+    :rtype: dict
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'],
+               'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version',
+                                                        '1.1'),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': io.BufferedReader(stream) if stream is not None
+               else io.BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    # The length announced is only known if the body is streamed
+    if stream is None:
+        environ['CONTENT_LENGTH'] = str(len(body))
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if (name == 'CONTENT_LENGTH') and (stream is None):
+            continue
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = value.decode('latin-1')
+
+    return environ
+
+
+def callWSGI(environ):
+    """Process a request with the WSGI application.
+
+    :param environ: WSGI environment
+    :type environ: dict
+    :returns: Status code, headers and chunks of the body of the response
+    :rtype: tuple
+    """
+    response = dict()
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split()[0])
+        response['headers'] = [(str(k).lower().encode('latin-1'),
+                                str(v).encode('latin-1'))
+                               for k, v in headers]
+
+    result = routing.application(environ, start_response)
+    try:
+        chunks = [chunk for chunk in result if chunk]
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return response['status'], response['headers'], chunks
+
+
+async def lifespan(receive, send):
+    """Load the routing information at startup and stop the reloader at exit.
+
+    :param receive: ASGI receive channel
+    :type receive: coroutine function
+    :param send: ASGI send channel
+    :type send: coroutine function
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # As in routing.wsgi, the service starts anyway and answers with
+            # 503 until the routing information is available
+            await loop.run_in_executor(executor, routing.warmup)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if routing.reloader:
+                routing.reloader.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """Main ASGI handler. Process requests and calls proper functions."""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] != 'http':
+        raise NotImplementedError('Unsupported connection: %s' %
+                                  scope['type'])
+
+    try:
+        body, more = await readBody(receive)
+    except ClientDisconnected:
+        logging.debug('Client disconnected before sending the request')
+        return
+
+    loop = asyncio.get_running_loop()
+    # The rest of the body is received by the thread processing the request
+    stream = BodyStream(receive, loop, body) if more else None
+    environ = makeEnviron(scope, body, stream)
+    if (routing.routes is None) or (stream is not None) or \
+            (scope['path'].split('/')[-1] in offloadedFunctions):
+        try:
+            status, headers, chunks = await loop.run_in_executor(executor,
+                                                                 callWSGI,
+                                                                 environ)
+        except ClientDisconnected:
+            logging.debug('Client disconnected while sending the request')
+            return
+    else:
+        status, headers, chunks = callWSGI(environ)
+
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers})
+    for pos, chunk in enumerate(chunks, start=1):
+        await send({'type': 'http.response.body', 'body': chunk,
+                    'more_body': pos < len(chunks)})
+    if not len(chunks):
+        await send({'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+
+"""Benchmarks of the routing engine
+
+Synthetic routing tables, similar to the one in routing.xml.sample but with
+any number of routes, stations and virtual networks, are generated and the
+time needed to import, save and load them, to route a representative mix of
+queries and to format the results is measured. No Station-WS is contacted.
+The results are printed in JSON format, so that they can be compared between
+versions. ::
+
+    $ ./benchRoute.py -s 1000,10000,100000 -o bench.json
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2014-2020 Javier Quinteros, Deutsches GFZ Potsdam <javier@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import sys
+import os
+import gc
+import time
+import json
+import random
+import pickle
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+from urllib.parse import urlparse
+
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+from routeutils.utils import RoutingCache
+from routeutils.utils import RoutingException
+from routeutils.utils import addRoutes
+from routeutils.utils import addVirtualNets
+from routeutils.utils import Station
+from routeutils.utils import Stream
+from routeutils.utils import TW
+from routeutils.utils import Route
+from routeutils.utils import BitsetIndex
+from routeutils.utils import ServiceRoutes
+from routeutils.utils import geoRectangle
+from routeutils.utils import numpy
+from routeutils.routing import applyFormat
+from routeutils.packed import writePacked
+
+services = (('station', '/fdsnws/station/1/query'),
+            ('dataselect', '/fdsnws/dataselect/1/query'),
+            ('wfcatalog', '/eidaws/wfcatalog/1/query'))
+
+formats = ('xml', 'json', 'get', 'post', 'fdsn')
+
+# Query routing the whole table
+fullTable = 'everything'
+
+# Stations per network
+stationsPerNet = 40
+
+
+def makeTables(routes, seed=1):
+    """Generate a synthetic routing table with the given number of routes.
+
+    Nine out of ten networks are routed station by station. The rest are
+    routed with a wildcard in the station code. Some networks have also an
+    alternative route with lower priority.
+
+    :param routes: Number of routes (one per stream and service)
+    :type routes: int
+    :param seed: Seed of the random generator
+    :type seed: int
+    :returns: Routing, station and virtual network tables
+    :rtype: tuple
+    """
+    rnd = random.Random(seed)
+    hosts = ['http://dc%02d.example.org' % i for i in range(12)]
+    ptRT = dict()
+    ptST = dict()
+    streams = max(1, routes // len(services))
+
+    net = 0
+    while len(ptRT) < streams:
+        code = 'N%d' % net
+        start = datetime.datetime(1980 + net % 30, 1, 1)
+        prio = [hosts[net % len(hosts)]]
+        if not net % 7:
+            prio.append(hosts[(net + 1) % len(hosts)])
+
+        stations = [Station('S%03d' % i, rnd.uniform(-60, 75),
+                            rnd.uniform(-180, 180),
+                            start + datetime.timedelta(days=rnd.randint(0, 999)),
+                            None if i % 5 else datetime.datetime(2015, 1, 1))
+                    for i in range(stationsPerNet)]
+
+        if not net % 10:
+            streamList = [(Stream(code, '*', '*', '*'), stations)]
+        else:
+            streamList = [(Stream(code, sta.name, '*', '*'), [sta])
+                          for sta in stations[:streams - len(ptRT)]]
+
+        for st, cached in streamList:
+            ptRT[st] = sorted(Route(srv, host + path, TW(start, None), p)
+                              for p, host in enumerate(prio, start=1)
+                              for srv, path in services)
+            for host in prio:
+                ptST.setdefault(urlparse(host).netloc, dict())[st] = cached
+
+        net += 1
+
+    # One virtual network every 500 routes with up to 20 stations
+    ptVN = dict()
+    keys = [st for st in ptRT if st.s != '*']
+    for vn in range(max(1, routes // 500)):
+        ptVN['_VN%d' % vn] = [(Stream(st.n, st.s, '*', '*'),
+                               TW(datetime.datetime(2000, 1, 1), None))
+                              for st in rnd.sample(keys, min(20, len(keys)))]
+
+    return ptRT, ptST, ptVN
+
+
+def writeXML(fileName, ptRT, ptVN):
+    """Save the routing and virtual network tables in XML format.
+
+    :param fileName: Name of the routing file
+    :type fileName: str
+    :param ptRT: Routing table
+    :type ptRT: dict
+    :param ptVN: Table with the virtual networks
+    :type ptVN: dict
+    """
+    def date(dt):
+        return '' if dt is None else dt.isoformat()
+
+    with open(fileName, 'w', encoding='utf-8') as fout:
+        fout.write('<?xml version="1.0" encoding="utf-8"?>\n<ns0:routing '
+                   'xmlns:ns0="http://geofon.gfz-potsdam.de/ns/Routing/1.0/">'
+                   '\n')
+        for code, members in ptVN.items():
+            fout.write(' <ns0:vnetwork networkCode="%s">\n' % code)
+            for st, tw in members:
+                fout.write('  <ns0:stream networkCode="%s" stationCode="%s" '
+                           'locationCode="%s" streamCode="%s" start="%s" '
+                           'end="%s" />\n' % (st.n, st.s, st.l, st.c,
+                                              date(tw.start), date(tw.end)))
+            fout.write(' </ns0:vnetwork>\n')
+
+        for st, routes in ptRT.items():
+            fout.write(' <ns0:route networkCode="%s" stationCode="%s" '
+                       'locationCode="%s" streamCode="%s">\n' % st)
+            for r in routes:
+                fout.write('  <ns0:%s address="%s" priority="%d" start="%s" '
+                           'end="%s" />\n' % (r.service, r.address, r.priority,
+                                              date(r.tw.start),
+                                              date(r.tw.end)))
+            fout.write(' </ns0:route>\n')
+        fout.write('</ns0:routing>\n')
+
+
+def makeQueries(ptRT, ptVN):
+    """Return a representative mix of queries for the routing table.
+
+    :param ptRT: Routing table
+    :type ptRT: dict
+    :param ptVN: Table with the virtual networks
+    :type ptVN: dict
+    :returns: Name and parameters of getRoute for every query
+    :rtype: list
+    """
+    keys = list(ptRT)
+    nets = sorted(set(st.n for st in keys))
+    st = keys[len(keys) // 2]
+    net = nets[len(nets) // 2]
+    tw = TW(datetime.datetime(2016, 1, 1), datetime.datetime(2016, 2, 1))
+    return [('stream', (Stream(st.n, st.s, '*', 'BHZ'), tw)),
+            ('network', (Stream(net, '*', '*', '*'), TW(None, None))),
+            ('station-all-networks', (Stream('*', 'S001', '*', '*'), tw)),
+            ('geolocation', (Stream(net, '*', '*', '*'), tw, 'station',
+                             geoRectangle(-10, 30, -90, 90))),
+            ('multi-valued', (Stream(nets[:3], '*', '*', ['BHZ', 'HHZ']),
+                              tw)),
+            ('virtual-network', (Stream(sorted(ptVN)[0], '*', '*', '*'),
+                                 TW(None, None))),
+            ('all-services', (Stream(net, '*', '*', '*'), tw,
+                              'dataselect,station,wfcatalog')),
+            ('alternative', (Stream(nets[0], '*', '*', '*'), tw, 'dataselect',
+                             None, True)),
+            ('unknown-network', (Stream('XX', '*', '*', '*'), tw)),
+            (fullTable, (Stream('*', '*', '*', '*'), TW(None, None)))]
+
+
+def timeit(func, budget=0.5, maxCalls=1000):
+    """Call a function repeatedly and return its mean duration.
+
+    :param func: Function without parameters
+    :type func: callable
+    :param budget: Seconds after which no more calls are made
+    :type budget: float
+    :param maxCalls: Maximum number of calls
+    :type maxCalls: int
+    :returns: Number of calls and mean duration in seconds
+    :rtype: tuple
+    """
+    calls = 0
+    total = 0.0
+    while (calls < maxCalls) and (total < budget):
+        start = time.perf_counter()
+        func()
+        total += time.perf_counter() - start
+        calls += 1
+    return calls, total / calls
+
+
+def once(func):
+    """Call a function once and return its duration in seconds."""
+    gc.collect()
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def traced(func):
+    """Call a function once and return its duration and the memory it keeps.
+
+    :param func: Function without parameters
+    :type func: callable
+    :returns: Duration in seconds, bytes still allocated and result
+    :rtype: tuple
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    res = func()
+    duration = time.perf_counter() - start
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return duration, size, res
+
+
+def bench(routes, tmpDir, quadLimit, budget):
+    """Run all the benchmarks for a routing table of a certain size.
+
+    :param routes: Number of routes in the routing table
+    :type routes: int
+    :param tmpDir: Directory where the files are generated
+    :type tmpDir: str
+    :param quadLimit: Maximum number of routes for which the operations with a
+        quadratic cost (addRoutes and routing the whole table) are timed
+    :type quadLimit: int
+    :param budget: Seconds spent at most with every query and format
+    :type budget: float
+    :returns: Sizes, memory in bytes and timings in seconds
+    :rtype: dict
+    """
+    ptRT, ptST, ptVN = makeTables(routes)
+    routingFile = os.path.join(tmpDir, 'routing-%d.xml' % routes)
+    writeXML(routingFile, ptRT, ptVN)
+
+    # Lists of stations are shared by all hosts of a stream
+    cached = dict((id(lst), lst) for d in ptST.values() for lst in d.values())
+    result = {'routes': sum(len(lr) for lr in ptRT.values()),
+              'streams': len(ptRT),
+              'stations': sum(len(lst) for lst in cached.values()),
+              'vnets': len(ptVN)}
+
+    timings = dict()
+    # Overlaps are checked between all routes (quadratic)
+    quadratic = result['routes'] <= quadLimit
+    timings['addRoutes'] = once(lambda: addRoutes(routingFile)) \
+        if quadratic else None
+    timings['addVirtualNets'] = once(lambda: addVirtualNets(routingFile))
+
+    configFile = os.path.join(tmpDir, 'routing.cfg')
+    binFile = routingFile + '.bin'
+    packFile = routingFile + '.pack'
+    snapshot = (ptRT, ptST, ptVN, list())
+
+    def dumpPickle():
+        with open(binFile, 'wb') as fout:
+            pickle.dump(snapshot, fout)
+
+    timings['writePickle'] = once(dumpPickle)
+    timings['loadPickle'] = once(
+        lambda: RoutingCache(routingFile, configFile, buildIfMissing=False))
+    timings['writePacked'] = once(lambda: writePacked(packFile, *snapshot))
+    timings['loadPacked'] = once(
+        lambda: RoutingCache(routingFile, configFile, buildIfMissing=False))
+
+    timings['getRoute'] = dict()
+    rcs = {'dict': RoutingCache(), 'packed': RoutingCache(routingFile, configFile)}
+    rcs['dict'].routingTable = ptRT
+    rcs['dict'].stationTable = ptST
+    rcs['dict'].vnTable = ptVN
+    for kind, rc in rcs.items():
+        for name, params in makeQueries(ptRT, ptVN):
+            if (name == fullTable) and not quadratic:
+                timings['getRoute']['%s/%s' % (kind, name)] = None
+                continue
+
+            def query():
+                try:
+                    return rc.getRoute(*params)
+                except RoutingException:
+                    return None
+
+            calls, mean = timeit(query, budget)
+            res = query()
+            timings['getRoute']['%s/%s' % (kind, name)] = {
+                'calls': calls, 'mean': mean,
+                'results': 0 if res is None else
+                sum(len(dc['params']) for dc in res)}
+
+    # Streams overlapping every query selected with the linear scan of the
+    # routing table and with the inverted index
+    timings['bitsetIndex'] = once(lambda: BitsetIndex(ptRT))
+    timings['expandNSLC'] = dict()
+    rc = rcs['dict']
+    for name, params in makeQueries(ptRT, ptVN):
+        nslc = [tuple(comp) if isinstance(comp, (list, tuple)) else (comp,)
+                for comp in params[0]]
+        for strategy, func in (('scan', rc.scanNSLC),
+                               ('bitset', rc.expandNSLC)):
+            calls, mean = timeit(lambda: func(*nslc), budget)
+            timings['expandNSLC']['%s/%s' % (strategy, name)] = {
+                'calls': calls, 'mean': mean}
+
+    # Indexes built by every worker after loading the packed snapshot, where
+    # the routes of every service are already ranked with their overlaps
+    timings['serviceRoutes'] = dict()
+    result['memory'] = dict()
+    table = RoutingCache(routingFile, configFile).routingTable
+    duration, size, index = traced(lambda: BitsetIndex(table))
+    result['memory']['bitsetIndex'] = size
+    duration, size, byService = traced(
+        lambda: dict((srv, ServiceRoutes(index, srv))
+                     for srv in index.services))
+    timings['serviceRoutes']['build'] = duration
+    result['memory']['serviceRoutes'] = size
+    duration, size, res = traced(
+        lambda: [sr.conflicts(rank) for sr in byService.values()
+                 for rank in range(len(sr))])
+    timings['serviceRoutes']['conflicts'] = duration
+    result['memory']['conflicts'] = size
+
+    # The results of one query for a station in all networks are formatted
+    timings['applyFormat'] = dict()
+    for outFormat in formats:
+        # Some formats modify the object received. Every call gets its own.
+        copies = [rcs['dict'].getRoute(Stream('*', 'S001', '*', '*'),
+                                       TW(None, None)) for i in range(20)]
+        calls, mean = timeit(lambda: applyFormat(copies.pop(), outFormat),
+                             budget, len(copies))
+        timings['applyFormat'][outFormat] = {'calls': calls, 'mean': mean}
+
+    for fileName in (routingFile, binFile, packFile):
+        os.remove(fileName)
+
+    result['timings'] = timings
+    return result
+
+
+def main():
+    desc = 'Benchmarks of the routing engine with synthetic routing tables.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-s', '--sizes', default='1000,10000,100000',
+                        help='Comma-separated number of routes of the tables.')
+    parser.add_argument('-q', '--quadratic-limit', type=int, default=5000,
+                        help='Maximum number of routes to time addRoutes '
+                             'and to route the whole table.')
+    parser.add_argument('-b', '--budget', type=float, default=0.5,
+                        help='Seconds spent at most with every query.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='File where the results are saved (JSON).')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    results = {'date': datetime.datetime.utcnow().isoformat(),
+               'python': platform.python_version(),
+               'numpy': numpy is not None,
+               'benchmarks': list()}
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for size in args.sizes.split(','):
+            results['benchmarks'].append(bench(int(size), tmpDir,
+                                               args.quadratic_limit,
+                                               args.budget))
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as fout:
+            fout.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""Load test comparing deployments of the Routing Service
+
+The same mix of requests is sent with a number of concurrent clients to every
+service given (e.g. the WSGI and the ASGI front ends running locally) and the
+throughput and latencies are reported. Slow clients, which send the body of
+their POST requests in pieces, can be simulated to check how the services
+behave with many open connections. ::
+
+    $ gunicorn -w 1 --threads 8 -b :8000 routing:application
+    $ uvicorn --port 8001 routingasgi:application
+    $ ./loadRoute.py -c 64 -s 0.5 wsgi=http://localhost:8000/eidaws/routing/1/query \\
+          asgi=http://localhost:8001/eidaws/routing/1/query
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+   :Copyright:
+       2014-2020 Javier Quinteros, Deutsches GFZ Potsdam <javier@gfz-potsdam.de>
+   :License:
+       GPLv3
+   :Platform:
+       Linux
+
+.. moduleauthor:: Javier Quinteros <javier@gfz-potsdam.de>, GEOFON, GFZ Potsdam
+"""
+
+import time
+import json
+import argparse
+import http.client
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Mix of requests sent to the services. None means a POST request.
+queries = ['net=GE&format=post',
+           'net=GE,RO&sta=*&cha=BH?&format=json',
+           'net=CH&sta=LIENZ&cha=HHZ&service=station&format=get',
+           'net=*&minlat=-10&maxlat=30&format=post',
+           'net=_GEALL&format=xml',
+           'net=XXX',
+           None]
+
+postBody = """service=dataselect
+format=post
+GE APE * BHZ 2010-01-01T00:00:00 *
+RO BZS * * 2010-01-01T00:00:00 2011-01-01T00:00:00
+CH * * HH? * *
+"""
+
+
+def request(url, query, slow=0.0):
+    """Send one request and return its status and duration.
+
+    :param url: Address of the query method of the service
+    :type url: str
+    :param query: Query string or None for a POST request
+    :type query: str
+    :param slow: Seconds to wait between the lines of a POST body
+    :type slow: float
+    :returns: HTTP status and seconds until the response was read
+    :rtype: tuple
+    """
+    parts = urlparse(url)
+    start = time.time()
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80,
+                                      timeout=120)
+    try:
+        if query is not None:
+            conn.request('GET', '%s?%s' % (parts.path, query))
+        else:
+            body = postBody.encode('utf-8')
+            conn.putrequest('POST', parts.path)
+            conn.putheader('Content-Length', str(len(body)))
+            conn.endheaders()
+            for line in body.splitlines(keepends=True):
+                if slow:
+                    time.sleep(slow)
+                conn.send(line)
+
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status, time.time() - start
+    except Exception:
+        return None, time.time() - start
+    finally:
+        conn.close()
+
+
+def percentile(values, p):
+    """Return the p-th percentile of an ordered list."""
+    if not len(values):
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def load(url, concurrency, requests, slow=0.0):
+    """Send a number of requests with concurrent clients to a service.
+
+    :param url: Address of the query method of the service
+    :type url: str
+    :param concurrency: Number of concurrent clients
+    :type concurrency: int
+    :param requests: Total number of requests
+    :type requests: int
+    :param slow: Seconds to wait between the lines of a POST body
+    :type slow: float
+    :returns: Statistics of the run
+    :rtype: dict
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: request(url, queries[i %
+                                                               len(queries)],
+                                                  slow),
+                                range(requests)))
+    elapsed = time.time() - start
+
+    latencies = sorted(t for status, t in results if status is not None)
+    return {'url': url,
+            'concurrency': concurrency,
+            'requests': requests,
+            'errors': len([s for s, t in results
+                           if s is None or s >= 500]),
+            'seconds': round(elapsed, 3),
+            'reqpersec': round(requests / elapsed, 1),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99)}
+
+
+def main():
+    desc = 'Compare the performance of deployments of the Routing Service.'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('services', nargs='+', metavar='NAME=URL',
+                        help='Address of the query method of a service.')
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+                        help='Number of concurrent clients.')
+    parser.add_argument('-n', '--requests', type=int, default=700,
+                        help='Number of requests sent to every service.')
+    parser.add_argument('-s', '--slow', type=float, default=0.0,
+                        help='Seconds between the lines of a POST body.')
+    parser.add_argument('-j', '--json', action='store_true',
+                        help='Print the results in JSON format.')
+    args = parser.parse_args()
+
+    results = dict()
+    for service in args.services:
+        name, sep, url = service.partition('=')
+        if not sep or ('://' in name):
+            name, url = service, service
+        # Warm up the service
+        request(url, queries[0])
+        results[name] = load(url, args.concurrency, args.requests, args.slow)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('%-10s %8s %7s %9s %8s %8s %8s' % ('service', 'requests', 'errors',
+                                             'req/s', 'p50', 'p90', 'p99'))
+    for name, r in results.items():
+        print('%-10s %8d %7d %9.1f %8.4f %8.4f %8.4f' %
+              (name[:10], r['requests'], r['errors'], r['reqpersec'],
+               r['p50'] or 0, r['p90'] or 0, r['p99'] or 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,20 +20,69 @@ any later version.
 import sys
 import os
 import datetime
+import configparser
+import io
+import asyncio
+import json
+import random
+import fnmatch
+import itertools
+import tempfile
+import threading
 import urllib.request as ul
 import unittest
+from urllib.parse import urlparse
 
 here = os.path.dirname(__file__)
 sys.path.append(os.path.join(here, '..'))
 
 from routeutils.unittestTools import WITestRunner
 from routeutils.utils import RoutingCache
+from routeutils.utils import addRoutes
+from routeutils.utils import addVirtualNets
+from routeutils.utils import Station
+from routeutils.utils import StationIndex
+from routeutils.utils import NumpyStationIndex
+from routeutils.utils import VirtualNetIndex
+from routeutils.utils import Interner
+from routeutils.utils import internTables
+from routeutils.utils import numpy
 from routeutils.utils import RequestMerge
 from routeutils.utils import FDSNRules
 from routeutils.utils import Stream
+from routeutils.utils import Route
 from routeutils.utils import TW
+from routeutils.utils import TWSet
+from routeutils.utils import coveredTW
 from routeutils.utils import geoRectangle
 from routeutils.utils import RoutingException
+from routeutils.utils import RoutingCacheReloader
+from routeutils.utils import BitsetIndex
+from routeutils.utils import ServiceRoutes
+from routeutils.routing import applyFormat
+from routeutils.routing import dumpsJSON
+from routeutils.routing import jsonEncoders
+from routeutils.routing import setJSONEncoder
+from routeutils.packed import writePacked
+from routeutils.packed import PackedSnapshot
+from routeutils.metrics import Metrics
+from routeutils.metrics import registry
+import routing
+from routing import readLines
+from routing import PostBody
+from routing import makeQueryPOST
+from routing import makeQueryGET
+from routing import parseQueryString
+from routing import SingleFlight
+from routingasgi import readBody
+from routingasgi import makeEnviron
+from routingasgi import BodyStream
+from routingasgi import ClientDisconnected
+from routeutils.wsgicomm import WIClientError
+from routeutils.wsgicomm import send_plain_response
+from routeutils.wsgicomm import send_xml_response
+from routeutils.wsgicomm import send_json_response
+from routeutils.wsgicomm import send_error_response
 
 
 class RouteCacheTests(unittest.TestCase):
@@ -370,6 +419,1006 @@ class RouteCacheTests(unittest.TestCase):
                          'Wrong service name!')
 
 
+class RouteCacheOfflineTests(unittest.TestCase):
+    """Test the routing engine without contacting any Station-WS.
+
+    """
+
+    @classmethod
+    def setUp(cls):
+        "Setting up test"
+        if hasattr(cls, 'rc'):
+            return
+        sample = os.path.join(here, '..', 'data', 'routing.xml.sample')
+        cls.rc = RoutingCache()
+        cls.rc.routingFile = sample
+        cls.rc.routingTable = addRoutes(sample)
+        cls.rc.vnTable = addVirtualNets(sample)
+        names = {'GE': ['APE', 'BNDI', 'RUE', 'LVC'],
+                 'RO': ['BZS', 'VRI'],
+                 'CH': ['LIENZ', 'DAVOX'],
+                 '4C': ['KES20', 'KES27']}
+        cls.rc.stationTable = dict()
+        for st, routes in cls.rc.routingTable.items():
+            stations = [Station(name, 10.0 * i, 5.0 * i,
+                                datetime.datetime(1990, 1, 1),
+                                datetime.datetime(2000, 1, 1)
+                                if name == 'LVC' else None)
+                        for i, name in enumerate(names.get(st.n, []))]
+            for rt in routes:
+                cls.rc.stationTable.setdefault(urlparse(rt.address).netloc,
+                                               dict())[st] = stations
+
+    def testMultiValued(self):
+        """Multi-valued N.S.L.C components equal the expanded combinations"""
+
+        comps = (['GE', 'RO', 'XXX', '_GEALL'], ['APE', 'BZS', 'LIENZ', '*'],
+                 ['*'], ['BHZ', 'HNE', '*'])
+        for service in ('dataselect', 'station'):
+            expected = RequestMerge()
+            for nslc in itertools.product(*comps):
+                try:
+                    expected.extend(self.rc.getRoute(Stream(*nslc),
+                                                     TW(None, None), service))
+                except RoutingException:
+                    pass
+
+            result = self.rc.getRoute(Stream(*comps), TW(None, None), service)
+            self.assertEqual(result, expected,
+                             'Multi-valued query differs from its expansion!')
+
+    def testStationIndex(self):
+        """Indexed station filter equals the linear one"""
+
+        stations = [Station('S%d' % (i % 7), (i * 37) % 180 - 90.0,
+                            (i * 53) % 360 - 180.0,
+                            datetime.datetime(1990, 1, 1), None)
+                    for i in range(200)]
+        index = StationIndex(stations)
+        for pattern in ('*', 'S3', 'S[12]', 'X*'):
+            for geo in (None, geoRectangle(-10, 45, -100, 20)):
+                expected = [sta for sta in stations
+                            if fnmatch.fnmatch(sta.name, pattern) and
+                            (geo is None or
+                             geo.contains(sta.latitude, sta.longitude))]
+                self.assertEqual(index.select(pattern, geo), expected,
+                                 'Wrong stations selected for %s' % pattern)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def testNumpyStationIndex(self):
+        """Vectorised station filter equals the pure Python one"""
+
+        stations = [Station('S%d' % (i % 7), (i * 37) % 180 - 90.0,
+                            (i * 53) % 360 - 180.0,
+                            datetime.datetime(1990 + i % 30, 1, 1),
+                            None if i % 3 else
+                            datetime.datetime(2000 + i % 20, 1, 1))
+                    for i in range(200)]
+        index = StationIndex(stations)
+        npindex = NumpyStationIndex(stations)
+        for pattern in ('*', 'S3', 'S[12]', 'X*'):
+            for geo in (None, geoRectangle(-10, 45, -100, 20)):
+                for tw in (None, TW(datetime.datetime(2005, 1, 1), None),
+                           TW(datetime.datetime(1995, 1, 1),
+                              datetime.datetime(1996, 1, 1))):
+                    self.assertEqual(npindex.select(pattern, geo, tw),
+                                     index.select(pattern, geo, tw),
+                                     'Wrong stations selected for %s' %
+                                     pattern)
+
+    def testVirtualNetIndex(self):
+        """Indexed expansion of virtual networks equals the linear one"""
+
+        def linear(members, stream, tw):
+            result = list()
+            for st, memberTW in members:
+                try:
+                    result.append((st.strictMatch(('*',) + tuple(stream[1:])),
+                                   TW(*memberTW.intersection(tw))))
+                except Exception:
+                    pass
+            return result
+
+        years = [None] + [datetime.datetime(y, 1, 1)
+                          for y in range(1990, 2021, 5)]
+        members = list()
+        for i in range(300):
+            start = years[i % 7]
+            end = years[(i * 3) % 8]
+            members.append((Stream('N%d' % (i % 4),
+                                   ('S%d' % (i % 9)) if i % 5 else '*',
+                                   '*' if i % 3 else '00',
+                                   ('BH%s' % 'ZNE'[i % 3]) if i % 4 else
+                                   'BH?'), TW(start, end)))
+
+        index = VirtualNetIndex(members)
+        for sta in ('*', 'S3', 'S1*', 'X'):
+            for loc in ('*', '00', '10'):
+                for cha in ('*', 'BHZ', 'BH?', 'HHZ'):
+                    for start, end in ((None, None), (years[2], None),
+                                       (None, years[3]), (years[1], years[4]),
+                                       (years[4], years[4])):
+                        stream = Stream('_VN', sta, loc, cha)
+                        tw = TW(start, end)
+                        self.assertEqual(index.expand(stream, tw),
+                                         linear(members, stream, tw),
+                                         'Wrong expansion of %s %s' %
+                                         (stream, tw))
+
+    def testVirtualNetRoutes(self):
+        """Routes of virtual networks resolved in advance equal the direct ones"""
+
+        world = geoRectangle(-90, 90, -180, 180)
+        years = [datetime.datetime(y, 1, 1) for y in (1985, 1995, 2010, 2015)]
+
+        # Members open in time also need routes starting later
+        rc = RoutingCache()
+        rc.routingTable = self.rc.routingTable
+        rc.stationTable = self.rc.stationTable
+        rc.vnTable = dict(self.rc.vnTable)
+        rc.vnTable['_OPEN'] = [(Stream('GE', 'APE', '*', '*'), TW(None, None)),
+                               (Stream('RO', '*', '*', 'BH?'),
+                                TW(years[0], None))]
+
+        for stream in (Stream('_GEALL', '*', '*', '*'),
+                       Stream('_OPEN', '*', '*', '*')):
+            for start, end in ((None, None), (years[0], years[1]),
+                               (years[2], None), (None, years[0]),
+                               (years[2], years[3])):
+                tw = TW(start, end)
+                for service in ('dataselect', 'station'):
+                    for geo in (None, world):
+                        for alternative in (False, True):
+                            expected = RequestMerge()
+                            for st, auxTW in rc.vn2real(stream, tw):
+                                try:
+                                    expected.extend(rc.getRouteDS(
+                                        service, st, auxTW, geo, alternative))
+                                except RoutingException:
+                                    pass
+
+                            for i in range(2):
+                                try:
+                                    result = rc.getRoute(stream, tw, service,
+                                                         geo, alternative)
+                                except RoutingException:
+                                    result = RequestMerge()
+                                self.assertEqual(result, expected,
+                                                 'Wrong routes for %s %s' %
+                                                 (stream, tw))
+
+    def testComparisons(self):
+        """Timewindows, streams and routes are compared as before"""
+
+        years = [None] + [datetime.datetime(y, 1, 1)
+                          for y in (1990, 2000, 2010)]
+        tws = [TW(start, end) for start in years for end in years
+               if (start is None) or (end is None) or (start <= end)]
+        low = datetime.datetime(1900, 1, 1)
+        high = datetime.datetime(3000, 1, 1)
+        for tw1 in tws:
+            for tw2 in tws:
+                self.assertEqual(tw1.overlap(tw2),
+                                 (tw2.start or low) <= (tw1.end or high) and
+                                 (tw1.start or low) <= (tw2.end or high),
+                                 'Wrong overlap of %s and %s' % (tw1, tw2))
+
+        codes = ('GE', 'G*', '*', 'RO', 'APE', 'A*', 'BH?', 'BHZ')
+        for code1 in codes:
+            for code2 in codes:
+                st1 = Stream(code1, code2, '*', code2)
+                st2 = Stream(code2, code1, '*', code1)
+                self.assertEqual(st1.overlap(st2),
+                                 all(fnmatch.fnmatch(a, b) or
+                                     fnmatch.fnmatch(b, a)
+                                     for a, b in zip(st1, st2)),
+                                 'Wrong overlap of %s and %s' % (st1, st2))
+
+        routes = [Route('dataselect', 'http://host%d' % (i % 4), tws[i % 7],
+                        (i * 7) % 5) for i in range(40)]
+        self.assertEqual([tuple(r) for r in sorted(routes,
+                                                   key=Route.sortKey)],
+                         [tuple(r) for r in sorted(routes)],
+                         'Routes sorted in a different order!')
+
+    def testServiceRoutes(self):
+        """Routes ranked in advance are selected as by the pairwise checks"""
+
+        def pairwise(routingTable, service, stream, tw, alternative):
+            subs2 = list()
+            for stRT, routes in routingTable.items():
+                if not stRT.overlap(stream):
+                    continue
+                prios = [rou.priority for rou in routes
+                         if (rou.service == service) and rou.tw.overlap(tw)]
+                for rou in routes:
+                    if (rou.service == service) and rou.tw.overlap(tw) and \
+                            (alternative or rou.priority == min(prios)):
+                        subs2.append((stRT, rou))
+
+            finalset = list()
+            for (s1, r1) in sorted(subs2, key=lambda x: (x[1].priority,
+                                                         x[0])):
+                for (s2, r2) in finalset:
+                    if s1.overlap(s2) and r1.tw.overlap(r2.tw) and \
+                            (not alternative or r1.priority == r2.priority):
+                        break
+                else:
+                    finalset.append((s1, r1))
+            return finalset
+
+        years = [None] + [datetime.datetime(y, 1, 1)
+                          for y in (1990, 2000, 2010)]
+        tws = [TW(start, end) for start in years for end in years
+               if (start is None) or (end is None) or (start < end)]
+        streams = [Stream(n, s, '*', c) for n in ('GE', 'G*', 'RO', '*')
+                   for s in ('*', 'APE', 'A*', 'BZS')
+                   for c in ('*', 'BHZ')]
+
+        # Routing table with many overlaps
+        routingTable = dict()
+        for i, st in enumerate(streams):
+            routingTable[st] = sorted([Route(('dataselect', 'station')[j % 2],
+                                             'http://host%d/' % ((i + j) % 3),
+                                             tws[(i * 5 + j) % len(tws)],
+                                             1 + (i + j) % 3)
+                                       for j in range(i % 4)],
+                                      key=Route.sortKey)
+
+        rc = RoutingCache()
+        rc.routingTable = routingTable
+
+        # Only positions are kept and overlaps are found when needed
+        table = rc.getServiceRoutes('station')
+        self.assertEqual(len(table), sum(rou.service == 'station'
+                                         for routes in routingTable.values()
+                                         for rou in routes),
+                         'Wrong number of routes ranked!')
+        self.assertFalse(table.conflictMemo, 'Overlaps found in advance!')
+        ranked = [table.item(rank) for rank in range(len(table))]
+        self.assertEqual([rou.priority for st, rou in ranked],
+                         sorted(rou.priority for st, rou in ranked),
+                         'Routes not ranked by priority!')
+
+        for service in ('dataselect', 'station'):
+            for stream in streams[::3] + [Stream('GE', 'APE', '00', 'BHZ')]:
+                for tw in tws:
+                    for alternative in (False, True):
+                        self.assertEqual(
+                            [(st, tuple(rt)) for st, rt in
+                             rc.selectRoutes(service, stream, tw,
+                                             alternative)],
+                            [(st, tuple(rt)) for st, rt in
+                             pairwise(routingTable, service, stream, tw,
+                                      alternative)],
+                            'Wrong routes for %s %s' % (stream, tw))
+
+    def testTWSet(self):
+        """Set algebra of timewindows equals the checks instant by instant"""
+
+        rnd = random.Random(41)
+        days = [None] + [datetime.datetime(2000, 1, 1) +
+                         datetime.timedelta(days=d) for d in range(10)]
+
+        def randomTW():
+            start, end = rnd.choice(days), rnd.choice(days)
+            if (start is not None) and (end is not None) and (start > end):
+                start, end = end, start
+            return TW(start, end)
+
+        def randomSet():
+            result = TWSet()
+            for i in range(rnd.randint(0, 3)):
+                result = result.union(TWSet.fromTW(randomTW()))
+            return result
+
+        def contains(twSet, instant):
+            return any(((tw.start is None) or (tw.start <= instant)) and
+                       ((tw.end is None) or (instant < tw.end))
+                       for tw in twSet)
+
+        # Every day, the hour after and instants far away
+        instants = [datetime.datetime(1900, 1, 1),
+                    datetime.datetime(2100, 1, 1)]
+        for day in days[1:]:
+            instants.extend((day, day + datetime.timedelta(hours=1)))
+
+        for i in range(500):
+            a, b = randomSet(), randomSet()
+            for name, op in (('union', lambda x, y: x or y),
+                             ('intersection', lambda x, y: x and y),
+                             ('difference', lambda x, y: x and not y)):
+                result = getattr(a, name)(b)
+                self.assertEqual(list(result), list(TWSet(result.bounds)),
+                                 'Bounds are not normalized!')
+                for instant in instants:
+                    self.assertEqual(contains(result, instant),
+                                     op(contains(a, instant),
+                                        contains(b, instant)),
+                                     'Wrong %s of %s and %s at %s' %
+                                     (name, list(a), list(b), instant))
+
+        def covered(tw, routeTW):
+            # Timewindows processed by the former loop in getRouteDS
+            result = list()
+            setTW = set([tw])
+            while setTW:
+                toProc = setTW.pop()
+                if toProc in routeTW:
+                    for auxTW in toProc.difference(routeTW):
+                        if auxTW == toProc:
+                            break
+                        setTW.add(auxTW)
+                    try:
+                        result.append(toProc.intersection(routeTW))
+                    except ValueError:
+                        continue
+            return result
+
+        for i in range(2000):
+            tw, routeTW = randomTW(), randomTW()
+            expected = covered(tw, routeTW)
+            result = coveredTW(tw, routeTW) if tw in routeTW else []
+            self.assertEqual(result, expected,
+                             'Wrong coverage of %s by %s' % (tw, routeTW))
+
+    def testStationEpochs(self):
+        """Only stations operating in the timewindow are routed"""
+
+        world = geoRectangle(-90, 90, -180, 180)
+        result = self.rc.getRoute(Stream('GE', '*', '*', '*'),
+                                  TW(datetime.datetime(2010, 1, 1), None),
+                                  'station', world)
+        self.assertNotIn('LVC', [p['sta'] for p in result[0]['params']],
+                         'LVC was closed in 2000!')
+
+        result = self.rc.getRoute(Stream('GE', '*', '*', '*'),
+                                  TW(datetime.datetime(1995, 1, 1),
+                                     datetime.datetime(1996, 1, 1)),
+                                  'station', world)
+        self.assertIn('LVC', [p['sta'] for p in result[0]['params']],
+                      'LVC was operating in 1995!')
+
+        with self.assertRaises(RoutingException):
+            self.rc.getRoute(Stream('GE', 'LVC', '*', '*'),
+                             TW(datetime.datetime(2010, 1, 1), None))
+
+    def testRoutesOutsideTW(self):
+        """Stations are not needed for routes outside the timewindow"""
+
+        st = Stream('XX', 'ABC', '*', '*')
+        rc = RoutingCache()
+        rc.routingTable = dict()
+        rc.vnTable = dict()
+        # No station is cached at the host of the old route
+        rc.stationTable = {'new.org': {st: [Station('ABC', 0.0, 0.0, None,
+                                                    None)]}}
+        finalset = [(st, Route('dataselect', 'http://old.org/ds',
+                               TW(datetime.datetime(1990, 1, 1),
+                                  datetime.datetime(1995, 1, 1)), 1)),
+                    (st, Route('dataselect', 'http://new.org/ds',
+                               TW(datetime.datetime(2000, 1, 1), None), 1))]
+        result = rc.resolveRoutes('dataselect', st,
+                                  TW(datetime.datetime(2010, 1, 1), None),
+                                  None, finalset)
+        self.assertEqual([dc['url'] for dc in result], ['http://new.org/ds'],
+                         'Wrong routes selected!')
+
+    def testMultiValued_XXX(self):
+        """Multi-valued query with non-existing networks only"""
+
+        with self.assertRaises(RoutingException):
+            self.rc.getRoute(Stream(['XXX', 'YYY'], '*', '*', '*'),
+                             TW(None, None))
+
+    def testPackedSnapshot(self):
+        """Routes read from the packed snapshot equal the original ones"""
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, 'routing.xml.pack')
+            writePacked(fileName, self.rc.routingTable, self.rc.stationTable,
+                        self.rc.vnTable, [])
+            snapshot = PackedSnapshot(fileName)
+
+            rc = RoutingCache()
+            rc.routingTable = snapshot.routingTable
+            rc.stationTable = snapshot.stationTable
+            rc.vnTable = snapshot.vnTable()
+            self.assertEqual(dict(rc.routingTable), self.rc.routingTable,
+                             'Routing tables differ!')
+            self.assertEqual(rc.vnTable, self.rc.vnTable,
+                             'Virtual networks differ!')
+
+            # Routes ranked in advance are used without decoding them
+            table = snapshot.routingTable
+            table.cache.clear()
+            index = BitsetIndex(table)
+            self.assertFalse(table.cache, 'Routes decoded by the index!')
+            expected = BitsetIndex(self.rc.routingTable)
+            self.assertEqual(index.services, expected.services,
+                             'Streams of the services differ!')
+            ranked = dict((service, ServiceRoutes(index, service))
+                          for service in expected.services)
+            self.assertFalse(table.cache, 'Routes decoded to rank!')
+            for service, packed in ranked.items():
+                original = ServiceRoutes(expected, service)
+                self.assertIsNotNone(packed.conflictFirst,
+                                     'Partition of %s not used!' % service)
+                self.assertEqual(len(packed), len(original),
+                                 'Ranks of %s differ!' % service)
+                for rank in range(len(original)):
+                    self.assertEqual(packed.item(rank), original.item(rank),
+                                     'Rank %d of %s differs!' %
+                                     (rank, service))
+                    self.assertEqual(packed.conflicts(rank),
+                                     original.conflicts(rank),
+                                     'Overlaps of %d (%s) differ!' %
+                                     (rank, service))
+                for pos in range(len(index.streams)):
+                    self.assertEqual(packed.entries(pos),
+                                     original.entries(pos),
+                                     'Routes of %s differ!' %
+                                     (index.streams[pos],))
+
+            # Decoded routes are kept and timewindows shared
+            table = snapshot.routingTable
+            st = Stream('GE', '*', '*', '*')
+            self.assertIs(table[st], table[st], 'Routes decoded again!')
+            tws = dict()
+            for st in table:
+                for rt in table[st]:
+                    self.assertIs(tws.setdefault(tuple(rt.tw), rt.tw), rt.tw,
+                                  'Timewindows not shared!')
+            table.cacheSize = 2
+            table.cache.clear()
+            for st, routes in self.rc.routingTable.items():
+                self.assertEqual([tuple(rt) for rt in table[st]],
+                                 [tuple(rt) for rt in routes],
+                                 'Routes of %s differ!' % (st,))
+                self.assertLessEqual(len(table.cache), 2, 'Cache too big!')
+
+            world = geoRectangle(-90, 90, -180, 180)
+            for net in ('GE', 'RO', '_GEALL', '*'):
+                for service in ('dataselect', 'station'):
+                    self.assertEqual(
+                        rc.getRoute(Stream(net, '*', '*', '*'),
+                                    TW(datetime.datetime(1995, 1, 1), None),
+                                    service, world),
+                        self.rc.getRoute(Stream(net, '*', '*', '*'),
+                                         TW(datetime.datetime(1995, 1, 1),
+                                            None),
+                                         service, world),
+                        'Routes differ for %s (%s)!' % (net, service))
+
+    def testInterner(self):
+        """Repeated values are shared without changing the routing tables"""
+
+        sample = os.path.join(here, '..', 'data', 'routing.xml.sample')
+        interner = Interner()
+        ptRT = addRoutes(sample, interner=interner)
+        ptVN = addVirtualNets(sample, interner=interner)
+        self.assertGreater(interner.saved, 0, 'No values were shared!')
+        self.assertEqual([(st, [tuple(rt) for rt in routes])
+                          for st, routes in ptRT.items()],
+                         [(st, [tuple(rt) for rt in routes])
+                          for st, routes in self.rc.routingTable.items()],
+                         'Routing tables differ!')
+        self.assertEqual(ptVN, self.rc.vnTable, 'Virtual networks differ!')
+
+        addresses = dict()
+        for routes in ptRT.values():
+            for rt in routes:
+                self.assertIs(addresses.setdefault(rt.address, rt.address),
+                              rt.address, 'Address %s repeated!' % rt.address)
+
+        ptRT, ptST, ptVN = internTables(self.rc.routingTable,
+                                        self.rc.stationTable,
+                                        self.rc.vnTable)
+        self.assertEqual(ptST, self.rc.stationTable, 'Station caches differ!')
+        stations = [sta for streams in ptST.values()
+                    for stList in streams.values() for sta in stList]
+        for sta in stations:
+            self.assertIs(sta.name, [s.name for s in stations
+                                     if s.name == sta.name][0],
+                          'Station %s repeated!' % sta.name)
+
+    def testPostBody(self):
+        """POST bodies read in chunks are routed like line by line"""
+
+        text = ('service=dataselect\r\n\nformat=post\n'
+                'GE APE * BHZ 2010-01-01T00:00:00 *\r\n'
+                'ge ape * BHZ 2010-01-01T00:00:00 *\r'
+                'RO * * * * 2011-01-01\n\n'
+                'CH LIENZ * HHZ * *\n'
+                'XXX * * * * *\n'
+                'GE APE * BHZ 2010-01-01T00:00:00 *')
+        for chunkSize in (1, 2, 7, 65536):
+            for length in (None, len(text)):
+                lines = readLines(io.BytesIO(text.encode()), length,
+                                  chunkSize)
+                self.assertEqual(list(lines), text.splitlines(),
+                                 'Wrong lines with chunks of %d bytes' %
+                                 chunkSize)
+
+        body = PostBody(text.splitlines())
+        self.assertEqual(body.header, ['service=dataselect', 'format=post'],
+                         'Wrong header!')
+        self.assertEqual(len(list(body)), 6, 'Wrong number of lines!')
+
+        expected = RequestMerge()
+        for st, tw in [(Stream('GE', 'APE', '*', 'BHZ'),
+                        TW(datetime.datetime(2010, 1, 1), None)),
+                       (Stream('RO', '*', '*', '*'),
+                        TW(None, datetime.datetime(2011, 1, 1))),
+                       (Stream('CH', 'LIENZ', '*', 'HHZ'), TW(None, None))]:
+            expected.extend(self.rc.getRoute(st, tw))
+
+        for batchSize in (1, 1000):
+            body = PostBody(readLines(io.BytesIO(text.encode()), None, 5))
+            result = makeQueryPOST(body, self.rc, batchSize)
+            self.assertEqual(list(result), list(expected),
+                             'Wrong routes with batches of %d' % batchSize)
+        self.assertEqual(list(makeQueryPOST(text, self.rc)), list(expected),
+                         'Wrong routes from the text of the body!')
+
+    def testBodyStream(self):
+        """Large bodies are received while they are read"""
+
+        lines = ['GE APE * BHZ 2010-01-01T00:00:00 *'] * 5000
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        chunks = [body[i:i + 1000] for i in range(0, len(body), 1000)]
+        scope = {'method': 'POST', 'path': '/query', 'query_string': b'',
+                 'headers': [(b'content-length', str(len(body)).encode())]}
+
+        def receiver(disconnect=None):
+            received = list()
+
+            async def receive():
+                received.append(len(received))
+                if len(received) == disconnect:
+                    return {'type': 'http.disconnect'}
+                return {'type': 'http.request',
+                        'body': chunks[len(received) - 1],
+                        'more_body': len(received) < len(chunks)}
+
+            return receive, received
+
+        async def run(receive, received):
+            start, more = await readBody(receive, limit=4096)
+            self.assertTrue(more, 'Whole body read in the event loop!')
+            loop = asyncio.get_running_loop()
+            environ = makeEnviron(scope, start,
+                                  BodyStream(receive, loop, start))
+            self.assertEqual(environ['CONTENT_LENGTH'], str(len(body)))
+
+            def consume():
+                result = readLines(environ['wsgi.input'],
+                                   int(environ['CONTENT_LENGTH']), 2000)
+                first = [next(result)]
+                self.assertLess(len(received), len(chunks) // 4,
+                                'Body received before being read!')
+                return first + list(result)
+
+            return await loop.run_in_executor(None, consume)
+
+        receive, received = receiver()
+        self.assertEqual(asyncio.run(run(receive, received)), lines,
+                         'Wrong lines read!')
+        self.assertEqual(len(received), len(chunks), 'Wrong chunks received!')
+
+        receive, received = receiver(disconnect=20)
+        with self.assertRaises(ClientDisconnected):
+            asyncio.run(run(receive, received))
+
+        # Small bodies are read at once
+        environ = makeEnviron(scope, b'net=GE')
+        self.assertEqual(environ['CONTENT_LENGTH'], '6')
+        self.assertEqual(environ['wsgi.input'].read(), b'net=GE')
+
+    def testQueryString(self):
+        """GET parameters keep their aliases, case and duplicate checks"""
+
+        params = parseQueryString('network=ge&sta=APE&sta=&cha=BH%3F&x=%ff')
+        self.assertEqual(params, {'network': ['ge'], 'sta': ['APE'],
+                                  'cha': ['BH?'], 'x': ['\ufffd']},
+                         'Wrong parameters!')
+
+        expected = self.rc.getRoute(Stream('GE', 'APE', '*', 'BH?'),
+                                    TW(None, None))
+        for qs in ('net=ge&sta=ape&cha=bh?', 'network=GE&station=APE&'
+                   'channel=BH%3F&format=json'):
+            result = makeQueryGET(parseQueryString(qs), self.rc)
+            self.assertEqual(list(result), list(expected),
+                             'Wrong routes for %s' % qs)
+
+        for qs in ('net=GE&net=RO', 'network=RO&network=CH',
+                   'net=GE&foo=bar'):
+            with self.assertRaises(WIClientError, msg=qs):
+                makeQueryGET(parseQueryString(qs), self.rc)
+
+    def testResponseBytes(self):
+        """Responses are sent in UTF-8 with the right Content-Length"""
+
+        headers = dict()
+
+        def start_response(status, responseHeaders):
+            headers.clear()
+            headers.update(responseHeaders)
+
+        for send in (send_plain_response, send_xml_response,
+                     send_json_response, send_error_response):
+            for body in ('Zürich', 'Zürich'.encode('utf-8')):
+                chunks = send('200 OK', body, start_response)
+                self.assertEqual(b''.join(chunks), 'Zürich'.encode('utf-8'),
+                                 'Wrong body from %s' % send.__name__)
+                self.assertEqual(headers['Content-Length'], '7',
+                                 'Wrong length from %s' % send.__name__)
+
+        chunks = send_json_response('200 OK', {'a': 'é'}, start_response)
+        self.assertEqual(headers['Content-Length'],
+                         str(len(b''.join(chunks))), 'Wrong JSON length!')
+
+        # Responses without body
+        self.assertEqual(send_error_response('400 Bad Request', '',
+                                             start_response), [b''])
+        self.assertEqual(headers['Content-Length'], '0', 'Wrong length!')
+        for status in ('204 No Content', '304 Not Modified'):
+            self.assertEqual(b''.join(send_error_response(status, '',
+                                                          start_response)),
+                             b'', 'Body sent with %s!' % status)
+            self.assertNotIn('Content-Length', headers,
+                             'Content-Length sent with %s!' % status)
+
+        for outFormat in ('xml', 'json', 'get', 'post', 'fdsn'):
+            result = self.rc.getRoute(Stream('GE', 'APE', '*', 'BHZ'),
+                                      TW(None, None))
+            self.assertIsInstance(applyFormat(result, outFormat), bytes,
+                                  'Format %s not encoded!' % outFormat)
+
+    def testJSONEncoders(self):
+        """JSON encoders serialize the results in the same way"""
+
+        result = RequestMerge()
+        for i in range(20):
+            result.append('dataselect', 'http://server/query', 1,
+                          Stream('GE', 'ÄPE%d' % (i % 3), '', 'BHZ'),
+                          TW(datetime.datetime(2010, 1, 1 + i % 4),
+                             datetime.datetime(2011, 1, 1, 0, 0, 0, i)
+                             if i % 2 else None))
+
+        expected = json.dumps(result, default=datetime.datetime.isoformat)
+        self.assertEqual(dumpsJSON(result), expected.encode('utf-8'),
+                         'Output differs from the standard library!')
+        try:
+            for name in jsonEncoders:
+                setJSONEncoder(name)
+                self.assertEqual(json.loads(applyFormat(result, 'json')),
+                                 json.loads(expected),
+                                 'Wrong output from %s' % name)
+
+            # The encoder missing is only reported once
+            with self.assertLogs(level='WARNING') as logs:
+                for i in range(3):
+                    setJSONEncoder('missing')
+            self.assertEqual(len(logs.records), 1,
+                             'Encoder missing reported more than once!')
+            self.assertEqual(applyFormat(result, 'json'),
+                             expected.encode('utf-8'), 'No fallback to json!')
+        finally:
+            setJSONEncoder('json')
+
+    def testBitsetIndex(self):
+        """Streams selected with bitsets equal the scan of the routing table"""
+
+        codes = (['GE', 'G*', 'RO', '*', 'XX'], ['APE', 'A*', 'BZS', '*', ''],
+                 ['', '00', '*', '0?'], ['BHZ', 'BH?', 'HHZ', '*', '[BH]HN'])
+        rc = RoutingCache()
+        rc.vnTable = self.rc.vnTable
+        random.seed(46)
+        for size in (0, 1, 10, 200):
+            rc.routingTable = dict((Stream(*[random.choice(c)
+                                             for c in codes]), list())
+                                   for i in range(size))
+            for i in range(50):
+                comps = [random.sample(c, random.randint(1, 3))
+                         for c in codes]
+                if i % 5 == 0:
+                    comps[0].append('_GEALL')
+                self.assertEqual(rc.expandNSLC(*comps), rc.scanNSLC(*comps),
+                                 'Wrong streams for %s' % comps)
+
+        # Streams with routes of every service
+        index = self.rc.getBitsetIndex()
+        for service in ('dataselect', 'station', 'wfcatalog'):
+            expected = [st for st, routes in self.rc.routingTable.items()
+                        if any(rt.service == service for rt in routes)]
+            self.assertEqual(index.select(index.services[service]), expected,
+                             'Wrong streams for %s' % service)
+
+        self.assertIs(rc.getBitsetIndex(), rc.getBitsetIndex(),
+                      'Index not reused!')
+        index = rc.getBitsetIndex()
+        rc.routingTable = dict(rc.routingTable)
+        self.assertIsNot(rc.getBitsetIndex(), index, 'Index not rebuilt!')
+
+    def testMultiService(self):
+        """Routes for many services equal the routes of every service"""
+
+        def normalize(result):
+            return sorted((dc['name'], dc['url'], sorted(map(repr,
+                                                             dc['params'])))
+                          for dc in result)
+
+        services = ('dataselect', 'station', 'wfcatalog')
+        for st in (Stream('*', '*', '*', '*'), Stream('GE', '*', '*', 'BH?'),
+                   Stream('_GEALL', '*', '*', '*'),
+                   Stream(['RO', 'CH'], '*', '*', '*')):
+            for tw in (TW(None, None), TW(datetime.datetime(2010, 1, 1),
+                                          None)):
+                expected = RequestMerge()
+                for service in services:
+                    try:
+                        expected.extend(self.rc.getRoute(st, tw, service,
+                                                         alternative=True))
+                    except RoutingException:
+                        pass
+                result = self.rc.getRoute(st, tw, ','.join(services),
+                                          alternative=True)
+                self.assertEqual(normalize(result), normalize(expected),
+                                 'Wrong routes for %s %s' % (st, tw))
+
+    def testServiceOrder(self):
+        """A service without routes does not hide the routes of the others"""
+
+        def normalize(result):
+            return sorted((dc['name'], dc['url'], sorted(map(repr,
+                                                             dc['params'])))
+                          for dc in result)
+
+        st = Stream('XX', 'ABC', '*', '*')
+        old = TW(datetime.datetime(1990, 1, 1), datetime.datetime(1995, 1, 1))
+        rc = RoutingCache()
+        # The station service has a route for the stream, but not for the
+        # timewindow requested
+        rc.routingTable = {st: [Route('dataselect', 'http://ds.org/ds',
+                                      TW(None, None), 1),
+                                Route('wfcatalog', 'http://ds.org/wfc',
+                                      TW(None, None), 1),
+                                Route('station', 'http://st.org/st', old, 1)]}
+        rc.stationTable = dict()
+        for host in ('ds.org', 'st.org'):
+            rc.stationTable[host] = {st: [Station('ABC', 0.0, 0.0, None,
+                                                  None)]}
+        rc.vnTable = dict()
+
+        tw = TW(datetime.datetime(2010, 1, 1), None)
+        services = ['station', 'dataselect', 'wfcatalog']
+        expected = None
+        for i in range(len(services)):
+            order = services[i:] + services[:i]
+            result = rc.getRoute(st, tw, ','.join(order))
+            self.assertEqual(len(result), 2, 'Routes missing with %s!' %
+                             ','.join(order))
+            if expected is None:
+                expected = normalize(result)
+            self.assertEqual(normalize(result), expected,
+                             'Result depends on the order of the services!')
+
+        # Services are given in the order they were requested
+        result = rc.getRoute(st, tw, 'wfcatalog,station,dataselect')
+        self.assertEqual([dc['name'] for dc in result],
+                         ['wfcatalog', 'dataselect'],
+                         'Services not in the order requested!')
+
+    def testNoRoutes(self):
+        """Requests without routes are remembered and answered at once"""
+
+        rc = RoutingCache()
+        rc.routingTable = self.rc.routingTable
+        rc.stationTable = self.rc.stationTable
+        rc.vnTable = self.rc.vnTable
+        rc.noRoutesSize = 3
+
+        def hits():
+            return registry.cacheHits['noroutes']
+
+        # Unknown networks are rejected without being searched
+        before = hits()
+        for st in (Stream('XXX', '*', '*', '*'), Stream(['XX', 'YY'], '*',
+                                                        '*', '*')):
+            self.assertRaises(RoutingException, rc.getRoute, st,
+                              TW(None, None))
+        self.assertEqual(hits(), before + 2, 'Unknown network not rejected!')
+        self.assertEqual(len(rc.noRoutes), 0, 'Unknown network remembered!')
+
+        # Known networks without routes for the request
+        streams = [Stream('GE', s, '*', '*') for s in ('AAA', 'BBB', 'CCC',
+                                                       'DDD')]
+        for st in streams:
+            self.assertRaises(RoutingException, rc.getRoute, st,
+                              TW(None, None))
+        self.assertEqual(len(rc.noRoutes), 3, 'Wrong number of requests!')
+
+        before = hits()
+        self.assertRaises(RoutingException, rc.getRoute, streams[-1],
+                          TW(None, None))
+        self.assertEqual(hits(), before + 1, 'Request not remembered!')
+
+        # New routing information
+        rc.routingTable = dict(rc.routingTable)
+        before = hits()
+        self.assertRaises(RoutingException, rc.getRoute, streams[-1],
+                          TW(None, None))
+        self.assertEqual(hits(), before, 'Request remembered after update!')
+        self.assertEqual(len(rc.noRoutes), 1, 'Old requests not forgotten!')
+
+        self.assertEqual(len(rc.getRoute(Stream('GE', 'APE', '*', 'BHZ'),
+                                         TW(None, None))), 1,
+                         'Request with routes not routed!')
+
+    def testSingleFlight(self):
+        """Identical calls made at once are computed only once"""
+
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = list()
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return b'result'
+
+        def failing():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            raise WIClientError('Wrong query')
+
+        for func, expected in ((slow, b'result'),
+                               (failing, WIClientError)):
+            del calls[:]
+            started.clear()
+            release.clear()
+            results = list()
+
+            def call():
+                try:
+                    results.append(flights.do(('key',), func))
+                except WIClientError as e:
+                    results.append(type(e))
+
+            leader = threading.Thread(target=call)
+            leader.start()
+            self.assertTrue(started.wait(5), 'Call not started!')
+            before = registry.cacheHits['singleflight']
+            waiters = [threading.Thread(target=call) for i in range(5)]
+            for th in waiters:
+                th.start()
+            # Wait until all the calls are waiting for the first one
+            while registry.cacheHits['singleflight'] < before + 5:
+                release.wait(0.01)
+            release.set()
+            for th in [leader] + waiters:
+                th.join(5)
+
+            self.assertEqual(len(calls), 1, 'Call computed more than once!')
+            self.assertEqual(results, [expected] * 6, 'Result not shared!')
+            self.assertEqual(len(flights.calls), 0, 'Call not forgotten!')
+
+        # Calls made later are computed again
+        release.set()
+        self.assertEqual(flights.do(('key',), slow), b'result')
+        self.assertEqual(len(calls), 2, 'Result kept after the call!')
+
+    def testStartReloader(self):
+        """Only one reloader is started by concurrent requests"""
+
+        config = configparser.RawConfigParser()
+        config.read_dict({'Service': {'reloadinterval': '3600'}})
+        saved = (routing.routes, routing.reloader)
+        routing.routes = RoutingCache()
+        routing.reloader = None
+        barrier = threading.Barrier(8)
+
+        def start():
+            barrier.wait()
+            routing.startReloader(here, config)
+
+        threads = [threading.Thread(target=start) for i in range(8)]
+        try:
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join(5)
+            reloaders = [th for th in threading.enumerate()
+                         if th.name == 'RoutingCacheReloader']
+            self.assertEqual(len(reloaders), 1, 'More than one reloader!')
+        finally:
+            for th in threading.enumerate():
+                if th.name == 'RoutingCacheReloader':
+                    th.stop()
+                    th.join(5)
+            routing.routes, routing.reloader = saved
+
+    def testWarmupFailed(self):
+        """Routes missing at startup are loaded in the background"""
+
+        saved = (routing.routes, routing.reloader, routing.retryInterval)
+        routing.routes = None
+        routing.reloader = None
+        routing.retryInterval = 3600
+        try:
+            with self.assertLogs(level='ERROR'):
+                self.assertFalse(routing.warmup(buildIfMissing=False),
+                                 'Routing information available!')
+            reloader = routing.reloader
+            self.assertIsInstance(reloader, RoutingCacheReloader,
+                                  'Reloader not started!')
+            self.assertEqual(reloader.mtime, (None, None),
+                             'Snapshots in use when nothing was loaded!')
+            self.assertTrue(reloader.is_alive(), 'Reloader not running!')
+
+            # The first routes loaded stop the reloader if it is disabled
+            reloader.callback(RoutingCache())
+            self.assertIsNotNone(routing.routes, 'Routes not swapped in!')
+            self.assertTrue(reloader.stopped.is_set(), 'Reloader not stopped!')
+
+            # Requests never wait while the routes are being loaded
+            routing.reloader = None
+            with routing.loadLock:
+                routing.startReloader(here, configparser.RawConfigParser(),
+                                      blocking=False)
+            self.assertIsNone(routing.reloader, 'Reloader started!')
+        finally:
+            for th in threading.enumerate():
+                if th.name == 'RoutingCacheReloader':
+                    th.stop()
+                    th.join(5)
+            (routing.routes, routing.reloader,
+             routing.retryInterval) = saved
+
+    def testMetrics(self):
+        """Stages of the sampled requests are timed and exported"""
+
+        metrics = Metrics(sampling=0)
+        self.assertIsNone(metrics.start(), 'Request sampled with sampling 0!')
+        metrics.finish('query', '204 No Content')
+
+        metrics.sampling = 1
+        timer = metrics.start()
+        self.assertIs(metrics.current(), timer, 'Timer not available!')
+        timer.lap('read')
+        timer.size('bytes', 100)
+        metrics.finish('query', '200 OK', timer)
+        self.assertIsNone(metrics.current(), 'Timer still in use!')
+
+        text = metrics.export(self.rc)
+        for line in ('routing_requests_total{function="query",status="200"} 1',
+                     'routing_requests_total{function="query",status="204"} 1',
+                     'routing_stage_seconds_count{function="query",'
+                     'stage="read"} 1',
+                     'routing_result_size_sum{function="query",'
+                     'magnitude="bytes"} 100',
+                     'routing_table_streams %d' % len(self.rc.routingTable)):
+            self.assertIn(line, text.splitlines(), 'Metric missing: %s' % line)
+
+    def testMetricsRouting(self):
+        """Routing stages are timed only for the sampled requests"""
+
+        registry.sampling, sampling = 1, registry.sampling
+        try:
+            timer = registry.start()
+            self.rc.getRoute(Stream('_GEALL', '*', '*', '*'), TW(None, None))
+            registry.finish('query', '200 OK', timer)
+        finally:
+            registry.sampling = sampling
+
+        for stage in ('expandNSLC', 'vn2real', 'getRouteDS'):
+            self.assertIn(stage, timer.stages, 'Stage %s not timed!' % stage)
+
+
 # ----------------------------------------------------------------------
 def usage():
     print('testRoute [-h] [-p]')